@@ -0,0 +1,286 @@
+"""
+Microbenchmarks of the hot paths of the wire codec and of bencoding.
+
+Covered:
+    - `PeerStreamIterator.parse` on realistic message mixes (a fast seeder
+      sending blocks, a chatty peer sending Have/Request/Cancel, a leecher
+      sending requests)
+    - `Piece.decode` / `Piece.encode`, `Request.encode`, `BitField.decode`
+      and `Handshake.decode`
+    - `Decoder` / `Encoder` on the bundled .torrent files in `data/`, on a
+      synthetic torrent of 300000 pieces and 10000 files and on a large
+      (non-compact) tracker response
+
+Each benchmark reports operations per second and bytes per second (best of
+a number of timed rounds). Results are printed as JSON, keyed by benchmark
+name, so they can be saved as a baseline and compared against later:
+
+    python -m benchmarks.micro_bench --save baseline.json
+    python -m benchmarks.micro_bench --compare baseline.json
+
+In compare mode the change of every benchmark is printed, and the exit
+status is 1 if any of them is slower than the baseline by more than the
+threshold (10% by default).
+
+Run from the repository root.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from utils.bencoding import Decoder, Encoder
+from utils.peer_message import REQUEST_SIZE, BitField, Cancel, Handshake, \
+    Have, Interested, Piece, Request, Unchoke
+from utils.peer_stream_iterator import PeerStreamIterator
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data')
+
+BLOCK = bytes(range(256)) * (REQUEST_SIZE // 256)
+
+
+def _seeder_mix() -> list:
+    # Blocks with the occasional Have, as sent by a fast seeder
+    messages = []
+    for i in range(256):
+        messages.append(Piece(i // 16, (i % 16) * REQUEST_SIZE, BLOCK))
+        if i % 16 == 15:
+            messages.append(Have(i // 16))
+    return messages
+
+
+def _chatty_mix() -> list:
+    # Small control messages, as sent by a peer in the endgame
+    messages = []
+    for i in range(1024):
+        messages.append(Have(i))
+        messages.append(Request(i, 0))
+        messages.append(Cancel(i, 0))
+    return messages
+
+
+def _leecher_mix() -> list:
+    # Requests of a leecher filling a deep pipeline
+    messages = [Interested()]
+    for i in range(4096):
+        messages.append(Request(i // 16, (i % 16) * REQUEST_SIZE))
+    return messages
+
+
+def bench_parse(messages: list):
+    """
+    Parse a stream of the given messages, returning (messages, bytes).
+    """
+    stream = b''.join(m.encode() for m in messages)
+
+    def run():
+        iterator = PeerStreamIterator(None)
+        iterator.feed(stream)
+        return iterator.parse(), len(stream)
+    return run
+
+
+def bench_piece_decode():
+    data = Piece(1, REQUEST_SIZE, BLOCK).encode()
+
+    def run():
+        for _ in range(1000):
+            Piece.decode(data)
+        return 1000, 1000 * len(data)
+    return run
+
+
+def bench_piece_encode():
+    def run():
+        for _ in range(1000):
+            Piece(1, REQUEST_SIZE, BLOCK).encode()
+        return 1000, 1000 * (len(BLOCK) + 13)
+    return run
+
+
+def bench_request_encode():
+    def run():
+        for i in range(1000):
+            Request(i, REQUEST_SIZE).encode()
+        return 1000, 1000 * 17
+    return run
+
+
+def bench_bitfield_decode():
+    # The bitfield of a torrent of 10000 pieces
+    data = BitField(b'\xaa' * 1250).encode()
+
+    def run():
+        for _ in range(100):
+            BitField.decode(data)
+        return 100, 100 * len(data)
+    return run
+
+
+def bench_handshake_decode():
+    data = Handshake(b'\x01' * 20, b'-PC0001-012345678901').encode()
+
+    def run():
+        for _ in range(1000):
+            Handshake.decode(data)
+        return 1000, 1000 * len(data)
+    return run
+
+
+def _torrent_files() -> list:
+    files = []
+    for path in sorted(glob.glob(os.path.join(DATA_DIRECTORY, '*.torrent'))):
+        with open(path, 'rb') as f:
+            files.append(f.read())
+    return files
+
+
+def bench_decode(files: list):
+    def run():
+        for data in files:
+            Decoder(data).decode()
+        return len(files), sum(len(data) for data in files)
+    return run
+
+
+def bench_encode(files: list):
+    decoded = [Decoder(data).decode() for data in files]
+
+    def run():
+        size = 0
+        for meta_info in decoded:
+            size += len(Encoder(meta_info).encode())
+        return len(decoded), size
+    return run
+
+
+def _large_torrent() -> bytes:
+    info = {
+        b'name': b'large',
+        b'piece length': 2**18,
+        b'pieces': bytes(range(20)) * 300000,
+        b'files': [{b'length': 7864320, b'path': [b'directory',
+                                                 b'file%05d.bin' % i]}
+                   for i in range(10000)],
+    }
+    return bytes(Encoder({b'announce': b'http://127.0.0.1/announce',
+                          b'info': info}).encode())
+
+
+def _tracker_response() -> bytes:
+    peers = [{b'ip': b'10.0.%d.%d' % (i // 256, i % 256),
+              b'peer id': b'-PC0001-%012d' % i,
+              b'port': 6881 + i % 100}
+             for i in range(5000)]
+    return bytes(Encoder({b'complete': 2500, b'incomplete': 2500,
+                          b'interval': 1800, b'peers': peers}).encode())
+
+
+def benchmarks() -> dict:
+    files = _torrent_files()
+    large = [_large_torrent()]
+    response = [_tracker_response()]
+    return {
+        'parse.seeder_mix': bench_parse(_seeder_mix()),
+        'parse.chatty_mix': bench_parse(_chatty_mix()),
+        'parse.leecher_mix': bench_parse(_leecher_mix()),
+        'piece.decode': bench_piece_decode(),
+        'piece.encode': bench_piece_encode(),
+        'request.encode': bench_request_encode(),
+        'bitfield.decode': bench_bitfield_decode(),
+        'handshake.decode': bench_handshake_decode(),
+        'bencoding.decode': bench_decode(files),
+        'bencoding.encode': bench_encode(files),
+        'bencoding.decode_large_torrent': bench_decode(large),
+        'bencoding.encode_large_torrent': bench_encode(large),
+        'bencoding.decode_tracker_response': bench_decode(response),
+        'bencoding.encode_tracker_response': bench_encode(response),
+    }
+
+
+def measure(run, rounds: int, min_time: float) -> dict:
+    """
+    Time the given benchmark, repeating it until a round lasts at least
+    `min_time` seconds. The best of `rounds` rounds is kept.
+    """
+    repeat = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        if time.perf_counter() - start >= min_time:
+            break
+        repeat *= 2
+
+    best = None
+    for _ in range(rounds):
+        ops = size = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            o, s = run()
+            ops += o
+            size += s
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'ops_per_s': ops / best, 'bytes_per_s': size / best}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Print the change of every benchmark against the baseline.
+
+    :return: True if no benchmark regressed by more than the threshold
+    """
+    ok = True
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print('{name:<34} {ops:>14.0f} ops/s   (new)'.format(
+                name=name, ops=result['ops_per_s']))
+            continue
+        change = result['ops_per_s'] / baseline[name]['ops_per_s'] - 1
+        regressed = change < -threshold
+        ok = ok and not regressed
+        print('{name:<34} {ops:>14.0f} ops/s {change:>+8.1%}{flag}'.format(
+            name=name, ops=result['ops_per_s'], change=change,
+            flag='  REGRESSION' if regressed else ''))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Number of timed rounds (best one is reported)')
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='Minimum duration of a round in seconds')
+    parser.add_argument('--filter', default='',
+                        help='Only run the benchmarks containing this text')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare the results against a baseline')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Slowdown in percent reported as regression')
+    args = parser.parse_args()
+
+    results = {}
+    for name, run in benchmarks().items():
+        if args.filter in name:
+            results[name] = measure(run, args.rounds, args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold / 100):
+            sys.exit(1)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Measures the framing throughput of `PeerStreamIterator` for a single peer
+connection.
+
+A synthetic stream of wire messages (mostly 16 KiB `Piece` blocks with the
+occasional `Have` and `KeepAlive` in between, as a fast seeder would send
+them) is fed into an `asyncio.StreamReader` which is then drained by the
+iterator, exactly as `PeerConnection` does.
+
+Run from the repository root:
+
+    python -m benchmarks.stream_bench [--blocks N] [--rounds N]
+"""
+import argparse
+import asyncio
+import time
+
+from utils.peer_message import REQUEST_SIZE, Have, KeepAlive, Piece
+from utils.peer_stream_iterator import PeerStreamIterator
+
+
+def build_stream(blocks: int) -> bytes:
+    """
+    Build the raw bytes of a peer stream containing `blocks` Piece messages.
+    """
+    block = bytes(range(256)) * (REQUEST_SIZE // 256)
+    messages = []
+    for i in range(blocks):
+        messages.append(Piece(i // 16, (i % 16) * REQUEST_SIZE, block).encode())
+        if i % 16 == 15:
+            messages.append(Have(i // 16).encode())
+        if i % 256 == 255:
+            messages.append(b'\x00\x00\x00\x00')  # KeepAlive
+    return b''.join(messages)
+
+
+async def drain(stream: bytes) -> (int, int):
+    """
+    Iterate over all messages in the stream and return the number of messages
+    and block bytes received.
+    """
+    reader = asyncio.StreamReader(limit=len(stream) + 1)
+    reader.feed_data(stream)
+    reader.feed_eof()
+
+    count = 0
+    received = 0
+    async for message in PeerStreamIterator(reader):
+        count += 1
+        if type(message) is Piece:
+            received += len(message.block)
+    return count, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--blocks', type=int, default=8192,
+                        help='Number of 16 KiB blocks in the stream')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Number of timed rounds (best one is reported)')
+    args = parser.parse_args()
+
+    stream = build_stream(args.blocks)
+    best = None
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        count, received = asyncio.run(drain(stream))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print('messages: {count}, block bytes: {received}'.format(
+        count=count, received=received))
+    print('stream size: {size:.1f} MB, best of {rounds}: {elapsed:.3f} s, '
+          '{rate:.1f} MB/s per connection'.format(
+              size=len(stream) / 2**20,
+              rounds=args.rounds,
+              elapsed=best,
+              rate=len(stream) / 2**20 / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+"""
+Measures the download throughput of `TorrentClient` against a swarm of
+seeders, entirely on localhost.
+
+A synthetic torrent is generated in a temporary directory, then N seeders
+speaking the wire protocol and a stand-in HTTP or UDP (BEP 15) tracker
+(announcing those seeders) are started in the same process. The client
+downloads the torrent from them and the wall time, throughput, CPU time per
+MB and peak RSS are reported.
+
+Each seeder can delay its responses (to emulate a link latency) and limit
+its upload rate, so that the pipelining and piece selection are exercised
+as on a real network.
+
+Note that the seeders and the tracker run in the same process, so the CPU
+time includes theirs; keep them cheap (they read blocks with `os.pread` and
+do no hashing).
+
+Run from the repository root:
+
+    python -m benchmarks.swarm_bench [--size MB] [--seeders N]
+                                     [--latency MS] [--rate KB/S] [--udp]
+                                     [--udp-drop N]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import socket
+import struct
+import tempfile
+import time
+
+from collections import deque
+
+from utils.bencoding import Encoder
+from utils.client import TorrentClient
+from utils.peer_message import BitField, Handshake, Interested, Piece, \
+    Request, Unchoke
+from utils.peer_stream_iterator import PeerStreamIterator
+from utils.torrent import Torrent
+
+
+def make_torrent(directory: str, size: int, piece_length: int,
+                 announce: str) -> (str, str):
+    """
+    Write a file of random data and a torrent describing it.
+
+    :return: The paths of the data file and of the .torrent file
+    """
+    name = 'swarm.bin'
+    data_path = os.path.join(directory, name)
+    hashes = []
+    with open(data_path, 'wb') as f:
+        remaining = size
+        while remaining:
+            piece = os.urandom(min(piece_length, remaining))
+            f.write(piece)
+            hashes.append(hashlib.sha1(piece).digest())
+            remaining -= len(piece)
+    meta_info = {
+        b'announce': announce.encode('utf-8'),
+        b'info': {
+            b'name': name.encode('utf-8'),
+            b'length': size,
+            b'piece length': piece_length,
+            b'pieces': b''.join(hashes),
+        },
+    }
+    torrent_path = os.path.join(directory, name + '.torrent')
+    with open(torrent_path, 'wb') as f:
+        f.write(Encoder(meta_info).encode())
+    return data_path, torrent_path
+
+
+class Seeder:
+    """
+    A seeder of a single torrent. Responses to requests are sent `latency`
+    seconds after the request was received, at most `rate` bytes per second
+    (None for no limit).
+    """
+    def __init__(self, torrent, path: str, latency: float, rate: float):
+        self.torrent = torrent
+        self.fd = os.open(path, os.O_RDONLY)
+        self.latency = latency
+        self.rate = rate
+        self.peer_id = os.urandom(20)
+        self.server = None
+        self.port = None
+        self.uploaded = 0
+        self.handlers = set()
+        # The moment the link is free again (for the rate limit)
+        self._available_at = 0.0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for handler in self.handlers:
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        os.close(self.fd)
+
+    async def _handle(self, reader, writer):
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        pending = deque()
+        ready = asyncio.Event()
+        sender = asyncio.ensure_future(self._send(writer, pending, ready))
+        try:
+            handshake = Handshake.decode(
+                await reader.readexactly(Handshake.length))
+            if not handshake or handshake.info_hash != self.torrent.info_hash:
+                return
+            pieces = len(self.torrent.pieces)
+            bitfield = bytearray(b'\xff' * ((pieces + 7) // 8))
+            if pieces % 8:
+                bitfield[-1] = (0xff << (8 - pieces % 8)) & 0xff
+            writer.write(Handshake(self.torrent.info_hash,
+                                   self.peer_id).encode())
+            writer.write(BitField(bytes(bitfield)).encode())
+            await writer.drain()
+
+            async for message in PeerStreamIterator(reader):
+                if type(message) is Interested:
+                    writer.write(Unchoke().encode())
+                elif type(message) is Request:
+                    pending.append((time.monotonic() + self.latency, message))
+                    ready.set()
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+            self.handlers.discard(handler)
+
+    async def _send(self, writer, pending: deque, ready: asyncio.Event):
+        piece_length = self.torrent.piece_length
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                while pending:
+                    due, request = pending.popleft()
+                    delay = due - time.monotonic()
+                    if self.rate:
+                        now = time.monotonic()
+                        start = max(now, self._available_at)
+                        self._available_at = start + request.length / self.rate
+                        delay = max(delay, start - now)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    block = os.pread(self.fd, request.length,
+                                     request.index * piece_length +
+                                     request.begin)
+                    writer.write(Piece(request.index, request.begin,
+                                       block).encode())
+                    await writer.drain()
+                    self.uploaded += len(block)
+        except ConnectionError:
+            pass
+
+
+class Tracker:
+    """
+    A stand-in HTTP tracker announcing the given peers to everyone.
+    """
+    def __init__(self, peers: list):
+        self.peers = b''.join(socket.inet_aton(ip) + struct.pack('>H', port)
+                              for ip, port in peers)
+        self.server = None
+        self.port = None
+
+    async def start(self, port: int = 0):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1',
+                                                 port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            body = Encoder({b'interval': 1800,
+                            b'complete': len(self.peers) // 6,
+                            b'incomplete': 1,
+                            b'peers': self.peers}).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() +
+                         b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+class UDPTracker(asyncio.DatagramProtocol):
+    """
+    A stand-in UDP tracker (BEP 15) announcing the given peers to everyone.
+
+    The first `drop` requests received are ignored, to exercise the
+    retransmissions of the client.
+    """
+    def __init__(self, peers: list, drop: int = 0):
+        self.peers = b''.join(socket.inet_aton(ip) + struct.pack('>H', port)
+                              for ip, port in peers)
+        self.drop = drop
+        self.connection_ids = set()
+        self.transport = None
+        self.requests = 0
+
+    async def start(self, port: int = 0):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=('127.0.0.1', port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def close(self):
+        self.transport.close()
+
+    def datagram_received(self, data, address):
+        self.requests += 1
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, transaction_id = struct.unpack_from('>QII',
+                                                                   data)
+        if action == 0:
+            connection_id = random.getrandbits(64)
+            self.connection_ids.add(connection_id)
+            response = struct.pack('>IIQ', 0, transaction_id, connection_id)
+        elif connection_id not in self.connection_ids:
+            response = struct.pack('>II', 3, transaction_id) + \
+                b'unknown connection id'
+        elif action == 1:
+            response = struct.pack('>IIIII', 1, transaction_id, 1800, 1,
+                                   len(self.peers) // 6) + self.peers
+        else:
+            # Every torrent scraped has the same statistics
+            hashes = (len(data) - 16) // 20
+            response = struct.pack('>II', 2, transaction_id) + \
+                struct.pack('>III', len(self.peers) // 6, 0, 1) * hashes
+        self.transport.sendto(response, address)
+
+
+def _reserve_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run(args, directory: str) -> dict:
+    # The tracker URL is part of the torrent, so its port is chosen first
+    tracker_port = _reserve_port()
+    data_path, torrent_path = make_torrent(
+        directory, args.size * 2**20, args.piece_length * 2**10,
+        '{scheme}://127.0.0.1:{port}/announce'.format(
+            scheme='udp' if args.udp else 'http', port=tracker_port))
+    torrent = Torrent(torrent_path)
+
+    seeders = [Seeder(torrent, data_path, args.latency / 1000,
+                      args.rate * 2**10 if args.rate else None)
+               for _ in range(args.seeders)]
+    for seeder in seeders:
+        await seeder.start()
+    peers = [('127.0.0.1', seeder.port) for seeder in seeders]
+    tracker = UDPTracker(peers, args.udp_drop) if args.udp else \
+        Tracker(peers)
+    await tracker.start(tracker_port)
+
+    # The client writes to the current directory
+    download = os.path.join(directory, 'download')
+    os.mkdir(download)
+    os.chdir(download)
+
+    client = TorrentClient(Torrent(torrent_path))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    task = asyncio.ensure_future(client.start())
+    while not client.piece_manager.complete and not task.done():
+        await asyncio.sleep(0.02)
+    # Include writing out what is still queued, unless the client returned
+    # (and closed its storage) already
+    if not task.done():
+        await client.piece_manager.storage.flush()
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    complete = client.piece_manager.complete
+    client.abort = True
+    await asyncio.gather(task, return_exceptions=True)
+    # Why the client returned before completing, if it failed
+    error = None if task.cancelled() or task.exception() is None else \
+        repr(task.exception())
+
+    tracker.close()
+    for seeder in seeders:
+        await seeder.close()
+
+    size = torrent.total_size / 2**20
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    return {
+        'complete': complete,
+        'error': error,
+        'size_mb': size,
+        'seeders': args.seeders,
+        'latency_ms': args.latency,
+        'rate_kbps': args.rate,
+        'wall_s': elapsed,
+        'mb_per_s': size / elapsed,
+        'cpu_s': cpu,
+        'cpu_ms_per_mb': cpu * 1000 / size,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': after.ru_maxrss / 2**10,
+        'hash_failures': client.piece_manager.hash_failures,
+        'redundant_mb': client.piece_manager.redundant_bytes / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=256,
+                        help='Size of the torrent in MB')
+    parser.add_argument('--piece-length', type=int, default=256,
+                        help='Piece length in KiB')
+    parser.add_argument('--seeders', type=int, default=4,
+                        help='Number of seeders')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay of the responses of each seeder, in ms')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Upload limit of each seeder in KB/s, 0 for '
+                             'no limit')
+    parser.add_argument('--udp', action='store_true',
+                        help='Announce to a UDP tracker rather than HTTP')
+    parser.add_argument('--udp-drop', type=int, default=0,
+                        help='Number of requests the UDP tracker ignores '
+                             'first, to exercise retransmissions')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='swarm_bench') as directory:
+        try:
+            result = asyncio.run(run(args, directory))
+        finally:
+            os.chdir(cwd)
+
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+    print('{size:.0f} MB from {seeders} seeders (latency {latency:g} ms, '
+          'rate {rate}): {state}'.format(
+              size=result['size_mb'], seeders=args.seeders,
+              latency=args.latency,
+              rate='{:g} KB/s'.format(args.rate) if args.rate else 'no limit',
+              state='complete' if result['complete'] else 'INCOMPLETE'))
+    if result['error']:
+        print('client failed: {error}'.format(**result))
+    print('wall time: {wall_s:.2f} s, {mb_per_s:.1f} MB/s'.format(**result))
+    print('cpu: {cpu_s:.2f} s, {cpu_ms_per_mb:.1f} ms/MB (client and '
+          'seeders)'.format(**result))
+    print('peak rss: {peak_rss_mb:.0f} MB'.format(**result))
+    print('hash failures: {hash_failures}, redundant: {redundant_mb:.1f} '
+          'MB'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Measures the cost of loading torrent meta-data with `Torrent`: the time to
+construct it, the memory it retains and the cost of the accessors used on
+the hot paths (piece hashes, piece length, total size).
+
+A synthetic single-file torrent with the given number of pieces is written
+to a temporary directory first.
+
+Run from the repository root:
+
+    python -m benchmarks.torrent_bench [--pieces N] [--lookups N]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from utils.bencoding import Encoder
+from utils.torrent import Torrent
+
+
+def make_torrent(path: str, pieces: int, piece_length: int = 2**18):
+    meta_info = {
+        b'announce': b'http://127.0.0.1/announce',
+        b'info': {
+            b'name': b'large.bin',
+            b'length': pieces * piece_length - 1000,
+            b'piece length': piece_length,
+            b'pieces': os.urandom(20 * pieces),
+        },
+    }
+    with open(path, 'wb') as f:
+        f.write(Encoder(meta_info).encode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pieces', type=int, default=1000000,
+                        help='Number of pieces of the torrent')
+    parser.add_argument('--lookups', type=int, default=1000,
+                        help='Number of random piece hash lookups')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='torrent_bench') as directory:
+        path = os.path.join(directory, 'large.torrent')
+        make_torrent(path, args.pieces)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        torrent = Torrent(path)
+        load = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    indices = [random.randrange(args.pieces) for _ in range(args.lookups)]
+    start = time.perf_counter()
+    for index in indices:
+        torrent.pieces[index]
+    lookup = (time.perf_counter() - start) / args.lookups
+
+    start = time.perf_counter()
+    for _ in range(args.lookups):
+        torrent.piece_length
+        torrent.total_size
+    accessors = (time.perf_counter() - start) / args.lookups
+
+    print('{pieces} pieces, {size:.1f} MB of hashes'.format(
+        pieces=args.pieces, size=args.pieces * 20 / 2**20))
+    print('load: {load:.1f} ms, retained {retained:.1f} MB, peak {peak:.1f} '
+          'MB'.format(load=load * 1000, retained=retained / 2**20,
+                      peak=peak / 2**20))
+    print('piece hash lookup: {lookup:.2f} us'.format(lookup=lookup * 1e6))
+    print('piece_length + total_size: {accessors:.2f} us'.format(
+        accessors=accessors * 1e6))
+
+
+if __name__ == '__main__':
+    main()
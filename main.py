@@ -1,10 +1,13 @@
+import argparse
 import asyncio
 import logging
+import signal
 
 # from utils.bencoding import Decoder
 from utils.torrent import Torrent
 # from utils.tracker import Tracker
-from utils.client import TorrentClient
+from utils.session import Session
+from utils.storage import Storage
 
 # async def start(tracker):
 #     response = await tracker.connect(
@@ -14,7 +17,60 @@ from utils.client import TorrentClient
 #     )
 #     print(response)
 
+
+async def run(filenames, seed=False, metrics_port=None, port=6889,
+              mmap_threshold=None, fsync=Storage.FSYNC_CLOSE,
+              fsync_interval=30):
+    session = Session(metrics_port=metrics_port, listen_port=port,
+                      mmap_threshold=mmap_threshold, fsync=fsync,
+                      fsync_interval=fsync_interval)
+    await session.start()
+    # Stop on Ctrl-C or SIGTERM by closing the session, so the resume files
+    # are saved (a second Ctrl-C interrupts the closing)
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+    def stop():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        stopped.set()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop)
+    try:
+        for filename in filenames:
+            await session.add(Torrent(filename), seed=seed)
+        waiting = [asyncio.ensure_future(session.wait()),
+                   asyncio.ensure_future(stopped.wait())]
+        await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+        for task in waiting:
+            task.cancel()
+    finally:
+        await session.close()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download torrents')
+    parser.add_argument('torrents', nargs='*',
+                        default=['data/ubuntu-20.10-desktop-amd64.iso.torrent'],
+                        help='The .torrent files to download')
+    parser.add_argument('--seed', action='store_true',
+                        help='Keep seeding the torrents once downloaded')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve the metrics of the torrents on this port')
+    parser.add_argument('--port', type=int, default=6889,
+                        help='Accept connections from peers on this port '
+                             '(0 for any free port)')
+    parser.add_argument('--mmap-threshold', type=int, metavar='MB',
+                        help='Memory map the files up to this size')
+    parser.add_argument('--fsync', default=Storage.FSYNC_CLOSE,
+                        choices=[Storage.FSYNC_NEVER, Storage.FSYNC_PERIODIC,
+                                 Storage.FSYNC_CLOSE],
+                        help='When to sync the files to disk')
+    parser.add_argument('--fsync-interval', type=float, default=30,
+                        help='Seconds between syncs with --fsync periodic')
+    args = parser.parse_args()
+
     # logging.basicConfig(level=logging.NOTSET)
     # logging.basicConfig(level=logging.INFO)
     # logging.basicConfig(level=logging.WARNING)
@@ -26,17 +82,15 @@ if __name__ == "__main__":
     # filename = "data/ubuntu-19.04-desktop-amd64.iso.torrent"
     # filename = "data/xubuntu-18.04.5-desktop-amd64.iso.torrent"
     # filename = "data/test.torrent"
-    filename = "data/ubuntu-20.10-desktop-amd64.iso.torrent"
-    # meta_info = open(filename, 'rb')
-    # torrent = Decoder(meta_info).decode()
-    torrent = Torrent(filename)
-    # tracker = Tracker(torrent)
-    client = TorrentClient(torrent)
-    
+
     # 获取EventLoop:
     loop = asyncio.get_event_loop()
     # 执行coroutine
-    task = loop.create_task(client.start())
+    task = loop.create_task(run(
+        args.torrents, args.seed, args.metrics_port, args.port,
+        args.mmap_threshold * 2**20 if args.mmap_threshold is not None
+        else None,
+        args.fsync, args.fsync_interval))
     loop.run_until_complete(task)
     loop.close()
 
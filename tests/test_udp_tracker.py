@@ -0,0 +1,158 @@
+"""
+Tests of `UDPTrackerClient` against a stand-in UDP tracker, on localhost.
+The timeouts are scaled down so the retransmissions happen within a
+fraction of a second.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import random
+import socket
+import struct
+import time
+import unittest
+
+from collections import Counter
+
+from utils.udp_tracker import ACTION_ANNOUNCE, ACTION_CONNECT, \
+    ACTION_ERROR, ACTION_SCRAPE, MAX_SCRAPE, UDPTrackerClient
+
+
+PEERS = [('127.0.0.1', 6881), ('127.0.0.1', 6882)]
+# The time (in seconds) to wait for the first response
+TIMEOUT = 0.05
+
+
+class StandInTracker(asyncio.DatagramProtocol):
+    """
+    A UDP tracker (BEP 15) announcing the given peers to everyone.
+
+    The first `drop` requests received are ignored. The moment every request
+    is received and the number of requests of each action are recorded.
+    """
+    def __init__(self, peers: list, drop: int = 0):
+        self.peers = b''.join(socket.inet_aton(ip) + struct.pack('>H', port)
+                              for ip, port in peers)
+        self.drop = drop
+        self.connection_ids = set()
+        self.transport = None
+        self.port = None
+        self.moments = []
+        self.actions = Counter()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=('127.0.0.1', 0))
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def close(self):
+        self.transport.close()
+
+    def datagram_received(self, data, address):
+        self.moments.append(time.monotonic())
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, transaction_id = struct.unpack_from('>QII',
+                                                                   data)
+        self.actions[action] += 1
+        if action == ACTION_CONNECT:
+            connection_id = random.getrandbits(64)
+            self.connection_ids.add(connection_id)
+            response = struct.pack('>IIQ', action, transaction_id,
+                                   connection_id)
+        elif connection_id not in self.connection_ids:
+            response = struct.pack('>II', ACTION_ERROR, transaction_id) + \
+                b'unknown connection id'
+        elif action == ACTION_ANNOUNCE:
+            response = struct.pack('>IIIII', action, transaction_id, 1800, 1,
+                                   len(self.peers) // 6) + self.peers
+        else:
+            # Every torrent scraped has the same statistics
+            hashes = (len(data) - 16) // 20
+            response = struct.pack('>II', action, transaction_id) + \
+                struct.pack('>III', len(self.peers) // 6, 0, 1) * hashes
+        self.transport.sendto(response, address)
+
+
+class UDPTrackerClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tracker = StandInTracker(PEERS)
+        await self.tracker.start()
+        self.address = ('127.0.0.1', self.tracker.port)
+        self.client = UDPTrackerClient(timeout=TIMEOUT, max_retransmits=2)
+
+    async def asyncTearDown(self):
+        self.client.close()
+        self.tracker.close()
+
+    async def announce(self, address=None):
+        return await self.client.announce(
+            address or self.address, os.urandom(20), os.urandom(20),
+            downloaded=0, left=100, uploaded=0, event='started', key=1,
+            port=6889)
+
+    async def test_announce(self):
+        response = await self.announce()
+        self.assertEqual(response.interval, 1800)
+        self.assertEqual(response.peers, PEERS)
+
+    async def test_retransmits(self):
+        # The connect request is sent three times, 15 * 2 ^ n (scaled down)
+        # apart
+        self.tracker.drop = 2
+        response = await self.announce()
+        self.assertEqual(response.peers, PEERS)
+        self.assertEqual(self.tracker.actions[ACTION_CONNECT], 1)
+        first, second, third = self.tracker.moments[:3]
+        self.assertGreaterEqual(second - first, TIMEOUT * 0.9)
+        self.assertLess(second - first, TIMEOUT * 2)
+        self.assertGreaterEqual(third - second, 2 * TIMEOUT * 0.9)
+        self.assertLess(third - second, 2 * TIMEOUT * 2)
+
+    async def test_connection_id_reused(self):
+        await self.announce()
+        await self.announce()
+        self.assertEqual(self.tracker.actions[ACTION_CONNECT], 1)
+        self.assertEqual(self.tracker.actions[ACTION_ANNOUNCE], 2)
+
+    async def test_scrape_batches(self):
+        info_hashes = [os.urandom(20) for _ in range(200)]
+        stats = await self.client.scrape(self.address, info_hashes)
+        # 74 + 74 + 52 info hashes
+        self.assertEqual(MAX_SCRAPE, 74)
+        self.assertEqual(self.tracker.actions[ACTION_SCRAPE], 3)
+        self.assertEqual(set(stats), set(info_hashes))
+        self.assertEqual(stats[info_hashes[-1]], (len(PEERS), 0, 1))
+
+    async def test_stale_connection_id(self):
+        await self.announce()
+        # The tracker forgets the connection ID it gave out
+        self.tracker.connection_ids.clear()
+        with self.assertRaises(ConnectionError):
+            await self.announce()
+        # A new connection ID is obtained for the next announce
+        response = await self.announce()
+        self.assertEqual(response.peers, PEERS)
+        self.assertEqual(self.tracker.actions[ACTION_CONNECT], 2)
+
+    async def test_dead_tracker(self):
+        # Nothing is ever answered
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as dead:
+            dead.bind(('127.0.0.1', 0))
+            start = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                await self.announce(dead.getsockname())
+        elapsed = time.monotonic() - start
+        # 1 + 2 + 4 timeouts
+        self.assertGreaterEqual(elapsed, 7 * TIMEOUT * 0.9)
+        self.assertLess(elapsed, 7 * TIMEOUT * 3)
+        self.assertEqual(self.client.protocol.waiting, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
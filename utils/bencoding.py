@@ -37,12 +37,24 @@ TOKEN_STRING_SEPARATOR = b':'
 class Decoder:
     """
     Decodes a bencoded sequence of bytes.
+
+    The data is decoded iteratively (nesting is kept on an explicit stack
+    rather than by recursion) scanning the data in place, so only the
+    decoded values are copied out of it.
+
+    The span of every decoded dict within the data is recorded, so the
+    original bytes of a dict can be retrieved with `raw` (e.g. to compute
+    the info hash of a torrent from the bytes it was given in, rather than
+    from a re-encoding that might differ).
     """
     def __init__(self, data: bytes):
-        if not isinstance(data, bytes):
+        if not isinstance(data, (bytes, bytearray)):
             raise TypeError('Argument "data" must be of type bytes')
         self._data = data
         self._index = 0
+        # The span (start, end) of each decoded dict, keyed by id. The dicts
+        # are referenced as well so the ids remain valid.
+        self._spans = {}
 
     def decode(self):
         """
@@ -50,89 +62,85 @@ class Decoder:
 
         :return A python object representing the bencoded data
         """
-        c = self._peek()
-        if c is None:
-            raise EOFError('Unexpected end-of-file')
-        elif c == TOKEN_INTEGER:
-            self._consume()  # The token
-            return self._decode_int()
-        elif c == TOKEN_LIST:
-            self._consume()  # The token
-            return self._decode_list()
-        elif c == TOKEN_DICT:
-            self._consume()  # The token
-            return self._decode_dict()
-        elif c == TOKEN_END:
-            return None
-        elif c in b'01234567899':
-            return self._decode_string()
-        else:
-            raise RuntimeError('Invalid token read at {0}'.format(
-                str(self._index)))
-
-    def _peek(self):
-        """
-        Return the next character from the bencoded data or None
-        """
-        if self._index + 1 >= len(self._data):
-            return None
-        return self._data[self._index:self._index + 1]
-
-    def _consume(self) -> bytes:
-        """
-        Read (and therefore consume) the next character from the data
-        """
-        self._index += 1
+        data = self._data
+        find = data.find
+        # Slices of bytes are bytes already
+        copy = type(data) is not bytes
+        length = len(data)
+        index = self._index
+        # The containers being decoded, innermost last, as [container, start
+        # index, dict key waiting for its value]
+        stack = []
+        while True:
+            if index >= length:
+                raise EOFError('Unexpected end-of-file')
+            token = data[index]
+            if 0x30 <= token <= 0x39:  # '0'..'9', a string
+                separator = find(TOKEN_STRING_SEPARATOR, index)
+                if separator < 0:
+                    raise RuntimeError('Unable to find token {0}'.format(
+                        str(TOKEN_STRING_SEPARATOR)))
+                start = separator + 1
+                index = start + int(data[index:separator])
+                if index > length:
+                    raise EOFError('Unexpected end-of-file')
+                value = data[start:index]
+                if copy:
+                    value = bytes(value)
+            elif token == 0x69:  # 'i', an integer
+                end = find(TOKEN_END, index)
+                if end < 0:
+                    raise RuntimeError('Unable to find token {0}'.format(
+                        str(TOKEN_END)))
+                value = int(data[index + 1:end])
+                index = end + 1
+            elif token == 0x6c:  # 'l', a list
+                stack.append([[], index, None])
+                index += 1
+                continue
+            elif token == 0x64:  # 'd', a dict
+                stack.append([{}, index, None])
+                index += 1
+                continue
+            elif token == 0x65 and stack:  # 'e', end of a list or dict
+                value, start, key = stack.pop()
+                index += 1
+                if key is not None:
+                    raise RuntimeError('Missing value for key {0}'.format(
+                        key))
+                if type(value) is dict:
+                    self._spans[id(value)] = (value, start, index)
+            elif token == 0x65:
+                return None
+            else:
+                raise RuntimeError('Invalid token read at {0}'.format(
+                    str(index)))
+
+            if not stack:
+                self._index = index
+                return value
+            entry = stack[-1]
+            container = entry[0]
+            if type(container) is list:
+                container.append(value)
+            elif entry[2] is None:
+                if type(value) is not bytes:
+                    raise RuntimeError('Invalid dict key at {0}'.format(
+                        str(index)))
+                entry[2] = value
+            else:
+                container[entry[2]] = value
+                entry[2] = None
 
-    def _read(self, length: int) -> bytes:
+    def raw(self, value: dict) -> memoryview:
         """
-        Read the `length` number of bytes from data and return the result
+        Get the original bytes of a dict decoded by this decoder, as a view
+        of the data (i.e. without copying).
         """
-        if self._index + length > len(self._data):
-            raise IndexError('Cannot read {0} bytes from current position {1}'
-                             .format(str(length), str(self._index)))
-        res = self._data[self._index:self._index+length]
-        self._index += length
-        return res
-
-    def _read_until(self, token: bytes) -> bytes:
-        """
-        Read from the bencoded data until the given token is found and return
-        the characters read.
-        """
-        try:
-            occurrence = self._data.index(token, self._index)
-            result = self._data[self._index:occurrence]
-            self._index = occurrence + 1
-            return result
-        except ValueError:
-            raise RuntimeError('Unable to find token {0}'.format(
-                str(token)))
-
-    def _decode_int(self):
-        return int(self._read_until(TOKEN_END))
-
-    def _decode_list(self):
-        res = []
-        # Recursive decode the content of the list
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            res.append(self.decode())
-        self._consume()  # The END token
-        return res
-
-    def _decode_dict(self):
-        res = OrderedDict()
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            key = self.decode()
-            obj = self.decode()
-            res[key] = obj
-        self._consume()  # The END token
-        return res
-
-    def _decode_string(self):
-        bytes_to_read = int(self._read_until(TOKEN_STRING_SEPARATOR))
-        data = self._read(bytes_to_read)
-        return data
+        span = self._spans.get(id(value))
+        if span is None or span[0] is not value:
+            raise ValueError('Not a dict decoded by this decoder')
+        return memoryview(self._data)[span[1]:span[2]]
 
 
 class Encoder:
@@ -146,7 +154,9 @@ class Encoder:
         - dict
         - bytes
 
-    Any other type will simply be ignored.
+    The keys of dicts are written in sorted order (of their raw bytes) as
+    required by the specification, whatever the order of the dict. Every
+    value is written into a single buffer.
     """
     def __init__(self, data):
         self._data = data
@@ -159,49 +169,38 @@ class Encoder:
         """
         return self.encode_next(self._data)
 
-    def encode_next(self, data):
-        if type(data) == str:
-            return self._encode_string(data)
-        elif type(data) == int:
-            return self._encode_int(data)
-        elif type(data) == list:
-            return self._encode_list(data)
-        elif type(data) == dict or type(data) == OrderedDict:
-            return self._encode_dict(data)
-        elif type(data) == bytes:
-            return self._encode_bytes(data)
+    def encode_next(self, data) -> bytes:
+        buffer = bytearray()
+        self._encode(data, buffer)
+        return bytes(buffer)
+
+    def _encode(self, data, buffer: bytearray):
+        kind = type(data)
+        if kind is bytes or kind is bytearray:
+            buffer += b'%d:' % len(data)
+            buffer += data
+        elif kind is str:
+            value = data.encode('utf-8')
+            buffer += b'%d:' % len(value)
+            buffer += value
+        elif kind is int:
+            buffer += b'i%de' % data
+        elif kind is list or kind is tuple:
+            buffer += TOKEN_LIST
+            for item in data:
+                self._encode(item, buffer)
+            buffer += TOKEN_END
+        elif kind is dict or kind is OrderedDict:
+            buffer += TOKEN_DICT
+            items = [(k.encode('utf-8') if type(k) is str else k, v)
+                     for k, v in data.items()]
+            items.sort(key=lambda item: item[0])
+            for key, value in items:
+                if type(key) is not bytes:
+                    raise TypeError('Bad dict key: {0!r}'.format(key))
+                buffer += b'%d:' % len(key)
+                buffer += key
+                self._encode(value, buffer)
+            buffer += TOKEN_END
         else:
-            return None
-
-    def _encode_int(self, value):
-        return str.encode('i' + str(value) + 'e')
-
-    def _encode_string(self, value: str):
-        res = str(len(value)) + ':' + value
-        return str.encode(res)
-
-    def _encode_bytes(self, value: str):
-        result = bytearray()
-        result += str.encode(str(len(value)))
-        result += b':'
-        result += value
-        return result
-
-    def _encode_list(self, data):
-        result = bytearray('l', 'utf-8')
-        result += b''.join([self.encode_next(item) for item in data])
-        result += b'e'
-        return result
-
-    def _encode_dict(self, data: dict) -> bytes:
-        result = bytearray('d', 'utf-8')
-        for k, v in data.items():
-            key = self.encode_next(k)
-            value = self.encode_next(v)
-            if key and value:
-                result += key
-                result += value
-            else:
-                raise RuntimeError('Bad dict')
-        result += b'e'
-        return result
+            raise TypeError('Cannot bencode {0}'.format(kind.__name__))
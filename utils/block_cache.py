@@ -0,0 +1,122 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+
+
+class BlockCache:
+    """
+    The block cache serves the blocks requested by remote peers.
+
+    Peers request the blocks of a piece one after the other, so rather than
+    reading every block from disk on its own, the whole piece is read once
+    and kept in a cache bounded in bytes, the least recently used piece is
+    evicted first. Blocks are handed out as `memoryview` slices of the cached
+    piece, i.e. they are not copied.
+
+    Peers also tend to request pieces in order, so once a piece is read the
+    next pieces we have are read ahead in the background.
+
+    Only pieces we have (i.e. verified) are cached, their data never changes.
+    """
+    def __init__(self, piece_manager, max_bytes: int = 32 * 2**20,
+                 read_ahead: int = 1):
+        """
+        :param piece_manager: The manager of the pieces to read
+        :param max_bytes: The number of bytes of pieces to keep cached
+        :param read_ahead: The number of following pieces to read ahead
+        """
+        self.piece_manager = piece_manager
+        self.max_bytes = max_bytes
+        self.read_ahead = read_ahead
+        # The cached pieces, piece index -> data, in least recently used order
+        self.pieces = OrderedDict()
+        self.size = 0
+        # The pieces being read, piece index -> future
+        self._loading = {}
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, index: int, begin: int, length: int) -> memoryview:
+        """
+        Get the given block of a piece we have.
+        """
+        data = self.pieces.get(index)
+        if data is not None:
+            self.hits += 1
+            self.pieces.move_to_end(index)
+        else:
+            self.misses += 1
+            data = await self._load(index)
+        for following in range(index + 1, index + 1 + self.read_ahead):
+            self._read_ahead(following)
+        return memoryview(data)[begin:begin + length]
+
+    def _read_ahead(self, index: int):
+        manager = self.piece_manager
+        if index >= manager.total_pieces_len or \
+                not manager.have_pieces[index] or \
+                index in self.pieces or index in self._loading:
+            return
+        future = asyncio.ensure_future(self._load(index))
+        future.add_done_callback(self._read_ahead_done)
+
+    def _read_ahead_done(self, future):
+        if not future.cancelled() and future.exception():
+            logging.warning('Unable to read ahead: {error}'.format(
+                error=future.exception()))
+
+    async def _load(self, index: int):
+        """
+        Read the given piece into the cache, sharing the read if the piece
+        is already being read.
+        """
+        future = self._loading.get(index)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[index] = future
+        try:
+            manager = self.piece_manager
+            data = await manager.storage.read(
+                index * manager.torrent.piece_length,
+                manager._piece_length(index))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieve it, the error might have no other waiter
+            future.exception()
+            raise
+        finally:
+            del self._loading[index]
+        future.set_result(data)
+        self._insert(index, data)
+        return data
+
+    def _insert(self, index: int, data):
+        if len(data) > self.max_bytes:
+            return
+        self.pieces[index] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, index: int):
+        """
+        Drop the given piece from the cache, if cached.
+        """
+        data = self.pieces.pop(index, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def clear(self):
+        """
+        Drop every cached piece (e.g. before the storage is closed, releasing
+        the views of memory mapped files).
+        """
+        self.pieces.clear()
+        self.size = 0
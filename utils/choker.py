@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import random
+
+
+class Choker:
+    """
+    The choker decides which remote peers are allowed to download from us
+    (i.e. are unchoked), following the tit-for-tat strategy of the reference
+    client.
+
+    Every `interval` seconds the interested peers are ranked by the rate they
+    upload to us, or by the rate we upload to them once we are seeding (we
+    then favour the peers downloading the fastest). The best `slots - 1`
+    peers are unchoked, every other peer is choked.
+
+    The remaining slot is the optimistic unchoke: a random interested peer
+    outside of the best ones, rotated every `optimistic_interval` seconds.
+    It gives new peers a chance to show how fast they upload, and us a chance
+    to find better peers than the current ones.
+
+    The connections register themselves with `add` once the handshake is
+    done and `discard` when dropped.
+    """
+    def __init__(self, piece_manager, slots: int = 4, interval: float = 10,
+                 optimistic_interval: float = 30):
+        """
+        :param piece_manager: The manager of the pieces of the torrent
+        :param slots: The number of peers unchoked at once, including the
+                      optimistic unchoke
+        :param interval: Seconds between two rounds
+        :param optimistic_interval: Seconds between two rotations of the
+                                    optimistic unchoke
+        """
+        self.piece_manager = piece_manager
+        self.slots = slots
+        self.interval = interval
+        self.optimistic_rounds = max(1, round(optimistic_interval / interval))
+        self.connections = set()
+        self.optimistic = None
+        self.rounds = 0
+        self.future = None
+
+    def add(self, connection):
+        self.connections.add(connection)
+
+    def discard(self, connection):
+        self.connections.discard(connection)
+        if self.optimistic is connection:
+            self.optimistic = None
+
+    def peer_interested(self, connection):
+        """
+        Called when a remote peer gets interested. The peer is unchoked right
+        away if there is a free slot, rather than waiting for the next round.
+        """
+        unchoked = sum(1 for c in self.connections
+                       if 'choked' not in c.peer_state)
+        if unchoked < self.slots:
+            connection.unchoke()
+
+    def start(self):
+        self.future = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self.future and not self.future.done():
+            self.future.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                self.rechoke()
+            except Exception:
+                logging.exception('Choking round failed')
+            await asyncio.sleep(self.interval)
+
+    def rechoke(self):
+        """
+        Run one choking round.
+        """
+        interested = [c for c in self.connections
+                      if 'interested' in c.peer_state]
+        if self.piece_manager.complete:
+            ranked = sorted(interested, key=lambda c: c.upload_rate.rate(),
+                            reverse=True)
+        else:
+            ranked = sorted(interested, key=lambda c: c.download_rate.rate(),
+                            reverse=True)
+        unchoked = set(ranked[:self.slots - 1])
+
+        others = ranked[self.slots - 1:]
+        if self.rounds % self.optimistic_rounds == 0 or \
+                self.optimistic not in others:
+            self.optimistic = random.choice(others) if others else None
+        if self.optimistic:
+            unchoked.add(self.optimistic)
+        self.rounds += 1
+
+        for connection in self.connections:
+            if connection in unchoked:
+                connection.unchoke()
+            else:
+                connection.choke()
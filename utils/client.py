@@ -1,10 +1,14 @@
 import asyncio
-import time
 import logging
 
+from .choker import Choker
+from .dialer import Dialer
+from .metrics import Metrics, MetricsServer
 from .peer_connection import PeerConnection
+from .peer_database import PeerDatabase
 from .piece_manager import PieceManager
-from .tracker import Tracker
+from .storage import Storage
+from .tracker_tiers import TrackerTiers
 
 
 class TorrentClient:
@@ -12,31 +16,77 @@ class TorrentClient:
     The torrent client is the local peer that holds peer-to-peer
     connections to download and upload pieces for a given torrent.
 
-    Once started, the client makes periodic announce calls to the tracker
-    registered in the torrent meta-data. These calls results in a list of
-    peers that should be tried in order to exchange pieces.
+    Once started, the client makes periodic announce calls to the trackers
+    registered in the torrent meta-data (every tier of them, see
+    `TrackerTiers`), at the intervals they ask for. These calls results in a
+    list of peers that should be tried in order to exchange pieces.
 
-    Each received peer is kept in a queue that a pool of PeerConnection
-    objects consume. There is a fix number of PeerConnections that can have
-    a connection open to a peer. Since we are not creating expensive threads
-    (or worse yet processes) we can create them all at once and they will
-    be waiting until there is a peer to consume in the queue.
+    Each received peer is kept in a `PeerDatabase` that a pool of
+    PeerConnection objects consume, best scored peers first. There is a fix
+    number of PeerConnections that can have a connection open to a peer.
+
+    Since we are not creating expensive threads (or worse yet processes) we
+    can create them all at once and they will be waiting until there is a
+    peer to consume in the queue.
+
+    If `seed` is set the client keeps serving the pieces to other peers once
+    the torrent is fully downloaded, until stopped.
+
+    The files of the torrent up to `mmap_threshold` bytes are memory mapped
+    (none by default), and synced to disk following the `fsync` policy (see
+    `Storage`).
+
+    The live statistics of the client are available through `metrics`, and
+    served in the Prometheus format on `metrics_port` (of the loopback
+    interface) if given.
+
+    Connections opened to us by remote peers are handed over by a
+    `PeerListener` through `accept`, each is served by a PeerConnection of
+    its own. They count towards the same limits as the connections we open.
+
+    When run as part of a `Session`, the HTTP session and the UDP socket of
+    the trackers, the hashing threads, the storage threads, the connection
+    budget and the dialer are shared with the other torrents of the session.
     """
-    def __init__(self, torrent, MAX_PEER_CONNECTIONS=40):
-        self.tracker = Tracker(torrent)
+    def __init__(self, torrent, MAX_PEER_CONNECTIONS=40, seed=False,
+                 metrics_port=None, http_client=None, verifier=None,
+                 storage_executor=None, connection_budget=None,
+                 listen_port=6889, dialer=None, udp_client=None,
+                 mmap_threshold=None, fsync=Storage.FSYNC_CLOSE,
+                 fsync_interval=30):
+        self.tracker = TrackerTiers(torrent, http_client, listen_port,
+                                    udp_client)
         # The number of max peer connections per TorrentClient
         self.MAX_PEER_CONNECTIONS = MAX_PEER_CONNECTIONS
-        # The list of potential peers is the work queue, consumed by the
+        # The potential peers are the work queue, consumed by the
         # PeerConnections
-        self.available_peers = asyncio.Queue()
+        self.peer_database = PeerDatabase()
         # The list of peers is the list of workers that *might* be connected
         # to a peer. Else they are waiting to consume new remote peers from
-        # the `available_peers` queue. These are our workers!
+        # the `peer_database`. These are our workers!
         self.peer_connections = []
+        # The connections opened to us by remote peers
+        self.incoming_connections = set()
         # The piece manager implements the strategy on which pieces to
         # request, as well as the logic to persist received pieces to disk.
-        self.piece_manager = PieceManager(torrent)
+        self.piece_manager = PieceManager(torrent, verifier,
+                                          storage_executor=storage_executor,
+                                          mmap_threshold=mmap_threshold,
+                                          fsync=fsync,
+                                          fsync_interval=fsync_interval)
+        # Decides which peers may download from us
+        self.choker = Choker(self.piece_manager)
+        # The semaphore limiting the open connections, if any
+        self.connection_budget = connection_budget
+        # Opens our connections, holding back the peers that failed
+        self.dialer = dialer if dialer else Dialer()
+        self.seed = seed
+        self.metrics = Metrics(self)
+        self.metrics_server = MetricsServer([self.metrics], port=metrics_port) \
+            if metrics_port else None
         self.abort = False
+        # The task stopping the client, once stopped
+        self._stopping = None
 
     async def start(self):
         """
@@ -44,61 +94,117 @@ class TorrentClient:
 
         This results in connecting to the tracker to retrieve the list of
         peers to communicate with. Once the torrent is fully downloaded or
-        if the download is aborted this method will complete.
+        if the download is aborted this method will complete. The client is
+        stopped however it completes, even if it fails or is cancelled.
         """
-        self.peer_connections = [PeerConnection(self.available_peers,
+        try:
+            await self._run()
+        finally:
+            await self.stop()
+
+    async def _run(self):
+        if self.piece_manager.needs_recheck:
+            # Data on disk without a trusted resume file, find out which
+            # pieces we already have before connecting to any peer
+            await self.piece_manager.recheck()
+
+        self.peer_connections = [PeerConnection(self.peer_database,
                                                 self.tracker.torrent.info_hash,
                                                 self.tracker.peer_id,
                                                 self.piece_manager,
-                                                self._on_block_retrieved)
+                                                self._on_block_retrieved,
+                                                self.choker,
+                                                self.connection_budget,
+                                                dialer=self.dialer)
                                 for _ in range(self.MAX_PEER_CONNECTIONS)]
-        
-        # The time we last made an announce call (timestamp)
-        previous_moment = None
-        # Default interval between announce calls made to the tracker (in seconds)
-        interval_time = 30*60
+        self.choker.start()
+        if self.metrics_server:
+            await self.metrics_server.start()
+
+        # Whether or not the download completed (and the trackers were told)
+        completed = self.piece_manager.complete
 
         while True:
             # print("====================>>>>>>>>>>>>>>>>client<<<<<<<<<<<<<<<<<<<<==================")
-            if self.piece_manager.complete:
+            if self.piece_manager.complete and not completed:
+                completed = True
+                self._announce('completed')
+            if self.piece_manager.complete and not self.seed:
                 logging.info('Torrent fully downloaded!')
                 break
             if self.abort:
                 logging.info('Aborting download...')
                 break
 
-            current_moment = time.time()
-
-            if (previous_moment is None) or (current_moment > previous_moment + interval_time):
-                
-                try:
-                    response = await self.tracker.connect(
-                        first=False if previous_moment else True,
-                        uploaded=self.piece_manager.bytes_uploaded,
-                        downloaded=self.piece_manager.bytes_downloaded)
-
-                    if response:
-                        # print(response)
-                        previous_moment = current_moment
-                        # interval_time = response.interval
-                        self._update_queue(response.peers)
-                        print("available_peers: {}".format(len(response.peers)))
-                except BaseException:
-                    logging.exception('Connect to tracker failed')
-            else:
-                if self.available_peers.empty():
-                    print("TorrentClient.available_peers is enmpty !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-                    self._update_queue(response.peers)
-                await asyncio.sleep(5)
-
-        # print("====================>>>>>>>>>>>>>>>>!!!!!!!!!!!!!!!!!!!!!!!start STOP!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!1<<<<<<<<<<<<<<<<<<<<==================")
-        self.stop()
-    
-    def _update_queue(self, new_peers):
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
-        for peer in new_peers:
-            self.available_peers.put_nowait(peer)
+            # Only the trackers that are due are announced to
+            self._announce()
+            await self.piece_manager.checkpoint()
+            await asyncio.sleep(5)
+
+    def _announce(self, event: str = None) -> list:
+        """
+        Start announcing our statistics to the trackers, the peers they
+        return are added to the peer database.
+
+        :param event: The event to report to every tracker, if any
+        :return: The tasks of the announces started
+        """
+        # More peers are wanted once there is none left to dial
+        want_peers = not self.piece_manager.complete and \
+            self.peer_database.candidate(self.dialer.retry_at) is None
+        return self.tracker.announce(
+            self._on_announce,
+            uploaded=self.piece_manager.bytes_uploaded,
+            downloaded=self.piece_manager.download_rate.total,
+            left=self.piece_manager.bytes_left,
+            event=event, want_peers=want_peers)
+
+    def _on_announce(self, url: str, response):
+        """
+        Called with the response of a tracker to an announce.
+        """
+        try:
+            self.peer_database.add(response.peers, url)
+        except Exception:
+            logging.exception('Connect to tracker failed')
+            return
+        logging.debug('{count} peers known, {announced} announced by {url}'
+                      .format(count=len(self.peer_database),
+                              announced=len(response.peers), url=url))
+
+    @property
+    def connections(self) -> list:
+        """
+        The connections we open and the connections opened to us.
+        """
+        return self.peer_connections + list(self.incoming_connections)
+
+    def accept(self, reader, writer, handshake) -> bool:
+        """
+        Serve a connection a remote peer opened to us, unless we are at our
+        connection limits.
+
+        :param handshake: The handshake already received from the peer
+        :return: Whether or not the connection was accepted
+        """
+        # Refuse the connections we opened to ourselves
+        if self.abort or \
+                handshake.peer_id == self.tracker.peer_id.encode('utf-8'):
+            return False
+        connected = sum(1 for c in self.connections if c.connected)
+        if connected >= self.MAX_PEER_CONNECTIONS:
+            return False
+        if self.connection_budget and self.connection_budget.locked():
+            return False
+        connection = PeerConnection(None, self.tracker.torrent.info_hash,
+                                    self.tracker.peer_id, self.piece_manager,
+                                    self._on_block_retrieved, self.choker,
+                                    self.connection_budget,
+                                    incoming=(reader, writer, handshake))
+        self.incoming_connections.add(connection)
+        connection.future.add_done_callback(
+            lambda _: self.incoming_connections.discard(connection))
+        return True
 
     def _on_block_retrieved(self, remote_id, piece_index, block_offset, data):
         """
@@ -114,12 +220,31 @@ class TorrentClient:
             remote_id=remote_id, piece_index=piece_index,
             block_offset=block_offset, data=data)
 
-    def stop(self):
+    async def stop(self):
         """
-        Stop the download or seeding process.
+        Stop the download or seeding process, and tell the trackers. Calling
+        it again waits for the client to be stopped.
         """
+        if self._stopping is None:
+            self._stopping = asyncio.ensure_future(self._stop())
+        # Cancelling the caller does not leave the client half stopped
+        await asyncio.shield(self._stopping)
+
+    async def _stop(self):
         self.abort = True
-        for peer_connection in self.peer_connections:
+        # Let the trackers know we are gone while the rest is stopped
+        stopping = self._announce('stopped')
+        self.choker.stop()
+        if self.metrics_server:
+            self.metrics_server.close()
+        connections = self.connections
+        for peer_connection in connections:
             peer_connection.stop()
-        self.piece_manager.close()
-        self.tracker.close()
+        # The connections use the piece manager until they are done
+        await asyncio.gather(*[c.future for c in connections],
+                             return_exceptions=True)
+        await self.piece_manager.close()
+        # Without waiting long for the trackers
+        if stopping:
+            await asyncio.wait(stopping, timeout=5)
+        await self.tracker.close()
@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+from collections import namedtuple
+
+
+# The dial history of a peer address
+DialRecord = namedtuple('DialRecord', ['failures', 'retry_at'])
+
+
+class Dialer:
+    """
+    Opens the connections to remote peers.
+
+    The number of connects in progress (half-open connections) is capped,
+    and a connect that does not complete within `connect_timeout` seconds
+    is given up, so dead peers do not hold the connection workers for the
+    operating system timeout (often minutes).
+
+    An address that failed to connect or to complete the handshake is not
+    dialed again before a backoff delay, doubling with every consecutive
+    failure. After `max_failures` consecutive failures the address is not
+    dialed anymore. A successful handshake clears the record.
+    """
+    def __init__(self, max_half_open: int = 8, connect_timeout: float = 10,
+                 handshake_timeout: float = 10, backoff: float = 15,
+                 max_backoff: float = 30 * 60, max_failures: int = 8):
+        """
+        :param max_half_open: The number of connects in progress at once
+        :param connect_timeout: The time (in seconds) a connect may take
+        :param handshake_timeout: The time (in seconds) the remote peer has
+                                  to answer our handshake
+        :param backoff: The delay (in seconds) before dialing an address
+                        again after its first failure
+        :param max_backoff: The longest delay (in seconds) before dialing an
+                            address again
+        :param max_failures: The number of consecutive failures after which
+                             an address is not dialed anymore
+        """
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self._half_open = asyncio.Semaphore(max_half_open)
+        # The addresses that failed, keyed by (ip, port)
+        self.records = {}
+        self.dials = 0
+        self.failures = 0
+
+    def ready(self, address: tuple, now: float = None) -> bool:
+        """
+        Whether or not the given address may be dialed now.
+        """
+        moment = self.retry_at(address)
+        return moment is not None and (now or time.monotonic()) >= moment
+
+    def retry_at(self, address: tuple) -> float:
+        """
+        Get the moment (`time.monotonic`) the given address may be dialed
+        again, None if it is not to be dialed anymore.
+        """
+        record = self.records.get(address)
+        if record is None:
+            return 0
+        if record.failures >= self.max_failures:
+            return None
+        return record.retry_at
+
+    async def connect(self, address: tuple):
+        """
+        Open a connection to the given address, waiting for a half-open slot
+        first.
+
+        :return: The (reader, writer) of the connection
+        :raises TimeoutError: If the connect took too long
+        """
+        async with self._half_open:
+            self.dials += 1
+            return await asyncio.wait_for(asyncio.open_connection(*address),
+                                          self.connect_timeout)
+
+    def failed(self, address: tuple):
+        """
+        Record a failure to connect or to complete the handshake with the
+        given address.
+        """
+        self.failures += 1
+        record = self.records.get(address)
+        failures = record.failures + 1 if record else 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        self.records[address] = DialRecord(failures,
+                                           time.monotonic() + delay)
+
+    def succeeded(self, address: tuple):
+        """
+        Record a completed handshake with the given address.
+        """
+        self.records.pop(address, None)
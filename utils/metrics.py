@@ -0,0 +1,239 @@
+import asyncio
+import logging
+
+
+class Metrics:
+    """
+    Collects the live statistics of a torrent client: rolling transfer
+    rates of the torrent and of each connected peer, peer states, pending
+    requests, hash failures and the state of the storage and the verifier.
+
+    Nothing is recorded here, the statistics are read from the objects
+    doing the work whenever a snapshot is taken, so taking none costs
+    nothing.
+    """
+    def __init__(self, client):
+        """
+        :param client: The `TorrentClient` to report on
+        """
+        self.client = client
+
+    def snapshot(self) -> dict:
+        """
+        Get the current statistics of the client, as a dict of plain values.
+        """
+        manager = self.client.piece_manager
+        torrent = manager.torrent
+        peers = [self._peer(c) for c in self.client.connections
+                 if c.connected]
+        storage = manager.storage
+        return {
+            'name': torrent.output_file,
+            'info_hash': torrent.info_hash.hex(),
+            'pieces_total': manager.total_pieces_len,
+            'pieces_have': manager.have_count,
+            'pieces_ongoing': len(manager.ongoing_pieces),
+            'pieces_verifying': len(manager.verifying_pieces),
+            'download_rate': manager.download_rate.rate(),
+            'upload_rate': manager.upload_rate.rate(),
+            'bytes_received': manager.download_rate.total,
+            'bytes_uploaded': manager.bytes_uploaded,
+            'bytes_redundant': manager.redundant_bytes,
+            'hash_failures': manager.hash_failures,
+            'pending_requests': len(manager.pending_blocks),
+            'duplicate_request_bytes': manager.pending_blocks.duplicate_bytes,
+            'endgame': manager.endgame,
+            'peers_known': len(self.client.peer_database),
+            'peers_connected': len(peers),
+            # Peers choking us / we are interested in
+            'peers_choking': sum(1 for p in peers if p['choking']),
+            'peers_interesting': sum(1 for p in peers if p['interesting']),
+            # Peers we choke / interested in us
+            'peers_choked': sum(1 for p in peers if p['choked']),
+            'peers_interested': sum(1 for p in peers if p['interested']),
+            'verifier_queue': manager.verifier.queued,
+            'storage_queue_depth': storage.queue_depth if storage else 0,
+            'storage_queued_bytes': storage.queued_bytes if storage else 0,
+            'storage_writes': storage.writes if storage else 0,
+            'storage_write_errors': storage.write_errors if storage else 0,
+            'storage_write_latency': storage.write_latency if storage else 0,
+            'cache_hits': manager.block_cache.hits,
+            'cache_misses': manager.block_cache.misses,
+            'peers': peers,
+        }
+
+    def _peer(self, connection) -> dict:
+        return {
+            'peer': '{ip}:{port}'.format(ip=connection.ip,
+                                         port=connection.port),
+            'download_rate': connection.download_rate.rate(),
+            'upload_rate': connection.upload_rate.rate(),
+            'choking': 'choked' in connection.my_state,
+            'interesting': 'interested' in connection.my_state,
+            'choked': 'choked' in connection.peer_state,
+            'interested': 'interested' in connection.peer_state,
+            'requests': len(connection.pipeline),
+            'pipeline_depth': connection.pipeline.depth,
+            'queued_uploads': len(connection.uploads),
+        }
+
+
+# The Prometheus metrics exposed for each torrent: name, type, help and the
+# key of the value in the snapshot
+TORRENT_METRICS = [
+    ('pieces_total', 'gauge', 'Number of pieces of the torrent',
+     'pieces_total'),
+    ('pieces_have', 'gauge', 'Number of verified pieces', 'pieces_have'),
+    ('pieces_ongoing', 'gauge', 'Number of pieces being downloaded',
+     'pieces_ongoing'),
+    ('pieces_verifying', 'gauge', 'Number of pieces being hashed',
+     'pieces_verifying'),
+    ('download_rate_bytes', 'gauge', 'Rolling download rate in bytes/s',
+     'download_rate'),
+    ('upload_rate_bytes', 'gauge', 'Rolling upload rate in bytes/s',
+     'upload_rate'),
+    ('received_bytes_total', 'counter', 'Bytes of blocks received',
+     'bytes_received'),
+    ('uploaded_bytes_total', 'counter', 'Bytes of blocks uploaded',
+     'bytes_uploaded'),
+    ('redundant_bytes_total', 'counter', 'Bytes of blocks received twice',
+     'bytes_redundant'),
+    ('hash_failures_total', 'counter', 'Pieces failing the hash check',
+     'hash_failures'),
+    ('pending_requests', 'gauge', 'Blocks requested and not yet received',
+     'pending_requests'),
+    ('duplicate_request_bytes', 'gauge',
+     'Bytes requested from more than one peer', 'duplicate_request_bytes'),
+    ('endgame', 'gauge', 'Whether the torrent is in endgame mode', 'endgame'),
+    ('peers_known', 'gauge', 'Number of peer addresses known',
+     'peers_known'),
+    ('peers_connected', 'gauge', 'Number of connected peers',
+     'peers_connected'),
+    ('peers_choking', 'gauge', 'Number of peers choking us',
+     'peers_choking'),
+    ('peers_interesting', 'gauge', 'Number of peers we are interested in',
+     'peers_interesting'),
+    ('peers_choked', 'gauge', 'Number of peers we choke', 'peers_choked'),
+    ('peers_interested', 'gauge', 'Number of peers interested in us',
+     'peers_interested'),
+    ('verifier_queue', 'gauge', 'Pieces queued for hashing',
+     'verifier_queue'),
+    ('storage_queue_depth', 'gauge', 'Writes waiting for a storage worker',
+     'storage_queue_depth'),
+    ('storage_queued_bytes', 'gauge', 'Bytes queued or being written',
+     'storage_queued_bytes'),
+    ('storage_writes_total', 'counter', 'Writes completed by the storage',
+     'storage_writes'),
+    ('storage_write_errors_total', 'counter', 'Writes failed by the storage',
+     'storage_write_errors'),
+    ('storage_write_latency_seconds', 'gauge', 'Smoothed write latency',
+     'storage_write_latency'),
+    ('cache_hits_total', 'counter', 'Uploaded blocks found in the cache',
+     'cache_hits'),
+    ('cache_misses_total', 'counter', 'Uploaded blocks read from disk',
+     'cache_misses'),
+]
+
+PEER_METRICS = [
+    ('peer_download_rate_bytes', 'gauge',
+     'Rolling download rate from a peer in bytes/s', 'download_rate'),
+    ('peer_upload_rate_bytes', 'gauge',
+     'Rolling upload rate to a peer in bytes/s', 'upload_rate'),
+    ('peer_requests', 'gauge', 'Blocks requested from a peer', 'requests'),
+    ('peer_queued_uploads', 'gauge', 'Blocks requested by a peer',
+     'queued_uploads'),
+]
+
+
+class MetricsServer:
+    """
+    A minimal HTTP server exposing the metrics of one or more torrents in
+    the Prometheus text format at `/metrics`.
+
+    It is meant to be scraped locally, so it listens on the loopback
+    interface unless told otherwise.
+    """
+    PREFIX = 'bittorrent_'
+
+    def __init__(self, sources: list, host: str = '127.0.0.1',
+                 port: int = 9100):
+        """
+        :param sources: The `Metrics` of the torrents to expose
+        :param host: The address to listen on
+        :param port: The port to listen on
+        """
+        self.sources = sources
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host,
+                                                 self.port)
+        logging.info('Serving metrics on http://{host}:{port}/metrics'.format(
+            host=self.host, port=self.port))
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the headers, we have no use for them
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and \
+                    parts[1].split(b'?')[0] == b'/metrics':
+                status = '200 OK'
+                body = self.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not Found\n'
+            writer.write('HTTP/1.1 {status}\r\n'
+                         'Content-Type: text/plain; version=0.0.4\r\n'
+                         'Content-Length: {length}\r\n'
+                         'Connection: close\r\n\r\n'.format(
+                            status=status, length=len(body)).encode('ascii'))
+            writer.write(body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def render(self) -> str:
+        """
+        Render the current metrics of every torrent in the Prometheus text
+        format.
+        """
+        snapshots = [source.snapshot() for source in self.sources]
+        lines = []
+        for name, kind, text, key in TORRENT_METRICS:
+            lines.append('# HELP {prefix}{name} {text}'.format(
+                prefix=self.PREFIX, name=name, text=text))
+            lines.append('# TYPE {prefix}{name} {kind}'.format(
+                prefix=self.PREFIX, name=name, kind=kind))
+            for snapshot in snapshots:
+                lines.append('{prefix}{name}{{info_hash="{info_hash}"}} '
+                             '{value}'.format(prefix=self.PREFIX, name=name,
+                                              info_hash=snapshot['info_hash'],
+                                              value=float(snapshot[key])))
+        for name, kind, text, key in PEER_METRICS:
+            lines.append('# HELP {prefix}{name} {text}'.format(
+                prefix=self.PREFIX, name=name, text=text))
+            lines.append('# TYPE {prefix}{name} {kind}'.format(
+                prefix=self.PREFIX, name=name, kind=kind))
+            for snapshot in snapshots:
+                for peer in snapshot['peers']:
+                    lines.append('{prefix}{name}{{info_hash="{info_hash}",'
+                                 'peer="{peer}"}} {value}'.format(
+                                    prefix=self.PREFIX, name=name,
+                                    info_hash=snapshot['info_hash'],
+                                    peer=peer['peer'],
+                                    value=float(peer[key])))
+        return '\n'.join(lines) + '\n'
@@ -1,10 +1,20 @@
 import asyncio
 import logging
+import time
 
+from collections import deque
 from concurrent.futures import CancelledError
 
 from .peer_message import PeerMessage, Handshake, Interested, BitField, NotInterested, Choke, Unchoke, Have, KeepAlive, Piece, Request, Cancel
 from .peer_stream_iterator import PeerStreamIterator
+from .dialer import Dialer
+from .request_pipeline import RequestPipeline
+from .rate_meter import RateMeter
+
+
+# The number of blocks a remote peer may have requested from us, further
+# requests are ignored
+MAX_QUEUED_UPLOADS = 500
 
 
 class ProtocolError(BaseException):
@@ -15,7 +25,8 @@ class PeerConnection:
     """
     A peer connection used to download and upload pieces.
 
-    The peer connection will consume one available peer from the given queue.
+    The peer connection will consume one available peer from the given
+    `PeerDatabase`, the best scored peer not connected yet.
     Based on the peer details the PeerConnection will try to open a connection
     and perform a BitTorrent handshake.
 
@@ -25,31 +36,62 @@ class PeerConnection:
 
     Once the remote peer unchoked us, we can start requesting pieces.
     The PeerConnection will continue to request pieces for as long as there are
-    pieces left to request, or until the remote peer disconnects.
+    pieces left to request, or until the remote peer disconnects. Requests are
+    pipelined, i.e. several blocks are requested without waiting for the
+    previous one to arrive (see `RequestPipeline`).
+
+    Blocks requested by the remote peer are queued and sent by an upload task
+    of their own, so a slow upload does not hold back our requests. Queued
+    blocks are dropped if the remote peer cancels them, or if we choke it.
+    Which peers are unchoked is decided by the `Choker`, based on the rates
+    measured in both directions. Without a choker every interested peer is
+    unchoked.
+
+    If a connection budget (a semaphore shared by the connections of every
+    torrent) is given, a slot of it is held for as long as a connection to
+    a remote peer is open.
 
     If the connection with a remote peer drops, the PeerConnection will consume
-    the next available peer from off the queue and try to connect to that one
-    instead.
+    the next available peer from the database and try to connect to that one
+    instead. How the connection went is recorded in the database.
+
+    Connections are opened through a `Dialer`, which gives up on slow
+    connects and handshakes, and holds back the addresses that failed
+    recently.
+
+    A PeerConnection can also be given a connection a remote peer opened to
+    us (see `PeerListener`), it then serves that connection only.
     """
-    def __init__(self, available_peers: asyncio.Queue, info_hash,
-                 peer_id, piece_manager, on_block_cb=None):
+    def __init__(self, peer_database, info_hash,
+                 peer_id, piece_manager, on_block_cb=None, choker=None,
+                 connection_budget: asyncio.Semaphore = None, incoming=None,
+                 dialer: Dialer = None):
         """
         Constructs a PeerConnection and add it to the asyncio event-loop.
 
         Use `stop` to abort this connection and any subsequent connection
         attempts
 
-        :param available_peers: The async Queue containing available peers
+        :param peer_database: The `PeerDatabase` of the available peers
         :param info_hash: The SHA1 hash for the meta-data's info
         :param peer_id: Our peer ID used to to identify ourselves
         :param piece_manager: The manager responsible to determine which pieces
                               to request
         :param on_block_cb: The callback function to call when a block is
                             received from the remote peer
+        :param choker: The choker deciding whether the remote peer may
+                       download from us
+        :param connection_budget: The semaphore limiting the number of open
+                                  connections, if any
+        :param incoming: A connection opened by a remote peer, as a tuple of
+                         (reader, writer, received handshake), to serve
+                         instead of consuming the database
+        :param dialer: The dialer opening our connections, which might be
+                       shared with other connections
         """
         self.my_state = []
-        # self.peer_state = []
-        self.available_peers = available_peers
+        self.peer_state = []
+        self.peer_database = peer_database
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.remote_id = None
@@ -57,91 +99,64 @@ class PeerConnection:
         self.reader = None
         self.piece_manager = piece_manager
         self.on_block_cb = on_block_cb
+        self.choker = choker
+        self.connection_budget = connection_budget
+        self.incoming = incoming
+        self.dialer = dialer if dialer else Dialer()
+        self.pipeline = RequestPipeline()
+        # The rates from and to the remote peer
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        # The blocks requested by the remote peer not yet sent
+        self.uploads = deque()
+        self._upload_ready = asyncio.Event()
+        self.uploader = None
+        # The moment the handshake with the remote peer completed
+        self.connected_at = None
         self.future = asyncio.ensure_future(self._start())  # Start this worker
 
     async def _start(self):
         while 'stopped' not in self.my_state:
             # print("<<<<<<<<<<<<<<<<<<<<<<<========================PEER CONNECTION=========================>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-            ip, port = await self.available_peers.get()
+            if self.incoming:
+                reader, writer, handshake = self.incoming
+                ip, port = writer.get_extra_info('peername')[:2]
+            else:
+                # Skipping the peers that failed recently
+                ip, port = await self.peer_database.get(
+                    self.dialer.retry_at)
             self.ip = ip
             self.port = port
+            self.remote_id = None
+            self.connected_at = None
+            # Our state is per connection, only being stopped carries over
+            self.my_state = ['stopped'] if 'stopped' in self.my_state else []
+            self.pipeline = RequestPipeline()
+            # The remote peer is choked until we unchoke it
+            self.peer_state = ['choked']
+            self.uploads.clear()
+            self.download_rate = RateMeter()
+            self.upload_rate = RateMeter()
             logging.info('Got assigned peer with: {ip}:{port}'.format(ip=ip, port=port))
+            if self.connection_budget:
+                await self.connection_budget.acquire()
             try:
-                # TODO For some reason it does not seem to work to open a new
-                # connection if the first one drops (i.e. second loop).
-                connect = asyncio.open_connection(ip, port)  # connect 为协程，立即返回不阻塞
-                self.reader, self.writer = await connect  # 阻塞操作，释放cpu
-                logging.info('Connection open to peer: {ip}'.format(ip=ip))
-
-                # It's our responsibility to initiate the handshake.
-                buffer = await self._send_handshake()
-
-                # TODO Add support for sending data
-                # Sending BitField is optional and not needed when client does
-                # not have any pieces. Thus we do not send any bitfield message
-
-                # The default state for a connection is that peer is not
-                # interested and we are choked
-                self.my_state.append('choked')
-
-                # Let the peer know we're interested in downloading pieces
-                await self._send_interested()
-                self.my_state.append('interested')
-
-                # Start reading responses as a stream of messages for as
-                # long as the connection is open and data is transmitted
-                async for message in PeerStreamIterator(self.reader, buffer):
-                    # print("i am alive {peer}".format(peer=self.remote_id))
-                    if 'stopped' in self.my_state:
-                        break
-                    if type(message) is BitField:
-                        # logging.info("receive BitField from peer {peer}".format(peer=self.remote_id))
-                        self.piece_manager.add_peer(self.remote_id, message.bitfield)
-                    # elif type(message) is Interested:
-                    #     # logging.info("receive Interested from peer {peer}".format(peer=self.remote_id))
-                    #     self.peer_state.append('interested')
-                    # elif type(message) is NotInterested:
-                    #     # logging.info("receive NotInterested from peer {peer}".format(peer=self.remote_id))
-                    #     if 'interested' in self.peer_state:
-                    #         self.peer_state.remove('interested')
-                    elif type(message) is Choke:
-                        # logging.info("receive Choke from peer {peer}".format(peer=self.remote_id))
-                        self.my_state.append('choked')
-                    elif type(message) is Unchoke:
-                        # logging.info("receive Unchoke from peer {peer}".format(peer=self.remote_id))
-                        if 'choked' in self.my_state:
-                            self.my_state.remove('choked')
-                    elif type(message) is Have:
-                        # logging.info("receive Have from peer {peer}".format(peer=self.remote_id))
-                        self.piece_manager.update_peer(self.remote_id, message.index)
-                    elif type(message) is KeepAlive:
-                        # logging.info("receive KeepAlive from peer {peer}".format(peer=self.remote_id))
-                        await asyncio.sleep(1)
-                        pass
-                    elif type(message) is Piece:
-                        # logging.info("receive Piece from peer {peer}".format(peer=self.remote_id))
-                        self.my_state.remove('pending_request')
-                        self.on_block_cb(
-                            remote_id=self.remote_id,
-                            piece_index=message.index,
-                            block_offset=message.begin,
-                            data=message.block
-                        )
-                    elif type(message) is Request:
-                        logging.info("receive Request from peer {peer}".format(peer=self.remote_id))
-                        # TODO Add support for sending data
-                        logging.info('Ignoring the received Request message.')
-                    elif type(message) is Cancel:
-                        logging.info("receive Cancel from peer {peer}".format(peer=self.remote_id))
-                        # TODO Add support for sending data
-                        logging.info('Ignoring the received Cancel message.')
-
-                    # Send block request to remote peer if we're interested
-                    if 'choked' not in self.my_state:
-                        if 'interested' in self.my_state:
-                            if 'pending_request' not in self.my_state:
-                                self.my_state.append('pending_request')
-                                await self._request_piece()
+                if self.incoming:
+                    self.reader, self.writer = reader, writer
+                    logging.info('Connection from peer: {ip}'.format(ip=ip))
+
+                    # The remote peer initiated the handshake
+                    buffer = await self._answer_handshake(handshake)
+                else:
+                    connect = self.dialer.connect((ip, port))  # connect 为协程，立即返回不阻塞
+                    self.reader, self.writer = await connect  # 阻塞操作，释放cpu
+                    logging.info('Connection open to peer: {ip}'.format(ip=ip))
+
+                    # It's our responsibility to initiate the handshake.
+                    buffer = await self._send_handshake()
+                    self.dialer.succeeded((ip, port))
+
+                await self._run(buffer)
 
             except ProtocolError as e:
                 logging.exception('Connection to peer with: {ip}:{port} Protocol error'.format(ip=ip, port=port))
@@ -150,13 +165,129 @@ class PeerConnection:
                 logging.warning('Connection to peer with: {ip}:{port} refused'.format(ip=ip, port=port))
             except (TimeoutError):
                 logging.warning('Connection to peer with: {ip}:{port} timeout'.format(ip=ip, port=port))
-            except (ConnectionResetError, CancelledError):
+            except (ConnectionResetError, CancelledError,
+                    asyncio.IncompleteReadError):
                 logging.warning('Connection to peer with: {ip}:{port} closed'.format(ip=ip, port=port))
+            except OSError as e:
+                logging.warning('Connection to peer with: {ip}:{port} failed: {error}'.format(ip=ip, port=port, error=e))
+            except asyncio.CancelledError:
+                # Stopped, clean up before leaving
+                self.cancel()
+                raise
             except Exception as e:
                 logging.exception('An error occurred')
                 self.cancel()
                 raise e
+            finally:
+                if self.connection_budget:
+                    self.connection_budget.release()
+                # No handshake with a peer we dialed, hold it back a while
+                if not self.incoming and self.remote_id is None and \
+                        'stopped' not in self.my_state:
+                    self.dialer.failed((ip, port))
             self.cancel()
+            if self.incoming:
+                break
+
+    async def _run(self, buffer: bytes):
+        """
+        Exchange messages with the remote peer once the handshake is done,
+        for as long as the connection is open.
+
+        :param buffer: The data received past the handshake
+        """
+        self.connected_at = time.monotonic()
+        # Sending BitField is optional and not needed when client does
+        # not have any pieces.
+        if self.piece_manager.have_count:
+            await self._send_bitfield()
+        self.piece_manager.have_listeners.add(self._on_have)
+        self.piece_manager.cancel_listeners[self.remote_id] = self._on_cancel
+        self.uploader = asyncio.ensure_future(self._upload())
+        if self.choker:
+            self.choker.add(self)
+
+        # The default state for a connection is that peer is not
+        # interested and we are choked
+        self.my_state.append('choked')
+
+        # Let the peer know we're interested in downloading pieces
+        if not self.piece_manager.complete:
+            await self._send_interested()
+            self.my_state.append('interested')
+
+        # Start reading responses as a stream of messages for as
+        # long as the connection is open and data is transmitted
+        async for message in PeerStreamIterator(self.reader, buffer):
+            # print("i am alive {peer}".format(peer=self.remote_id))
+            if 'stopped' in self.my_state:
+                break
+            if type(message) is BitField:
+                # logging.info("receive BitField from peer {peer}".format(peer=self.remote_id))
+                self.piece_manager.add_peer(self.remote_id, message.bitfield)
+            elif type(message) is Interested:
+                # logging.info("receive Interested from peer {peer}".format(peer=self.remote_id))
+                if 'interested' not in self.peer_state:
+                    self.peer_state.append('interested')
+                if self.choker:
+                    self.choker.peer_interested(self)
+                else:
+                    self.unchoke()
+            elif type(message) is NotInterested:
+                # logging.info("receive NotInterested from peer {peer}".format(peer=self.remote_id))
+                if 'interested' in self.peer_state:
+                    self.peer_state.remove('interested')
+            elif type(message) is Choke:
+                # logging.info("receive Choke from peer {peer}".format(peer=self.remote_id))
+                if 'choked' not in self.my_state:
+                    self.my_state.append('choked')
+                # The peer discards all our pending requests when
+                # choking us, let someone else fetch those blocks
+                self._release_requests()
+            elif type(message) is Unchoke:
+                # logging.info("receive Unchoke from peer {peer}".format(peer=self.remote_id))
+                if 'choked' in self.my_state:
+                    self.my_state.remove('choked')
+            elif type(message) is Have:
+                # logging.info("receive Have from peer {peer}".format(peer=self.remote_id))
+                self.piece_manager.update_peer(self.remote_id, message.index)
+            elif type(message) is KeepAlive:
+                # logging.info("receive KeepAlive from peer {peer}".format(peer=self.remote_id))
+                await asyncio.sleep(1)
+                pass
+            elif type(message) is Piece:
+                # logging.info("receive Piece from peer {peer}".format(peer=self.remote_id))
+                self.pipeline.received(message.index, message.begin,
+                                       len(message.block))
+                self.download_rate.update(len(message.block))
+                self.on_block_cb(
+                    remote_id=self.remote_id,
+                    piece_index=message.index,
+                    block_offset=message.begin,
+                    data=message.block
+                )
+            elif type(message) is Request:
+                # logging.info("receive Request from peer {peer}".format(peer=self.remote_id))
+                self._queue_upload(message)
+            elif type(message) is Cancel:
+                # logging.info("receive Cancel from peer {peer}".format(peer=self.remote_id))
+                self._cancel_upload(message)
+
+            # Keep the request pipeline to the remote peer filled
+            # if we're interested
+            if 'choked' not in self.my_state:
+                if 'interested' in self.my_state:
+                    if self.pipeline.free_slots:
+                        await self._request_pieces()
+
+    @property
+    def connected(self) -> bool:
+        """
+        Whether or not a connection to a remote peer is established (i.e.
+        the handshake is done).
+        """
+        return self.remote_id is not None and self.writer is not None and \
+            not self.writer.is_closing()
 
     def stop(self):
         """
@@ -175,12 +306,26 @@ class PeerConnection:
         Sends the cancel message to the remote peer and closes the connection.
         """
         logging.warning('Closing peer {id}, {ip}:{port}'.format(id=self.remote_id, ip=self.ip, port=self.port))
-        if not self.future.done():
-            self.future.cancel()
+        self._release_requests()
+        self.piece_manager.remove_peer(self.remote_id)
+        self.piece_manager.have_listeners.discard(self._on_have)
+        if self.piece_manager.cancel_listeners.get(self.remote_id) == \
+                self._on_cancel:
+            del self.piece_manager.cancel_listeners[self.remote_id]
+        if self.choker:
+            self.choker.discard(self)
+        self.uploads.clear()
+        if self.uploader and not self.uploader.done():
+            self.uploader.cancel()
         if self.writer:
             self.writer.close()
 
-        self.available_peers.task_done()
+        if self.peer_database is not None and not self.incoming:
+            duration = time.monotonic() - self.connected_at \
+                if self.connected_at else 0
+            self.peer_database.release((self.ip, self.port),
+                                       self.remote_id is not None,
+                                       self.download_rate.total, duration)
 
     async def _send_handshake(self):
         """
@@ -190,13 +335,11 @@ class PeerConnection:
         self.writer.write(Handshake(self.info_hash, self.peer_id).encode())
         await self.writer.drain()
 
-        buf = b''
-        tries = 1
-        while len(buf) < Handshake.length and tries < 10:
-            tries += 1
-            buf = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+        buf = await asyncio.wait_for(
+            self.reader.readexactly(Handshake.length),
+            self.dialer.handshake_timeout)
 
-        response = Handshake.decode(buf[:Handshake.length])
+        response = Handshake.decode(buf)
         if not response:
             raise ProtocolError('Unable receive and parse a handshake : {ip}:{port}'.format(ip=self.ip, port=self.port))
         if not response.info_hash == self.info_hash:
@@ -207,10 +350,130 @@ class PeerConnection:
         self.remote_id = response.peer_id
         logging.info('Handshake with peer {peer} was successful, {ip}:{port}'.format(peer=self.remote_id, ip=self.ip, port=self.port))
 
-        # We need to return the remaining buffer data, since we might have
-        # read more bytes then the size of the handshake message and we need
-        # those bytes to parse the next message.
-        return buf[Handshake.length:]
+        # The handshake was read exactly, the messages following it are
+        # still in the reader
+        return b''
+
+    async def _answer_handshake(self, handshake: Handshake) -> bytes:
+        """
+        Answer the handshake of a remote peer that connected to us, its
+        info_hash was checked when the connection was routed to us.
+        """
+        self.writer.write(Handshake(self.info_hash, self.peer_id).encode())
+        await self.writer.drain()
+        self.remote_id = handshake.peer_id
+        logging.info('Handshake from peer {peer} was successful, {ip}:{port}'.format(peer=self.remote_id, ip=self.ip, port=self.port))
+        # The handshake was read exactly, nothing past it is buffered
+        return b''
+
+    async def _send_bitfield(self):
+        message = BitField(self.piece_manager.have_pieces.tobytes())
+        logging.info('Sending message: {type} to peer {peer}'.format(type=message, peer=self.remote_id))
+        self.writer.write(message.encode())
+        await self.writer.drain()
+
+    def choke(self):
+        """
+        Stop the remote peer from downloading from us, its queued requests
+        are discarded.
+        """
+        if 'choked' in self.peer_state or not self.writer or \
+                self.writer.is_closing():
+            return
+        message = Choke()
+        logging.info('Sending message: {type} to peer {peer}'.format(type=message, peer=self.remote_id))
+        self.writer.write(message.encode())
+        self.peer_state.append('choked')
+        self.uploads.clear()
+
+    def unchoke(self):
+        """
+        Allow the remote peer to download from us.
+        """
+        if 'choked' not in self.peer_state or not self.writer or \
+                self.writer.is_closing():
+            return
+        message = Unchoke()
+        logging.info('Sending message: {type} to peer {peer}'.format(type=message, peer=self.remote_id))
+        self.writer.write(message.encode())
+        self.peer_state.remove('choked')
+
+    def _on_have(self, index: int):
+        """
+        Called by the piece manager when a new piece is verified, to let the
+        remote peer know we have it.
+        """
+        if self.writer and not self.writer.is_closing():
+            self.writer.write(Have(index).encode())
+
+    def _on_cancel(self, block):
+        """
+        Called by the piece manager when a block requested from the remote
+        peer was received from another peer (endgame), to cancel our
+        request.
+        """
+        if self.pipeline.outstanding.pop((block.piece, block.offset), None) \
+                and self.writer and not self.writer.is_closing():
+            self.writer.write(
+                Cancel(block.piece, block.offset, block.length).encode())
+
+    def _queue_upload(self, request: Request):
+        """
+        Queue a block requested by the remote peer to be sent, if valid.
+        """
+        if 'choked' in self.peer_state:
+            # Requests made while choked are discarded
+            return
+        if not self.piece_manager.is_valid_request(
+                request.index, request.begin, request.length):
+            logging.info('Ignoring invalid request for block {block} of '
+                         'piece {piece} from peer {peer}'.format(
+                            block=request.begin,
+                            piece=request.index,
+                            peer=self.remote_id))
+            return
+        if len(self.uploads) >= MAX_QUEUED_UPLOADS:
+            logging.info('Too many requests queued by peer {peer}'.format(
+                peer=self.remote_id))
+            return
+        self.uploads.append(request)
+        self._upload_ready.set()
+
+    def _cancel_upload(self, cancel: Cancel):
+        """
+        Drop a block requested by the remote peer if not yet sent.
+        """
+        for request in self.uploads:
+            if request.index == cancel.index and \
+                    request.begin == cancel.begin and \
+                    request.length == cancel.length:
+                self.uploads.remove(request)
+                return
+
+    async def _upload(self):
+        """
+        Send the blocks requested by the remote peer, in order, for as long
+        as the connection is open.
+        """
+        try:
+            while True:
+                await self._upload_ready.wait()
+                self._upload_ready.clear()
+                while self.uploads:
+                    request = self.uploads.popleft()
+                    block = await self.piece_manager.read_block(
+                        request.index, request.begin, request.length)
+                    if 'choked' in self.peer_state:
+                        # Choked while the block was read
+                        continue
+                    self.writer.write(
+                        Piece(request.index, request.begin, block).encode())
+                    await self.writer.drain()
+                    self.upload_rate.update(len(block))
+                    self.piece_manager.block_sent(len(block))
+        except (ConnectionError, OSError) as e:
+            logging.warning('Unable to upload to peer {peer}: {error}'.format(
+                peer=self.remote_id, error=e))
 
     async def _send_interested(self):
         message = Interested()
@@ -218,10 +481,21 @@ class PeerConnection:
         self.writer.write(message.encode())
         await self.writer.drain()
 
-    async def _request_piece(self):
-        block = self.piece_manager.next_request(self.remote_id)
-        if block:
-            message = Request(block.piece, block.offset, block.length).encode()
+    async def _request_pieces(self):
+        """
+        Fill the free slots of the request pipeline with the next blocks to
+        request from the remote peer, sent in a single write.
+        """
+        # Stop requesting blocks while the received ones cannot be processed
+        await self.piece_manager.wait_for_capacity()
+
+        messages = []
+        while self.pipeline.free_slots:
+            block = self.piece_manager.next_request(self.remote_id)
+            if not block:
+                break
+            messages.append(Request(block.piece, block.offset, block.length).encode())
+            self.pipeline.requested(block)
 
             logging.info('Requesting block {block} for piece {piece} '
                           'of {length} bytes from peer {peer}'.format(
@@ -230,5 +504,14 @@ class PeerConnection:
                             length=block.length,
                             peer=self.remote_id))
 
-            self.writer.write(message)
-            await self.writer.drain()
\ No newline at end of file
+        if messages:
+            self.writer.write(b''.join(messages))
+            await self.writer.drain()
+
+    def _release_requests(self):
+        """
+        Hand the blocks still requested from the remote peer back to the
+        piece manager so they can be requested from other peers.
+        """
+        for block in self.pipeline.drain():
+            self.piece_manager.release_request(self.remote_id, block)
\ No newline at end of file
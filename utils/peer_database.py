@@ -0,0 +1,297 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from collections import deque
+
+
+class PeerRecord:
+    """
+    What we know about a peer address: where we learned it from, when it
+    was last announced and how our connections to it went.
+    """
+    def __init__(self, address: tuple, source: str, now: float):
+        self.address = address
+        self.source = source
+        self.last_seen = now
+        # The moment our last connection to it ended
+        self.last_closed = None
+        self.successes = 0
+        self.failures = 0
+        # The download rate (bytes/s) over our last connection to it
+        self.rate = 0.0
+        # Its current entry in the candidates or the held back heap, if any
+        self.entry = None
+
+    @property
+    def score(self) -> float:
+        """
+        The peers that sent us data rank first (by their rate), then the
+        peers never tried or tried without failing, then the peers that
+        failed (the more failures the lower).
+        """
+        if self.rate:
+            return self.rate
+        return -float(self.failures)
+
+
+class PeerDatabase:
+    """
+    The peers of a torrent, keyed by (ip, port).
+
+    The addresses announced by the trackers are added to the database
+    rather than replacing a queue, so what was learned about a peer is kept
+    across announces. The connection workers take candidates with `get`,
+    best score first, and hand them back with `release` once the connection
+    ended. An address is handed out to one worker at a time, so peers we are
+    connected to (or connecting to) are never dialed twice.
+
+    A peer whose connection ended is not handed out again before
+    `reconnect_delay` seconds, nor is an address the `Dialer` holds back
+    after failures (see `Dialer.retry_at`). Once the database holds more
+    than `max_peers` addresses, the lowest scored ones not in use are
+    forgotten.
+
+    The candidates are kept in a heap ordered by score, and the addresses
+    held back in a heap ordered by the moment they may be dialed again, so
+    handing out a candidate does not look at every address. Entries are not
+    removed from the heaps when an address changes, they are skipped once
+    they reach the top (and the heaps are rebuilt if they grow too large
+    compared to the database). The workers waiting for a candidate are woken
+    when an address is added or released, or comes out of its delay, rather
+    than polling.
+    """
+    def __init__(self, max_peers: int = 2000, reconnect_delay: float = 60):
+        """
+        :param max_peers: The number of addresses kept
+        :param reconnect_delay: The time (in seconds) before connecting again
+                                to a peer we were connected to
+        """
+        self.max_peers = max_peers
+        self.reconnect_delay = reconnect_delay
+        self.records = {}
+        # The addresses handed out and not yet released
+        self.in_use = set()
+        # Heap of [-score, -last seen, sequence, address]
+        self._candidates = []
+        # Heap of [moment it may be dialed, sequence, address]
+        self._held = []
+        # Breaks the ties of the heaps, addresses are not compared
+        self._sequence = itertools.count()
+        # The futures of the workers waiting for a candidate
+        self._waiters = deque()
+        self._timer = None
+        self._timer_at = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, address):
+        return address in self.records
+
+    def add(self, addresses, source: str, now: float = None):
+        """
+        Add the given (ip, port) addresses, or mark them as seen again.
+
+        :param source: Where the addresses come from (e.g. a tracker URL)
+        """
+        now = now or time.monotonic()
+        added = 0
+        for address in addresses:
+            record = self.records.get(address)
+            if record:
+                record.last_seen = now
+                # Its rank among the candidates changed (or it is a
+                # candidate again, if it was not to be dialed anymore)
+                if address not in self.in_use and \
+                        (record.entry is None or len(record.entry) == 4):
+                    self._push(record)
+            else:
+                record = PeerRecord(address, source, now)
+                self.records[address] = record
+                self._push(record)
+                added += 1
+        if len(self.records) > self.max_peers:
+            self._prune()
+        self._wake(max(1, added))
+
+    def _prune(self):
+        idle = sorted((r for r in self.records.values()
+                       if r.address not in self.in_use),
+                      key=lambda r: (r.score, r.last_seen))
+        for record in idle[:len(self.records) - self.max_peers]:
+            del self.records[record.address]
+            record.entry = None
+        self._compact()
+
+    def _push(self, record: PeerRecord):
+        """
+        Make the given record a candidate.
+        """
+        record.entry = [-record.score, -record.last_seen,
+                        next(self._sequence), record.address]
+        heapq.heappush(self._candidates, record.entry)
+        self._compact()
+
+    def _hold(self, record: PeerRecord, until: float):
+        """
+        Hold back the given record until the given moment.
+        """
+        record.entry = [until, next(self._sequence), record.address]
+        heapq.heappush(self._held, record.entry)
+        self._compact()
+
+    def _current(self, heap: list) -> list:
+        """
+        Get the top entry of the given heap, dropping the entries of
+        addresses forgotten, handed out or moved since.
+        """
+        while heap:
+            entry = heap[0]
+            record = self.records.get(entry[-1])
+            if record is not None and record.entry is entry:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    def _compact(self):
+        if len(self._candidates) + len(self._held) > \
+                2 * len(self.records) + 64:
+            self._candidates = [r.entry for r in self.records.values()
+                                if r.entry and len(r.entry) == 4]
+            self._held = [r.entry for r in self.records.values()
+                          if r.entry and len(r.entry) == 3]
+            heapq.heapify(self._candidates)
+            heapq.heapify(self._held)
+
+    def _release_held(self, now: float) -> int:
+        """
+        Make the addresses whose delay is over candidates again.
+
+        :return: The number of addresses released
+        """
+        released = 0
+        entry = self._current(self._held)
+        while entry and entry[0] <= now:
+            heapq.heappop(self._held)
+            self._push(self.records[entry[-1]])
+            released += 1
+            entry = self._current(self._held)
+        return released
+
+    def candidate(self, retry_at=None, now: float = None) -> tuple:
+        """
+        Get the best scored address that may be connected to now, without
+        handing it out.
+
+        :param retry_at: A function giving the moment an address may be
+                         dialed, None if never (e.g. `Dialer.retry_at`), if
+                         any
+        :return: The address, or None if there is no candidate
+        """
+        now = now or time.monotonic()
+        self._release_held(now)
+        entry = self._current(self._candidates)
+        while entry:
+            if retry_at is None:
+                return entry[-1]
+            moment = retry_at(entry[-1])
+            if moment is not None and moment <= now:
+                return entry[-1]
+            heapq.heappop(self._candidates)
+            record = self.records[entry[-1]]
+            if moment is None:
+                # Not to be dialed anymore, unless announced again
+                record.entry = None
+            else:
+                self._hold(record, moment)
+            entry = self._current(self._candidates)
+        return None
+
+    async def get(self, retry_at=None) -> tuple:
+        """
+        Hand out the best candidate, waiting until there is one.
+
+        :param retry_at: A function giving the moment an address may be
+                         dialed, None if never, if any
+        :return: The (ip, port) address to connect to
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            address = self.candidate(retry_at)
+            if address:
+                heapq.heappop(self._candidates)
+                self.records[address].entry = None
+                self.in_use.add(address)
+                return address
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            self._schedule()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Woken at the same time, let another worker have it
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def _wake(self, count: int = 1):
+        """
+        Wake up to `count` of the workers waiting for a candidate, there
+        might be one for each.
+        """
+        while count and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                count -= 1
+
+    def _schedule(self):
+        """
+        Wake a waiting worker once the next held back address may be dialed.
+        """
+        entry = self._current(self._held)
+        if entry is None or not self._waiters:
+            return
+        if self._timer and self._timer_at <= entry[0]:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer_at = entry[0]
+        self._timer = asyncio.get_running_loop().call_later(
+            max(0.0, entry[0] - time.monotonic()), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wake(self._release_held(time.monotonic()))
+        self._schedule()
+
+    def release(self, address: tuple, connected: bool, downloaded: int = 0,
+                duration: float = 0, now: float = None):
+        """
+        Hand back an address once the connection to it ended.
+
+        :param connected: Whether or not the handshake was completed
+        :param downloaded: The number of bytes received from the peer
+        :param duration: The time (in seconds) the connection lasted
+        """
+        self.in_use.discard(address)
+        record = self.records.get(address)
+        if record is None:
+            return
+        if connected:
+            record.last_closed = now or time.monotonic()
+            record.successes += 1
+            record.rate = downloaded / duration if duration > 0 else 0.0
+            self._hold(record, record.last_closed + self.reconnect_delay)
+            if self._waiters:
+                self._schedule()
+        else:
+            # Held back by the dialer, if it failed to connect
+            record.failures += 1
+            self._push(record)
+            self._wake()
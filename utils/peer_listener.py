@@ -0,0 +1,71 @@
+import asyncio
+import logging
+
+from .peer_message import Handshake
+
+
+class PeerListener:
+    """
+    Accepts the connections remote peers open to us, on the port we announce
+    to the trackers.
+
+    The first message of a connection is the handshake of the remote peer,
+    the connection is routed to the torrent with the info_hash it names
+    (connections to torrents we do not serve are closed). The torrent is
+    free to refuse the connection, e.g. if it has enough peers already.
+    """
+    def __init__(self, host: str = '0.0.0.0', port: int = 6889,
+                 handshake_timeout: float = 10):
+        """
+        :param host: The address to listen on
+        :param port: The port to listen on, 0 for any free port (the port
+                     listened on is set once started)
+        :param handshake_timeout: The time (in seconds) a remote peer has to
+                                  send its handshake once connected
+        """
+        self.host = host
+        self.port = port
+        self.handshake_timeout = handshake_timeout
+        # The clients accepting connections, keyed by info hash
+        self.torrents = {}
+        self.server = None
+        self.accepted = 0
+        self.refused = 0
+
+    def register(self, info_hash: bytes, client):
+        """
+        Route the connections to the torrent with the given info hash to the
+        given client (see `TorrentClient.accept`).
+        """
+        self.torrents[info_hash] = client
+
+    def unregister(self, info_hash: bytes):
+        self.torrents.pop(info_hash, None)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host,
+                                                 self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info('Listening for peers on {host}:{port}'.format(
+            host=self.host, port=self.port))
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            data = await asyncio.wait_for(
+                reader.readexactly(Handshake.length), self.handshake_timeout)
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError):
+            writer.close()
+            return
+        handshake = Handshake.decode(data)
+        client = self.torrents.get(handshake.info_hash) if handshake else None
+        if client is None or not client.accept(reader, writer, handshake):
+            self.refused += 1
+            writer.close()
+            return
+        self.accepted += 1
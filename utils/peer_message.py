@@ -153,11 +153,11 @@ class BitField(PeerMessage):
         Encodes this object instance to the raw bytes representing the entire
         message (ready to be transmitted).
         """
-        bits_length = len(self.bitfield)
-        return struct.pack('>Ib' + str(bits_length) + 's',
-                           1 + bits_length,
+        data = self.bitfield.tobytes()
+        return struct.pack('>Ib' + str(len(data)) + 's',
+                           1 + len(data),
                            PeerMessage.BitField,
-                           self.bitfield)
+                           data)
 
     @classmethod
     def decode(cls, data: bytes):
@@ -203,6 +203,11 @@ class NotInterested(PeerMessage):
     Message format:
         <len=0001><id=3>
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.NotInterested)
+
     def __str__(self):
         return 'NotInterested'
 
@@ -215,6 +220,11 @@ class Choke(PeerMessage):
     Message format:
         <len=0001><id=0>
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.Choke)
+
     def __str__(self):
         return 'Choke'
 
@@ -227,6 +237,11 @@ class Unchoke(PeerMessage):
     Message format:
         <len=0001><id=1>
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.Unchoke)
+
     def __str__(self):
         return 'Unchoke'
 
@@ -318,7 +333,7 @@ class Piece(PeerMessage):
 
         :param index: The zero based piece index
         :param begin: The zero based offset within a piece
-        :param block: The block data
+        :param block: The block data (any bytes-like object)
         """
         self.index = index
         self.begin = begin
@@ -326,20 +341,23 @@ class Piece(PeerMessage):
 
     def encode(self):
         message_length = Piece.length + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's',
-                           message_length,
-                           PeerMessage.Piece,
-                           self.index,
-                           self.begin,
-                           self.block)
+        header = struct.pack('>IbII',
+                             message_length,
+                             PeerMessage.Piece,
+                             self.index,
+                             self.begin)
+        return b''.join([header, self.block])
 
     @classmethod
     def decode(cls, data: bytes):
+        """
+        Decodes the Piece message. The block is returned as a `memoryview`
+        into the given data, i.e. the block data is not copied.
+        """
         # logging.debug('Decoding Piece of length: {length}'.format(length=len(data)))
-        length = struct.unpack('>I', data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's',
-                              data[:length+4])
-        return cls(parts[2], parts[3], parts[4])
+        length, _, index, begin = struct.unpack_from('>IbII', data)
+        block = memoryview(data)[Piece.length + 4:length + 4]
+        return cls(index, begin, block)
 
     def __str__(self):
         return 'Piece'
@@ -1,6 +1,7 @@
 import struct
 import logging
 
+from collections import deque
 from concurrent.futures import CancelledError
 
 from .peer_message import PeerMessage, Handshake, Interested, BitField, NotInterested, Choke, Unchoke, Have, KeepAlive, Piece, Request, Cancel
@@ -11,35 +12,51 @@ class PeerStreamIterator:
     the given stream reader and tries to parse valid BitTorrent messages from
     off that stream of bytes.
 
+    Received bytes are appended to a growable `bytearray` and consumed by
+    moving a read cursor forward, so a message is never copied just to get
+    it out of the buffer. Every complete message in the buffer is parsed for
+    each socket read, and payloads (e.g. the block of a `Piece` message) are
+    handed out as `memoryview` slices of the read buffer.
+
     If the connection is dropped, something fails the iterator will abort by
     raising the `StopAsyncIteration` error ending the calling iteration.
     """
-    CHUNK_SIZE = 10*1024
+    CHUNK_SIZE = 64*1024
+
+    # The length prefix of each message is a four byte big-endian value
+    HEADER_LENGTH = 4
 
     def __init__(self, reader, initial: bytes=None):
         self.reader = reader
-        self.buffer = initial if initial else b''
+        self.buffer = bytearray(initial) if initial else bytearray()
+        # Position of the first byte not yet parsed in the buffer
+        self.cursor = 0
+        # Messages parsed from the buffer not yet returned by the iterator
+        self.messages = deque()
+        # Whether or not views into the current buffer have been handed out,
+        # in which case the buffer must not be resized in place
+        self._exported = False
+        # The initial data (read along with the handshake) might already
+        # hold complete messages
+        self.parse()
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
         # Read data from the socket. When we have enough data to parse, parse
-        # it and return the message. Until then keep reading from stream
+        # all of it and return the first message. Until then keep reading
+        # from stream
         while True:
+            if self.messages:
+                return self.messages.popleft()
             try:
                 data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
                 if data:
-                    self.buffer += data
-                    message = self.parse()
-                    if message:
-                        return message
+                    self.feed(data)
+                    self.parse()
                 else:
                     # logging.debug('No data read from stream')
-                    if self.buffer:
-                        message = self.parse()
-                        if message:
-                            return message
                     raise StopAsyncIteration()
             except ConnectionResetError:
                 logging.debug('Connection closed by peer')
@@ -52,14 +69,30 @@ class PeerStreamIterator:
             except Exception:
                 logging.exception('Error when iterating over stream!')
                 raise StopAsyncIteration()
-        raise StopAsyncIteration()
 
-    def parse(self):
+    def feed(self, data: bytes):
+        """
+        Append the given data to the read buffer, discarding the bytes that
+        have already been parsed.
+        """
+        if self.cursor:
+            if self._exported:
+                # Someone still holds views into the current buffer, only the
+                # unparsed tail (at most one partial message) is copied to a
+                # new buffer and the old one is left to its views.
+                self.buffer = bytearray(memoryview(self.buffer)[self.cursor:])
+                self._exported = False
+            else:
+                del self.buffer[:self.cursor]
+            self.cursor = 0
+        self.buffer += data
+
+    def parse(self) -> int:
         """
-        Tries to parse protocol messages if there is enough bytes read in the
-        buffer.
+        Parse every complete protocol message in the buffer and queue them
+        to be returned by the iterator.
 
-        :return The parsed message, or None if no message could be parsed
+        :return The number of messages parsed
         """
         # Each message is structured as:
         #     <length prefix><message ID><payload>
@@ -70,60 +103,55 @@ class PeerStreamIterator:
         #
         # The message length is not part of the actual length. So another
         # 4 bytes needs to be included when slicing the buffer.
-        header_length = 4
-
-        if len(self.buffer) > 4:  # 4 bytes is needed to identify the message
-            message_length = struct.unpack('>I', self.buffer[0:4])[0]
-
-            if message_length == 0:
-                return KeepAlive()
-
-            if len(self.buffer) >= message_length:
-                message_id = struct.unpack('>b', self.buffer[4:5])[0]
-
-                def _consume():
-                    """Consume the current message from the read buffer"""
-                    self.buffer = self.buffer[header_length + message_length:]
-
-                def _data():
-                    """"Extract the current message from the read buffer"""
-                    return self.buffer[:header_length + message_length]
-
-                if message_id is PeerMessage.BitField:
-                    data = _data()
-                    _consume()
-                    return BitField.decode(data)
-                elif message_id is PeerMessage.Interested:
-                    _consume()
-                    return Interested()
-                elif message_id is PeerMessage.NotInterested:
-                    _consume()
-                    return NotInterested()
-                elif message_id is PeerMessage.Choke:
-                    _consume()
-                    return Choke()
-                elif message_id is PeerMessage.Unchoke:
-                    _consume()
-                    return Unchoke()
-                elif message_id is PeerMessage.Have:
-                    data = _data()
-                    _consume()
-                    return Have.decode(data)
-                elif message_id is PeerMessage.Piece:
-                    data = _data()
-                    _consume()
-                    return Piece.decode(data)
-                elif message_id is PeerMessage.Request:
-                    data = _data()
-                    _consume()
-                    return Request.decode(data)
-                elif message_id is PeerMessage.Cancel:
-                    data = _data()
-                    _consume()
-                    return Cancel.decode(data)
+        header_length = PeerStreamIterator.HEADER_LENGTH
+        buffer_length = len(self.buffer)
+        parsed = 0
+
+        with memoryview(self.buffer) as view:
+            while buffer_length - self.cursor >= header_length:
+                start = self.cursor
+                message_length = struct.unpack_from('>I', view, start)[0]
+                end = start + header_length + message_length
+                if end > buffer_length:
+                    # logging.debug('Not enough in buffer in order to parse')
+                    break
+                self.cursor = end
+
+                if message_length == 0:
+                    message = KeepAlive()
                 else:
-                    logging.info('Unsupported message!')
-            # else:
-            #     logging.debug('Not enough in buffer in order to parse')
+                    message = self._decode(view[start:end],
+                                           view[start + header_length])
+                if message:
+                    self.messages.append(message)
+                    parsed += 1
+        return parsed
+
+    def _decode(self, data: memoryview, message_id: int):
+        """
+        Decode a single message given its raw bytes, including the length
+        prefix.
+        """
+        if message_id == PeerMessage.Piece:
+            # The block of the message is a view into our buffer
+            self._exported = True
+            return Piece.decode(data)
+        elif message_id == PeerMessage.Have:
+            return Have.decode(data)
+        elif message_id == PeerMessage.Request:
+            return Request.decode(data)
+        elif message_id == PeerMessage.Cancel:
+            return Cancel.decode(data)
+        elif message_id == PeerMessage.BitField:
+            return BitField.decode(data)
+        elif message_id == PeerMessage.Interested:
+            return Interested()
+        elif message_id == PeerMessage.NotInterested:
+            return NotInterested()
+        elif message_id == PeerMessage.Choke:
+            return Choke()
+        elif message_id == PeerMessage.Unchoke:
+            return Unchoke()
+        else:
+            logging.info('Unsupported message!')
         return None
-
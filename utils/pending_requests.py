@@ -0,0 +1,144 @@
+import heapq
+
+from collections import namedtuple
+
+
+# The type used for keeping track of pending request that can be re-issued
+PendingRequest = namedtuple('PendingRequest', ['block', 'peer_id', 'added_moment'])
+
+
+class PendingRequests:
+    """
+    The table of blocks requested from peers but not yet received.
+
+    Requests are indexed by (piece index, block offset) so a received block
+    finds its request in constant time, and each request is tagged with the
+    peer it was sent to. The expiry moments are kept in a min-heap, so
+    finding the requests pending for too long does not require walking the
+    whole table.
+
+    Entries of the heap are not removed when a request is completed, they
+    are skipped once they reach the top of the heap (and the heap is rebuilt
+    if it grows too large compared to the table).
+
+    In endgame mode a block might be requested from several peers at once.
+    The first peer is the owner of the request, the others are kept as
+    duplicates of it (and the number of bytes requested twice is counted).
+    """
+    def __init__(self, max_pending_time: int):
+        """
+        :param max_pending_time: The time (in milliseconds) after which a
+                                 request is considered expired
+        """
+        self.max_pending_time = max_pending_time
+        self.requests = {}
+        # Heap of (expiry moment, piece index, block offset)
+        self.deadlines = []
+        # The other peers a block is requested from, keyed by (piece index,
+        # block offset)
+        self.duplicates = {}
+        self.duplicate_bytes = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, key):
+        return key in self.requests
+
+    def get(self, piece: int, offset: int) -> PendingRequest:
+        return self.requests.get((piece, offset))
+
+    def add(self, block, peer_id, moment: int):
+        """
+        Add (or renew) the request of the given block to the given peer.
+        """
+        self.requests[(block.piece, block.offset)] = \
+            PendingRequest(block, peer_id, moment)
+        heapq.heappush(self.deadlines,
+                       (moment + self.max_pending_time, block.piece, block.offset))
+        if len(self.deadlines) > 2 * len(self.requests) + 64:
+            self._rebuild()
+
+    def remove(self, piece: int, offset: int) -> PendingRequest:
+        """
+        Remove the request for the given block, and its duplicates.
+
+        :return: The removed request, or None if the block was not pending
+        """
+        self._remove_duplicates(piece, offset)
+        return self.requests.pop((piece, offset), None)
+
+    def add_duplicate(self, block, peer_id):
+        """
+        Add a request of an already requested block to another peer.
+        """
+        self.duplicates.setdefault((block.piece, block.offset), []).append(
+            peer_id)
+        self.duplicate_bytes += block.length
+
+    def get_duplicates(self, piece: int, offset: int) -> list:
+        """
+        Get the peers the given block is requested from, besides the owner
+        of the request.
+        """
+        return self.duplicates.get((piece, offset), [])
+
+    def remove_duplicate(self, piece: int, offset: int, peer_id) -> bool:
+        """
+        Remove the duplicate request of the given block to the given peer.
+
+        :return: Whether or not there was such a duplicate
+        """
+        peers = self.duplicates.get((piece, offset))
+        if not peers or peer_id not in peers:
+            return False
+        peers.remove(peer_id)
+        if not peers:
+            del self.duplicates[(piece, offset)]
+        self.duplicate_bytes -= self.requests[(piece, offset)].block.length
+        return True
+
+    def promote(self, piece: int, offset: int) -> PendingRequest:
+        """
+        Make the first duplicate the owner of the request for the given
+        block, e.g. when the owner dropped it.
+
+        :return: The new request, or None if there is no duplicate
+        """
+        peers = self.duplicates.get((piece, offset))
+        if not peers:
+            return None
+        peer_id = peers[0]
+        self.remove_duplicate(piece, offset, peer_id)
+        # Keep the moment, its entry of the heap remains valid
+        request = self.requests[(piece, offset)]._replace(peer_id=peer_id)
+        self.requests[(piece, offset)] = request
+        return request
+
+    def _remove_duplicates(self, piece: int, offset: int):
+        peers = self.duplicates.pop((piece, offset), None)
+        if peers:
+            self.duplicate_bytes -= \
+                len(peers) * self.requests[(piece, offset)].block.length
+
+    def pop_expired(self, moment: int) -> PendingRequest:
+        """
+        Remove and return the request that expired first, or None if no
+        request is expired at the given moment.
+        """
+        while self.deadlines and self.deadlines[0][0] < moment:
+            deadline, piece, offset = heapq.heappop(self.deadlines)
+            request = self.requests.get((piece, offset))
+            # Skip entries of requests completed or renewed since
+            if request and \
+               request.added_moment + self.max_pending_time == deadline:
+                self._remove_duplicates(piece, offset)
+                del self.requests[(piece, offset)]
+                return request
+        return None
+
+    def _rebuild(self):
+        self.deadlines = [(r.added_moment + self.max_pending_time,
+                           r.block.piece, r.block.offset)
+                          for r in self.requests.values()]
+        heapq.heapify(self.deadlines)
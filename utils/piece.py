@@ -1,6 +1,11 @@
-from collections import namedtuple
+import math
+import logging
+
 from hashlib import sha1
 
+from .peer_message import REQUEST_SIZE
+
+
 class Block:
     """
     The block is a partial piece, this is what is requested and transferred
@@ -8,17 +13,20 @@ class Block:
 
     A block is most often of the same size as the REQUEST_SIZE, except for the
     final block which might (most likely) is smaller than REQUEST_SIZE.
+
+    Blocks are only created when requested, the state of the blocks of a piece
+    is kept by the piece itself.
     """
     Missing = 0
     Pending = 1
     Retrieved = 2
 
+    __slots__ = ('piece', 'offset', 'length')
+
     def __init__(self, piece: int, offset: int, length: int):
         self.piece = piece
         self.offset = offset
         self.length = length
-        self.status = Block.Missing
-        self.data = None
 
 
 class Piece:
@@ -30,29 +38,54 @@ class Piece:
     data between peers a smaller unit is used - this smaller piece is refereed
     to as `Block` by the unofficial specification (the official specification
     uses piece for this one as well, which is slightly confusing).
+
+    The state of each block (see `Block`) is kept in a byte array indexed by
+    block number, together with a count of the retrieved blocks so that
+    completion is known without looking at the blocks.
     """
-    def __init__(self, index: int, blocks: [], hash_value):
+    def __init__(self, index: int, length: int, hash_value):
         self.index = index
-        self.blocks = blocks
+        self.length = length
         self.hash = hash_value
+        self.num_blocks = math.ceil(length / REQUEST_SIZE)
+        self.status = bytearray(self.num_blocks)
+        self.blocks = [None] * self.num_blocks
+        self.retrieved = 0
 
     def reset(self):
         """
         Reset all blocks to Missing regardless of current state.
         """
-        for block in self.blocks:
-            block.status = Block.Missing
+        self.status = bytearray(self.num_blocks)
+        self.blocks = [None] * self.num_blocks
+        self.retrieved = 0
+
+    def block(self, number: int) -> Block:
+        """
+        Get the Block with the given block number.
+        """
+        offset = number * REQUEST_SIZE
+        return Block(self.index, offset, min(REQUEST_SIZE, self.length - offset))
 
     def next_request(self) -> Block:
         """
         Get the next Block to be requested
         """
-        missing = [b for b in self.blocks if b.status is Block.Missing]
-        if missing:
-            missing[0].status = Block.Pending
-            return missing[0]
+        number = self.status.find(Block.Missing)
+        if number >= 0:
+            self.status[number] = Block.Pending
+            return self.block(number)
         return None
 
+    def block_released(self, offset: int):
+        """
+        Put a pending block back in Missing state, e.g. when its request was
+        dropped.
+        """
+        number = offset // REQUEST_SIZE
+        if number < self.num_blocks and self.status[number] == Block.Pending:
+            self.status[number] = Block.Missing
+
     def block_received(self, offset: int, data: bytes):
         """
         Update block information that the given block is now received
@@ -60,14 +93,24 @@ class Piece:
         :param offset: The block offset (within the piece)
         :param data: The block data
         """
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
+        number, remainder = divmod(offset, REQUEST_SIZE)
+        if remainder or number >= self.num_blocks or \
+                len(data) != self.block(number).length:
             logging.warning('Trying to complete a non-existing block {offset}'
                             .format(offset=offset))
+            return
+        if self.status[number] != Block.Retrieved:
+            self.status[number] = Block.Retrieved
+            self.retrieved += 1
+        self.blocks[number] = data
+
+    def has_block(self, offset: int) -> bool:
+        """
+        Check whether the block at the given offset is retrieved already.
+        """
+        number, remainder = divmod(offset, REQUEST_SIZE)
+        return not remainder and number < self.num_blocks and \
+            self.status[number] == Block.Retrieved
 
     def is_complete(self) -> bool:
         """
@@ -75,8 +118,7 @@ class Piece:
 
         :return: True or False
         """
-        blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) == 0
+        return self.retrieved == self.num_blocks
 
     def is_hash_matching(self):
         """
@@ -96,6 +138,4 @@ class Piece:
         NOTE: This method does not control that all blocks are valid or even
         existing!
         """
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
+        return b''.join([b for b in self.blocks if b is not None])
@@ -1,16 +1,22 @@
-import math
+import asyncio
 import os
 import time
 import logging
-
-from collections import namedtuple, defaultdict
+import bitstring
 
 from .piece import Piece, Block
-from .peer_message import REQUEST_SIZE
+from .piece_picker import PiecePicker
+from .pending_requests import PendingRequests
+from .verifier import PieceVerifier
+from .storage import Storage
+from .resume import FastResume
+from .recheck import Recheck
+from .block_cache import BlockCache
+from .rate_meter import RateMeter
 
 
-# The type used for keeping track of pending request that can be re-issued
-PendingRequest = namedtuple('PendingRequest', ['block', 'added_moment'])
+# The largest block a remote peer may request, larger requests are ignored
+MAX_REQUEST_LENGTH = 2**17
 
 
 class PieceManager:
@@ -19,63 +25,187 @@ class PieceManager:
     pieces for the connected peers as well as the pieces we have available for
     other peers.
 
-    The strategy on which piece to request is made as simple as possible in
-    this implementation.
+    Blocks of pieces already started are requested first, new pieces are
+    started "rarest-piece-first" (see `PiecePicker`).
+
+    Only the ongoing pieces are kept as `Piece` objects, the missing pieces
+    are the candidates of the picker and the pieces we have are kept as a
+    bitfield.
+
+    Completed pieces are hashed by a `PieceVerifier` off the event loop, in
+    the meantime they are kept as verifying. Verified pieces are handed to the
+    write-behind `Storage`. Should writing a piece fail, it is no longer a
+    piece we have and is retrieved again.
+
+    The pieces we have are recorded in a fast-resume file when closed, and
+    restored from it on startup if the files were not changed since.
+    Otherwise data found on disk has to be verified with `recheck`. While
+    downloading, the pieces written so far are recorded every
+    `checkpoint_interval` seconds (see `checkpoint`), so a download that is
+    not closed (e.g. killed) resumes from there.
+
+    Once every missing block is requested (the endgame), the blocks still
+    pending are requested from the other peers having them as well, so the
+    download does not wait on the slowest peers. When the first copy of a
+    block arrives the other requests are cancelled through the
+    `cancel_listeners` callbacks of the connections. The bytes requested
+    more than once are capped at `max_duplicate_bytes`.
+
+    Blocks of the pieces we have are served to remote peers through a
+    `BlockCache`. The connections are told about every new piece we have
+    through the `have_listeners` callbacks (to send Have messages).
     """
-    def __init__(self, torrent):
+    def __init__(self, torrent, verifier: PieceVerifier = None,
+                 storage: Storage = None, storage_executor=None,
+                 mmap_threshold: int = None, fsync: str = Storage.FSYNC_CLOSE,
+                 fsync_interval: float = 30):
+        """
+        :param verifier: The verifier to hash the pieces with, which might be
+                         shared with other managers
+        :param storage: The storage to write the pieces to, a new one for
+                        the files of the torrent if not given
+        :param storage_executor: The threads of the new storage, see
+                                 `Storage`
+        :param mmap_threshold: The size up to which the files of the new
+                               storage are memory mapped, None to not map
+                               any file
+        :param fsync: The fsync (or msync) policy of the new storage
+        :param fsync_interval: Seconds between syncs for the periodic policy
+        """
         self.torrent = torrent
-        self.total_pieces_len = len(torrent.pieces)
+        self.piece_hashes = torrent.pieces
+        self.total_pieces_len = len(self.piece_hashes)
         self.peers = {}
-        self.pending_blocks = []
-        # self.missing_pieces = []
-        self.missing_pieces = self._initiate_pieces()
-        self.ongoing_pieces = []
-        self.have_pieces = []
-        self.max_pending_time = 1 * 60 * 1000  # 5 minutes
-        self.f = open(torrent.output_file, "wb")
-
-    def _initiate_pieces(self) -> [Piece]:
-        """
-        Pre-construct the list of pieces and blocks based on the number of
-        pieces and request size for this torrent.
-        """
-        torrent = self.torrent
-        total_pieces_len = self.total_pieces_len
-        pieces = []
-        n_piece_blocks = math.ceil(torrent.piece_length / REQUEST_SIZE)
-
-        for index, hash_value in enumerate(torrent.pieces):
-            # The number of blocks for each piece can be calculated using the
-            # request size as divisor for the piece length.
-            # The final piece however, will most likely have fewer blocks
-            # than 'regular' pieces, and that final block might be smaller
-            # than the other blocks.
-            if index < (total_pieces_len - 1):
-                blocks = [Block(index, block_id * REQUEST_SIZE, REQUEST_SIZE)
-                          for block_id in range(n_piece_blocks)]
-            else:
-                last_length = torrent.total_size % torrent.piece_length
-                num_blocks = math.ceil(last_length / REQUEST_SIZE)
-                blocks = [Block(index, block_id * REQUEST_SIZE, REQUEST_SIZE)
-                          for block_id in range(num_blocks)]
-
-                if last_length % REQUEST_SIZE > 0:
-                    # Last block of the last piece might be smaller than
-                    # the ordinary request size.
-                    last_block = blocks[-1]
-                    last_block.length = last_length % REQUEST_SIZE
-                    blocks[-1] = last_block
-            pieces.append(Piece(index, blocks, hash_value))
-        return pieces
-
-    def close(self):
-        """
-        Close any resources used by the PieceManager (such as open files)
+        # The missing pieces not yet started are the candidates of the picker
+        self.picker = PiecePicker(self.total_pieces_len)
+        # The pieces started but not yet verified, keyed by piece index
+        self.ongoing_pieces = {}
+        # The completed pieces waiting for their hash to be checked
+        self.verifying_pieces = {}
+        self.hash_failures = 0
+        # A verifier given by the caller might be shared with other managers
+        self._own_verifier = verifier is None
+        self.verifier = verifier if verifier else PieceVerifier()
+        self.have_pieces = bitstring.BitArray(self.total_pieces_len)
+        self.have_count = 0
+        self.max_pending_time = 1 * 60 * 1000  # 1 minute
+        self.pending_blocks = PendingRequests(self.max_pending_time)
+        self.endgame = False
+        self.max_duplicate_bytes = 4 * 2**20
+        # Bytes of blocks received more than once
+        self.redundant_bytes = 0
+        # The rates of the torrent, over all peers
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        # Called with the blocks no longer needed from a peer, keyed by peer
+        self.cancel_listeners = {}
+        # Seconds between the checkpoints of the resume file
+        self.checkpoint_interval = 30
+        self._checkpointed = time.monotonic()
+        # Whether or not the pieces we have changed since the last checkpoint
+        self._changed = False
+        # Held while the resume file is saved (off the event loop)
+        self._saving = asyncio.Lock()
+        # The resume file must be checked before the storage opens the files
+        self.resume = FastResume(torrent)
+        bitfield = self.resume.load()
+        if bitfield:
+            self._restore(bitfield)
+        # Data left by a previous run that cannot be trusted must be checked
+        self.needs_recheck = not bitfield and any(
+            os.path.isfile(f.name) and os.path.getsize(f.name) > 0
+            for f in torrent.files)
+        self.storage = storage if storage else \
+            Storage(torrent.files, fsync=fsync, fsync_interval=fsync_interval,
+                    mmap_threshold=mmap_threshold, executor=storage_executor)
+        self.storage.on_write_error = self._write_failed
+        self.block_cache = BlockCache(self)
+        # Called with the index of every newly verified piece
+        self.have_listeners = set()
+        self.uploaded = 0
+
+    def _piece_length(self, index: int) -> int:
+        """
+        Get the length of the piece with the given index. Every piece has the
+        same length except the final one, which might be shorter.
+        """
+        return self.torrent.piece_size(index)
+
+    def _restore(self, bitfield: bytes):
+        """
+        Mark the pieces set in the given bitfield as pieces we have.
+        """
+        have = bitstring.BitArray(bytes=bitfield)
+        for index in have.findall('0b1'):
+            if index >= self.total_pieces_len:
+                break
+            self._mark_have(index)
+        logging.info('Resuming with {have} / {total} pieces'.format(
+            have=self.have_count, total=self.total_pieces_len))
+
+    async def recheck(self):
+        """
+        Verify the data on disk against the piece hashes, marking the valid
+        pieces as have.
+        """
+        await Recheck(self).run()
+        self.needs_recheck = False
+
+    def _mark_have(self, index: int):
+        if not self.have_pieces[index]:
+            self.have_pieces[index] = 1
+            self.have_count += 1
+            self.picker.remove(index)
+            self._changed = True
+
+    async def checkpoint(self):
+        """
+        Record the pieces we have in the resume file, if they changed and the
+        last checkpoint is `checkpoint_interval` seconds old.
+
+        The pieces still waiting to be written are left out, the others are
+        synced to disk (following the fsync policy of the storage) before
+        the file is saved, by the threads of the storage.
+        """
+        storage = self.storage
+        if not self._changed or storage is None or \
+                time.monotonic() - self._checkpointed < \
+                self.checkpoint_interval:
+            return
+        self._changed = False
+        self._checkpointed = time.monotonic()
+        written = self.have_pieces.copy()
+        for offset in storage.pending_offsets():
+            written[offset // self.torrent.piece_length] = 0
+        await storage.sync()
+        # Closing saves the resume file as well, with every piece written
+        if storage is self.storage:
+            async with self._saving:
+                await asyncio.get_running_loop().run_in_executor(
+                    storage.executor, self.resume.save, written.tobytes(),
+                    True)
+
+    async def close(self):
+        """
+        Close any resources used by the PieceManager (such as open files),
+        once the verified pieces are written. The event loop is not blocked
+        in the meantime.
         """
         # if self.fd:
         #     os.close(self.fd)
-        if self.f:
-            self.f.close()
+        self.verifying_pieces.clear()
+        if self._own_verifier:
+            self.verifier.close()
+        self.block_cache.clear()
+        if self.storage:
+            storage = self.storage
+            self.storage = None
+            await storage.aclose()
+            # Every verified piece is on disk now. The threads of the storage
+            # might be shut down, the default ones are used instead
+            async with self._saving:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.resume.save, self.have_pieces.tobytes())
 
     @property
     def complete(self):
@@ -84,7 +214,7 @@ class PieceManager:
 
         :return: True if all pieces are fully downloaded else False
         """
-        return len(self.have_pieces) == self.total_pieces_len
+        return self.have_count == self.total_pieces_len
 
     @property
     def bytes_downloaded(self) -> int:
@@ -93,28 +223,84 @@ class PieceManager:
 
         This method Only counts full, verified, pieces, not single blocks.
         """
-        return len(self.have_pieces) * self.torrent.piece_length
+        return self.have_count * self.torrent.piece_length
+
+    @property
+    def bytes_left(self) -> int:
+        """
+        Get the number of bytes of the pieces we do not have yet.
+        """
+        left = self.torrent.total_size - \
+            self.have_count * self.torrent.piece_length
+        # The final piece might be shorter than the others
+        last = self.total_pieces_len - 1
+        if self.have_pieces[last]:
+            left += self.torrent.piece_length - self._piece_length(last)
+        return left
 
     @property
     def bytes_uploaded(self) -> int:
-        # TODO Add support for sending data
-        return 0
+        """
+        Get the number of bytes of blocks sent to remote peers.
+        """
+        return self.uploaded
+
+    def is_valid_request(self, index: int, begin: int, length: int) -> bool:
+        """
+        Check whether a block requested by a remote peer can be served, i.e.
+        it is a block of a piece we have.
+        """
+        return 0 <= index < self.total_pieces_len and \
+            self.have_pieces[index] and \
+            0 < length <= MAX_REQUEST_LENGTH and \
+            0 <= begin and begin + length <= self._piece_length(index)
+
+    async def read_block(self, index: int, begin: int, length: int):
+        """
+        Read a (valid) block requested by a remote peer.
+
+        :return: A bytes-like object
+        """
+        return await self.block_cache.get(index, begin, length)
+
+    def block_sent(self, length: int):
+        """
+        Account a block of the given length sent to a remote peer.
+        """
+        self.uploaded += length
+        self.upload_rate.update(length)
+
+    async def wait_for_capacity(self):
+        """
+        Wait until the received pieces can be processed, i.e. neither the
+        verifier nor the storage is falling behind. Used to stop requesting
+        blocks until then.
+        """
+        await self.verifier.wait_for_capacity()
+        await self.storage.wait_for_capacity()
 
     def add_peer(self, peer_id, bitfield):
         """
         Adds a peer and the bitfield representing the pieces the peer has.
         """
+        self.remove_peer(peer_id)
         self.peers[peer_id] = bitfield
+        self.picker.add_peer(bitfield)
 
     def update_peer(self, peer_id, index: int):
         """
         Updates the information about which pieces a peer has (reflects a Have
         message).
         """
-        if peer_id in self.peers:
+        if index >= self.total_pieces_len:
+            return
+        if peer_id not in self.peers:
+            # The peer did not have any pieces when it connected, so it did
+            # not send any bitfield.
+            self.peers[peer_id] = bitstring.BitArray(self.total_pieces_len)
+        if not self.peers[peer_id][index]:
             self.peers[peer_id][index] = 1
-        # else:
-        #     self.peers[peer_id][index] = 1
+            self.picker.peer_have(index)
 
     def remove_peer(self, peer_id):
         """
@@ -122,6 +308,7 @@ class PieceManager:
         is dropped)
         """
         if peer_id in self.peers:
+            self.picker.remove_peer(self.peers[peer_id])
             del self.peers[peer_id]
 
     def next_request(self, peer_id) -> Block:
@@ -131,17 +318,15 @@ class PieceManager:
         If there are no more blocks left to retrieve or if this peer does not
         have any of the missing pieces None is returned
         """
-        # The algorithm implemented for which piece to retrieve is a simple
-        # one. This should preferably be replaced with an implementation of
-        # "rarest-piece-first" algorithm instead.
-        #
-        # The algorithm tries to download the pieces in sequence and will try
-        # to finish started pieces before starting with new pieces.
+        # Started pieces are finished before new pieces are started, and new
+        # pieces are picked "rarest-piece-first" by the `PiecePicker`.
         #
         # 1. Check any pending blocks to see if any request should be reissued
         #    due to timeout
         # 2. Check the ongoing pieces to get the next block to request
-        # 3. Check if this peer have any of the missing pieces not yet started
+        # 3. Start the rarest of the missing pieces this peer has
+        # 4. Once every missing block is requested (endgame), request a
+        #    pending block from this peer as well
         if peer_id not in self.peers:
             return None
 
@@ -149,64 +334,143 @@ class PieceManager:
         if not block:
             block = self._next_ongoing(peer_id)
             if not block:
-                # block = self._get_rarest_piece(peer_id).next_request()
                 piece = self._get_rarest_piece(peer_id)
-                block = self._next_ongoing(peer_id)
+                if piece:
+                    block = self._request_block(peer_id, piece)
+        if not block and self._in_endgame():
+            block = self._duplicate_request(peer_id)
         return block
 
+    def release_request(self, peer_id, block: Block):
+        """
+        Put a block requested from the given peer back in missing state, to
+        be requested again (e.g. the peer choked us or the connection dropped
+        before the block was received).
+        """
+        if self.pending_blocks.remove_duplicate(block.piece, block.offset,
+                                                peer_id):
+            return
+        request = self.pending_blocks.get(block.piece, block.offset)
+        # The request might have expired and been re-issued to another peer
+        if request and request.peer_id == peer_id:
+            # The block is still requested from another peer (endgame)
+            if self.pending_blocks.promote(block.piece, block.offset):
+                return
+            self.pending_blocks.remove(block.piece, block.offset)
+            self._block_released(block)
+
+    def _in_endgame(self) -> bool:
+        """
+        Check whether every missing block is requested already.
+        """
+        if self.endgame:
+            return True
+        if len(self.picker) or not self.pending_blocks:
+            return False
+        for piece in self.ongoing_pieces.values():
+            if piece.status.find(Block.Missing) >= 0:
+                return False
+        logging.info('Entering endgame with {count} blocks pending'.format(
+            count=len(self.pending_blocks)))
+        self.endgame = True
+        return True
+
+    def _duplicate_request(self, peer_id) -> Block:
+        """
+        Get a pending block to request from the given peer as well, the one
+        requested from the fewest peers. None if the peer has none of the
+        pending blocks, or too many bytes are requested twice already.
+        """
+        if self.pending_blocks.duplicate_bytes >= self.max_duplicate_bytes:
+            return None
+        bitfield = self.peers[peer_id]
+        best = None
+        fewest = None
+        for (index, offset), request in self.pending_blocks.requests.items():
+            if request.peer_id == peer_id or not bitfield[index]:
+                continue
+            duplicates = self.pending_blocks.get_duplicates(index, offset)
+            if peer_id in duplicates:
+                continue
+            if best is None or len(duplicates) < fewest:
+                best = request.block
+                fewest = len(duplicates)
+                if not fewest:
+                    break
+        if best:
+            self.pending_blocks.add_duplicate(best, peer_id)
+        return best
+
     def _expired_requests(self, peer_id) -> Block:
         """
         Go through previously requested blocks, if any one have been in the
-        requested state for longer than `MAX_PENDING_TIME` return the block to
+        requested state for longer than `max_pending_time` return the block to
         be re-requested.
 
+        Expired blocks the given peer does not have are put back in missing
+        state, to be requested from any peer having them.
+
         If no pending blocks exist, None is returned
         """
         current = int(round(time.time() * 1000))
-        for request in self.pending_blocks:
-            if self.peers[peer_id][request.block.piece]:
-                if request.added_moment + self.max_pending_time < current:
-                    logging.info('Re-requesting block {block} for '
-                                 'piece {piece}'.format(
-                                    block=request.block.offset,
-                                    piece=request.block.piece))
-                    # Reset expiration timer
-                    self.pending_blocks.append(PendingRequest(request.block, current))
-                    self.pending_blocks.remove(request)
-                    return self.pending_blocks[-1].block
+        request = self.pending_blocks.pop_expired(current)
+        while request:
+            block = request.block
+            if self.peers[peer_id][block.piece]:
+                logging.info('Re-requesting block {block} for '
+                             'piece {piece}'.format(
+                                block=block.offset,
+                                piece=block.piece))
+                # Reset expiration timer
+                self.pending_blocks.add(block, peer_id, current)
+                return block
+            self._block_released(block)
+            request = self.pending_blocks.pop_expired(current)
         return None
 
+    def _block_released(self, block: Block):
+        piece = self.ongoing_pieces.get(block.piece)
+        if piece:
+            piece.block_released(block.offset)
+
     def _next_ongoing(self, peer_id) -> Block:
         """
         Go through the ongoing pieces and return the next block to be
         requested or None if no block is left to be requested.
         """
-        for piece in self.ongoing_pieces:
+        for piece in self.ongoing_pieces.values():
             if self.peers[peer_id][piece.index]:
                 # Is there any blocks left to request in this piece?
-                block = piece.next_request()
+                block = self._request_block(peer_id, piece)
                 if block:
-                    self.pending_blocks.append(PendingRequest(block, int(round(time.time() * 1000))))
                     return block
         return None
 
+    def _request_block(self, peer_id, piece: Piece) -> Block:
+        """
+        Get the next block to request of the given piece from the given peer
+        and mark it as pending, or None if all its blocks are already
+        requested.
+        """
+        block = piece.next_request()
+        if block:
+            self.pending_blocks.add(block, peer_id, int(round(time.time() * 1000)))
+        return block
+
     def _get_rarest_piece(self, peer_id) -> Piece:
         """
         Given the current list of missing pieces, get the
         rarest one first (i.e. a piece which fewest of its
-        neighboring peers have)
-        """
-        piece_count = defaultdict(int)
-        for piece in self.missing_pieces:
-            if not self.peers[peer_id][piece.index]:
-                continue
-            for p in self.peers:
-                if self.peers[p][piece.index]:
-                    piece_count[piece] += 1
+        neighboring peers have) and start it.
 
-        rarest_piece = min(piece_count, key=lambda p: piece_count[p])
-        self.missing_pieces.remove(rarest_piece)
-        self.ongoing_pieces.append(rarest_piece)
+        If the peer has none of the missing pieces None is returned.
+        """
+        index = self.picker.pick(self.peers[peer_id])
+        if index is None:
+            return None
+        rarest_piece = Piece(index, self._piece_length(index),
+                             self.piece_hashes[index])
+        self.ongoing_pieces[index] = rarest_piece
         return rarest_piece
 
     def block_received(self, remote_id, piece_index, block_offset, data):
@@ -214,49 +478,74 @@ class PieceManager:
         This method must be called when a block has successfully been retrieved
         by a peer.
 
-        Once a full piece have been retrieved, a SHA1 hash control is made. If
-        the check fails all the pieces blocks are put back in missing state to
-        be fetched again. If the hash succeeds the partial piece is written to
-        disk and the piece is indicated as Have.
+        Once a full piece have been retrieved, it is handed to the verifier
+        for a SHA1 hash control (see `_piece_verified`).
         """
         logging.info('Received block {block_offset} for piece {piece_index} '
                       'from peer {remote_id}: '.format(block_offset=block_offset,
                                                      piece_index=piece_index,
                                                      remote_id=remote_id))
 
-        # Remove from pending requests
-        for index, request in enumerate(self.pending_blocks):
-            if request.block.piece == piece_index and \
-               request.block.offset == block_offset:
-                del self.pending_blocks[index]
-                break
-
-        pieces = [p for p in self.ongoing_pieces if p.index == piece_index]
-        piece = pieces[0] if pieces else None
-        if piece:
+        self.download_rate.update(len(data))
+
+        # Remove from pending requests, cancelling the requests of the same
+        # block to other peers
+        request = self.pending_blocks.get(piece_index, block_offset)
+        if request:
+            owners = [request.peer_id] + self.pending_blocks.get_duplicates(
+                piece_index, block_offset)
+            self.pending_blocks.remove(piece_index, block_offset)
+            for peer_id in owners:
+                listener = self.cancel_listeners.get(peer_id)
+                if peer_id != remote_id and listener:
+                    listener(request.block)
+
+        piece = self.ongoing_pieces.get(piece_index)
+        if piece and piece.has_block(block_offset):
+            # Another copy arrived first (endgame)
+            self.redundant_bytes += len(data)
+        elif piece:
             piece.block_received(block_offset, data)
             if piece.is_complete():
-                if piece.is_hash_matching():
-                    self._write(piece)
-                    self.ongoing_pieces.remove(piece)
-                    self.have_pieces.append(piece)
-                    complete = len(self.have_pieces)
-                    # complete = (self.total_pieces_len -
-                    #             len(self.missing_pieces) -
-                    #             len(self.ongoing_pieces))
-                    print(' ==== >>> ==== >>> {complete} / {total} pieces downloaded {per:.3f} % <<< ==== <<< ===='
-                          .format(complete=complete,
-                                  total=self.total_pieces_len,
-                                  per=(complete/self.total_pieces_len)*100))
-                    if (self.total_pieces_len == complete):
-                        print("complete")
-                else:
-                    logging.info('Discarding corrupt piece {index}'
-                                 .format(index=piece.index))
-                    piece.reset()
+                del self.ongoing_pieces[piece.index]
+                self.verifying_pieces[piece.index] = piece
+                self.verifier.submit(piece, self._piece_verified)
+        elif piece_index in self.verifying_pieces or \
+                (piece_index < self.total_pieces_len and
+                 self.have_pieces[piece_index]):
+            self.redundant_bytes += len(data)
         else:
             logging.warning('Trying to update piece that is not ongoing!')
 
+    def _piece_verified(self, piece: Piece, hash_matching: bool):
+        """
+        Called by the verifier once the hash of a completed piece is checked.
+
+        If the check fails all the pieces blocks are put back in missing state
+        to be fetched again. If the hash succeeds the partial piece is written
+        to disk and the piece is indicated as Have.
+        """
+        if self.verifying_pieces.pop(piece.index, None) is None:
+            # The manager was closed in the meantime
+            return
+        if hash_matching:
+            self._write(piece)
+            self._mark_have(piece.index)
+            for listener in list(self.have_listeners):
+                listener(piece.index)
+            # The progress is available through the metrics as well
+            logging.debug('{complete} / {total} pieces downloaded'.format(
+                complete=self.have_count, total=self.total_pieces_len))
+            if self.have_count == self.total_pieces_len:
+                logging.info('Every piece of {name} downloaded'.format(
+                    name=self.torrent.output_file))
+        else:
+            logging.info('Discarding corrupt piece {index}'
+                         .format(index=piece.index))
+            self.hash_failures += 1
+            piece.reset()
+            self.ongoing_pieces[piece.index] = piece
+
     # def _next_missing(self, peer_id) -> Block:
     #     """
     #     Go through the missing pieces and return the next block to request
@@ -278,8 +567,27 @@ class PieceManager:
 
     def _write(self, piece):
         """
-        Write the given piece to disk
+        Queue the given piece to be written to disk
         """
         pos = piece.index * self.torrent.piece_length
-        self.f.seek(pos, 0)
-        self.f.write(piece.data)
+        self.storage.write(pos, piece.blocks)
+
+    def _write_failed(self, offset: int, length: int):
+        """
+        Called by the storage when writing the given range failed. The pieces
+        it covers are not on disk, so they are put back in missing state to
+        be retrieved again (remote peers told we have them get their
+        requests ignored).
+        """
+        first = offset // self.torrent.piece_length
+        last = (offset + length - 1) // self.torrent.piece_length
+        for index in range(first, last + 1):
+            if self.have_pieces[index]:
+                logging.error('Unable to write piece {index}, retrieving it '
+                              'again'.format(index=index))
+                self.have_pieces[index] = 0
+                self.have_count -= 1
+                self.block_cache.discard(index)
+                self.picker.add(index)
+                self.endgame = False
+                self._changed = True
@@ -0,0 +1,128 @@
+from array import array
+
+
+class PiecePicker:
+    """
+    The piece picker implements the "rarest-piece-first" strategy: when a new
+    piece is to be started, pick the one that the fewest of the connected
+    peers have, so that rare pieces are spread in the swarm as fast as
+    possible.
+
+    Instead of counting the peers having each missing piece whenever a piece
+    is to be started, the availability of every piece is kept up to date as
+    peers connect, announce new pieces and disconnect. The pieces that can be
+    started are kept in buckets keyed by their availability, so picking the
+    rarest piece a peer has is a matter of walking the buckets from the
+    rarest up until a piece the peer has is found. For a peer having most of
+    the pieces (e.g. a seeder) that is the first piece looked at.
+
+    The buckets are dense lists (a piece is removed by moving the last piece
+    of the bucket in its place) rather than sets, since iterating a set that
+    had most of its items removed has to skip all the emptied slots.
+    """
+    def __init__(self, total_pieces: int):
+        self.total_pieces = total_pieces
+        # The number of connected peers having each piece
+        self.availability = array('I', [0]) * total_pieces
+        # Whether or not each piece is a candidate to be started (i.e. it is
+        # missing and not yet ongoing)
+        self.candidates = bytearray(b'\x01') * total_pieces
+        # The candidate pieces grouped by availability, buckets[n] holds the
+        # candidates that exactly n peers have
+        self.buckets = [list(range(total_pieces))]
+        # The position of each candidate within its bucket
+        self.positions = array('I', range(total_pieces))
+
+    def __len__(self):
+        """
+        The number of candidate pieces.
+        """
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def add_peer(self, bitfield):
+        """
+        Count the pieces of a newly connected peer.
+        """
+        for index in self._indices(bitfield):
+            self._move(index, 1)
+
+    def remove_peer(self, bitfield):
+        """
+        Stop counting the pieces of a disconnected peer.
+        """
+        for index in self._indices(bitfield):
+            self._move(index, -1)
+
+    def peer_have(self, index: int):
+        """
+        Count a piece a peer announced to have (reflects a Have message).
+        """
+        if index < self.total_pieces:
+            self._move(index, 1)
+
+    def pick(self, bitfield):
+        """
+        Get the index of the rarest candidate piece the peer with the given
+        bitfield has, and remove it from the candidates.
+
+        :return: The piece index or None if the peer has none of the
+                 candidate pieces
+        """
+        # Pieces no peer has are of no interest here, start at 1
+        for bucket in self.buckets[1:]:
+            for index in bucket:
+                if bitfield[index]:
+                    self.remove(index)
+                    return index
+        return None
+
+    def remove(self, index: int):
+        """
+        Remove a piece from the candidates (e.g. the piece was started).
+        """
+        if self.candidates[index]:
+            self.candidates[index] = 0
+            self._discard(self.availability[index], index)
+
+    def add(self, index: int):
+        """
+        Make a piece a candidate again (e.g. the piece has to be retrieved
+        again).
+        """
+        if not self.candidates[index]:
+            self.candidates[index] = 1
+            self._append(self.availability[index], index)
+
+    def _move(self, index: int, delta: int):
+        count = self.availability[index]
+        if count + delta < 0:
+            return
+        self.availability[index] = count + delta
+        if count + delta == len(self.buckets):
+            self.buckets.append([])
+        if self.candidates[index]:
+            self._discard(count, index)
+            self._append(count + delta, index)
+
+    def _append(self, count: int, index: int):
+        bucket = self.buckets[count]
+        self.positions[index] = len(bucket)
+        bucket.append(index)
+
+    def _discard(self, count: int, index: int):
+        bucket = self.buckets[count]
+        last = bucket.pop()
+        if last != index:
+            position = self.positions[index]
+            bucket[position] = last
+            self.positions[last] = position
+
+    def _indices(self, bitfield):
+        """
+        Get the indices of the pieces set in the given bitfield, ignoring the
+        spare bits at its end.
+        """
+        for index in bitfield.findall('0b1'):
+            if index >= self.total_pieces:
+                break
+            yield index
@@ -0,0 +1,49 @@
+import time
+
+
+class RateMeter:
+    """
+    Measures a transfer rate (bytes per second) over a rolling window.
+
+    The transferred bytes are summed in one slot per second of the window,
+    slots are reused as the window moves on, so updating and reading the
+    rate does not depend on the number of transfers.
+    """
+    def __init__(self, window: int = 20):
+        """
+        :param window: The length of the window, in seconds
+        """
+        self.window = window
+        self.slots = [0] * window
+        self.total = 0
+        self.started = time.monotonic()
+        # The second of the most recent slot
+        self.second = int(self.started)
+
+    def update(self, length: int, now: float = None):
+        """
+        Account the given number of bytes transferred.
+        """
+        self._advance(time.monotonic() if now is None else now)
+        self.slots[self.second % self.window] += length
+        self.total += length
+
+    def rate(self, now: float = None) -> float:
+        """
+        Get the average rate over the window (or since the meter was
+        started, if more recently), in bytes per second.
+        """
+        now = time.monotonic() if now is None else now
+        self._advance(now)
+        elapsed = min(self.window, max(1.0, now - self.started))
+        return sum(self.slots) / elapsed
+
+    def _advance(self, now: float):
+        second = int(now)
+        if second <= self.second:
+            return
+        # Clear the slots of the seconds without any transfer
+        for passed in range(self.second + 1,
+                            min(second, self.second + self.window) + 1):
+            self.slots[passed % self.window] = 0
+        self.second = second
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+
+
+class Recheck:
+    """
+    Verifies the data already on disk against the piece hashes of the
+    torrent, e.g. when there is no trusted fast-resume file.
+
+    Consecutive pieces are read in batches of about `read_size` bytes, so the
+    disk sees large sequential reads, and each batch is read and hashed by a
+    pool of worker threads (hashlib releases the GIL while hashing, so the
+    hashing runs on all cores). The pieces found valid are marked as have in
+    the piece manager as soon as their batch completes.
+    """
+    # Seconds between progress reports
+    REPORT_INTERVAL = 5
+
+    def __init__(self, piece_manager, max_workers: int = None,
+                 read_size: int = 8 * 2**20):
+        """
+        :param piece_manager: The piece manager to verify the data of
+        :param max_workers: The number of reading and hashing threads, by
+                            default the number of cores
+        :param read_size: The (approximate) number of bytes read at once
+        """
+        self.piece_manager = piece_manager
+        self.max_workers = max_workers if max_workers else os.cpu_count() or 1
+        piece_length = piece_manager.torrent.piece_length
+        self.pieces_per_batch = max(1, read_size // piece_length)
+        # Statistics
+        self.checked = 0
+        self.valid = 0
+        self.bytes_read = 0
+
+    async def run(self):
+        """
+        Verify every piece not already marked as have.
+        """
+        manager = self.piece_manager
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        reported = start
+        batches = self._batches()
+        pending = set()
+
+        with ThreadPoolExecutor(self.max_workers,
+                                thread_name_prefix='recheck') as executor:
+            while True:
+                # Keep a couple of batches per worker in flight, more would
+                # only hold read data in memory
+                while len(pending) < 2 * self.max_workers:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    pending.add(loop.run_in_executor(
+                        executor, self._check, batch))
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    results, length = future.result()
+                    self.bytes_read += length
+                    for index, valid in results:
+                        self.checked += 1
+                        if valid:
+                            self.valid += 1
+                            manager._mark_have(index)
+
+                now = time.monotonic()
+                if now - reported > Recheck.REPORT_INTERVAL:
+                    reported = now
+                    self._report(now - start)
+        self._report(time.monotonic() - start)
+
+    def _batches(self):
+        """
+        Generate the batches of consecutive piece indices to check.
+        """
+        manager = self.piece_manager
+        batch = []
+        for index in range(manager.total_pieces_len):
+            if manager.have_pieces[index]:
+                continue
+            if batch and (index != batch[-1] + 1 or
+                          len(batch) == self.pieces_per_batch):
+                yield batch
+                batch = []
+            batch.append(index)
+        if batch:
+            yield batch
+
+    def _check(self, batch: list) -> (list, int):
+        """
+        Read the given consecutive pieces with a single read and check their
+        hashes. Called from a worker thread.
+
+        :return: A list of (piece index, hash matching) and the number of
+                 bytes read
+        """
+        manager = self.piece_manager
+        piece_length = manager.torrent.piece_length
+        offset = batch[0] * piece_length
+        lengths = [manager._piece_length(index) for index in batch]
+        data = memoryview(manager.storage.pread(offset, sum(lengths)))
+
+        results = []
+        position = 0
+        for index, length in zip(batch, lengths):
+            piece_hash = sha1(data[position:position + length]).digest()
+            results.append((index, piece_hash == manager.piece_hashes[index]))
+            position += length
+        return results, position
+
+    def _report(self, elapsed: float):
+        total = self.piece_manager.total_pieces_len
+        logging.info('Recheck: {checked} / {total} pieces checked, {valid} '
+                     'valid, {rate:.1f} MB/s'.format(
+                         checked=self.checked,
+                         total=total,
+                         valid=self.valid,
+                         rate=self.bytes_read / 2**20 / max(elapsed, 1e-6)))
@@ -0,0 +1,103 @@
+import math
+import time
+
+from .peer_message import REQUEST_SIZE
+
+
+class RequestPipeline:
+    """
+    The request pipeline keeps track of the block requests in flight to a
+    single remote peer.
+
+    Having only one request outstanding caps the throughput of a connection
+    at one block per round-trip, so instead the pipeline is kept filled with
+    up to `depth` requests. The depth adapts to the bandwidth-delay product
+    measured for the peer: the rate at which blocks are received times the
+    shortest request latency seen (i.e. the round-trip time without any
+    queueing at the remote end).
+
+    The depth is set to twice the bandwidth-delay product, so while the
+    connection is limited by the pipeline (rather than by the link) the depth
+    doubles every measurement interval, similar to TCP slow start.
+    """
+    MIN_DEPTH = 2
+    MAX_DEPTH = 256
+    INITIAL_DEPTH = 4
+
+    # How often (in seconds) the receive rate and the depth are recomputed
+    INTERVAL = 1.0
+
+    def __init__(self):
+        # The requests in flight, keyed by (piece index, block offset) with
+        # the block and the moment it was requested as value
+        self.outstanding = {}
+        self.depth = RequestPipeline.INITIAL_DEPTH
+        # The smoothed receive rate in bytes per second
+        self.rate = 0.0
+        # The estimated round-trip time in seconds
+        self.rtt = None
+        self._received = 0
+        self._interval_start = time.monotonic()
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    @property
+    def free_slots(self) -> int:
+        """
+        The number of requests that can be sent before the pipeline is full.
+        """
+        return max(0, self.depth - len(self.outstanding))
+
+    def requested(self, block):
+        """
+        Register the given block as requested from the peer.
+        """
+        self.outstanding[(block.piece, block.offset)] = \
+            (block, time.monotonic())
+
+    def received(self, piece: int, offset: int, length: int):
+        """
+        Register that a block was received from the peer, updating the rate
+        and round-trip estimates.
+
+        :return: The block if it was requested through this pipeline, else
+                 None
+        """
+        now = time.monotonic()
+        self._received += length
+        request = self.outstanding.pop((piece, offset), None)
+        if request:
+            block, requested_at = request
+            sample = now - requested_at
+            if self.rtt is None or sample < self.rtt:
+                self.rtt = sample
+            else:
+                # Slowly forget old minimums in case the route changed
+                self.rtt += (sample - self.rtt) / 64
+        self._update(now)
+        return request[0] if request else None
+
+    def drain(self) -> list:
+        """
+        Forget all requests in flight (e.g. when the peer chokes us, since it
+        discards our pending requests) and return their blocks.
+        """
+        blocks = [block for block, _ in self.outstanding.values()]
+        self.outstanding.clear()
+        return blocks
+
+    def _update(self, now: float):
+        elapsed = now - self._interval_start
+        if elapsed < RequestPipeline.INTERVAL:
+            return
+        sample = self._received / elapsed
+        self.rate = sample if not self.rate else 0.5 * self.rate + 0.5 * sample
+        self._received = 0
+        self._interval_start = now
+
+        if self.rtt:
+            bdp = self.rate * self.rtt / REQUEST_SIZE
+            self.depth = min(RequestPipeline.MAX_DEPTH,
+                             max(RequestPipeline.MIN_DEPTH,
+                                 math.ceil(2 * bdp)))
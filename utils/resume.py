@@ -0,0 +1,127 @@
+import logging
+import os
+
+from .bencoding import Decoder, Encoder
+
+
+class FastResume:
+    """
+    The fast-resume file records which pieces of a torrent are verified and
+    written to disk, so a restarted download continues where it left off
+    instead of fetching everything again.
+
+    Along with the bitfield of the verified pieces, the size and modification
+    time of every file of the torrent is recorded when the file is saved. On
+    startup the bitfield is only trusted if the info hash matches and none of
+    the files were changed since (e.g. the client crashed while writing, or
+    the files were modified by someone else).
+
+    The file is also saved as a checkpoint while downloading, so a download
+    that was interrupted without being closed resumes from the last
+    checkpoint. Pieces keep being written after a checkpoint, so its
+    bitfield is trusted as long as the files only grew or were written
+    since (their size and modification time are not lower).
+
+    The file is bencoded and written next to the output as
+    `<output_file>.resume`, atomically (written to a temporary file which then
+    replaces the previous one).
+    """
+    def __init__(self, torrent, path: str = None):
+        self.torrent = torrent
+        self.path = path if path else torrent.output_file + '.resume'
+
+    def load(self) -> bytes:
+        """
+        Read the fast-resume file.
+
+        :return: The bitfield of verified pieces, or None if there is no
+                 fast-resume file or it cannot be trusted
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                state = Decoder(f.read()).decode()
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.warning('Ignoring unreadable resume file {path}'.format(
+                path=self.path))
+            return None
+
+        if not isinstance(state, dict) or \
+                state.get(b'info_hash') != self.torrent.info_hash:
+            logging.warning('Ignoring resume file {path} of another '
+                            'torrent'.format(path=self.path))
+            return None
+        if not self._unchanged(state.get(b'files'),
+                               state.get(b'checkpoint') == 1):
+            logging.info('Files changed since resume file {path} was '
+                         'saved'.format(path=self.path))
+            return None
+        bitfield = state.get(b'bitfield')
+        if not isinstance(bitfield, bytes) or \
+                len(bitfield) * 8 < len(self.torrent.pieces):
+            return None
+        return bitfield
+
+    def _unchanged(self, recorded, checkpoint: bool) -> bool:
+        """
+        Check whether the files are the ones the given stats were recorded
+        from.
+
+        :param checkpoint: Whether or not the files may have been written
+                           since
+        """
+        current = self._file_stats()
+        if not checkpoint:
+            return recorded == current
+        if not isinstance(recorded, list) or len(recorded) != len(current):
+            return False
+        for before, now in zip(recorded, current):
+            if not isinstance(before, list) or len(before) != 2:
+                return False
+            if before[0] < 0:
+                # Missing at the checkpoint, nothing is trusted from it
+                continue
+            if now[0] < before[0] or now[1] < before[1]:
+                return False
+        return True
+
+    def save(self, bitfield: bytes, checkpoint: bool = False):
+        """
+        Atomically write the fast-resume file. Must be called once all the
+        pieces of the bitfield are written to disk.
+
+        :param bitfield: The bitfield of verified pieces
+        :param checkpoint: Whether or not pieces are still being written
+        """
+        state = {
+            b'info_hash': self.torrent.info_hash,
+            b'bitfield': bitfield,
+            b'files': self._file_stats(),
+        }
+        if checkpoint:
+            state[b'checkpoint'] = 1
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(Encoder(state).encode())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+        except OSError:
+            logging.exception('Unable to save resume file {path}'.format(
+                path=self.path))
+
+    def _file_stats(self) -> list:
+        """
+        Get the [size, modification time in ns] of every file of the torrent,
+        [-1, -1] for missing files.
+        """
+        stats = []
+        for f in self.torrent.files:
+            try:
+                stat = os.stat(f.name)
+                stats.append([stat.st_size, stat.st_mtime_ns])
+            except FileNotFoundError:
+                stats.append([-1, -1])
+        return stats
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import TorrentClient
+from .dialer import Dialer
+from .metrics import MetricsServer
+from .peer_listener import PeerListener
+from .storage import Storage
+from .tracker import create_http_client
+from .udp_tracker import UDPTrackerClient
+from .verifier import PieceVerifier
+
+
+class Session:
+    """
+    A session runs any number of torrents on a single event loop.
+
+    The resources whose cost grows with the number of torrents are shared
+    by all the torrents of the session rather than created per torrent:
+
+        - the budget of open peer connections (a semaphore, a connection
+          holds a slot of it for as long as it is open)
+        - the `Dialer`, capping the connects in progress and holding back
+          the addresses that failed
+        - the HTTP connection pool used to announce to the trackers (the
+          connections are kept alive between announces), and the socket
+          used to announce to the UDP trackers
+        - the threads hashing the completed pieces (`PieceVerifier`)
+        - the threads writing and reading the files (`Storage`)
+
+    The storage options (`mmap_threshold`, `fsync` and `fsync_interval`, see
+    `Storage`) apply to every torrent of the session.
+
+    The connections remote peers open to us are accepted on `listen_port`
+    (announced to the trackers) and routed to the torrent they ask for.
+
+    Torrents can be added and removed while the session runs. A torrent
+    that is not seeded stays in the session once downloaded, until removed.
+
+    The metrics of every torrent of the session are served in the
+    Prometheus format on `metrics_port` (of the loopback interface) if
+    given.
+    """
+    def __init__(self, max_connections: int = 500,
+                 connections_per_torrent: int = 40, hashing_workers: int = 4,
+                 storage_workers: int = 8, metrics_port: int = None,
+                 listen_port: int = 6889, mmap_threshold: int = None,
+                 fsync: str = Storage.FSYNC_CLOSE, fsync_interval: float = 30):
+        """
+        :param max_connections: The number of peer connections open at once,
+                                over all torrents
+        :param connections_per_torrent: The number of peer connections of a
+                                        single torrent
+        :param hashing_workers: The number of threads hashing pieces
+        :param storage_workers: The number of threads doing disk I/O
+        :param metrics_port: The port to serve the metrics on, if any
+        :param listen_port: The port to accept peer connections on, 0 for
+                            any free port, None to not accept any
+        :param mmap_threshold: The size up to which files are memory mapped,
+                               None to not map any file
+        :param fsync: The fsync (or msync) policy of the files
+        :param fsync_interval: Seconds between syncs for the periodic policy
+        """
+        self.connections_per_torrent = connections_per_torrent
+        self.mmap_threshold = mmap_threshold
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.connection_budget = asyncio.Semaphore(max_connections)
+        self.dialer = Dialer()
+        self.verifier = PieceVerifier(hashing_workers,
+                                      max_queued=4 * hashing_workers)
+        self.storage_executor = ThreadPoolExecutor(
+            storage_workers, thread_name_prefix='storage')
+        # Created once the event loop runs, see `start`
+        self.http_client = None
+        self.udp_client = UDPTrackerClient()
+        # The clients of the torrents and the tasks running them, keyed by
+        # info hash
+        self.torrents = {}
+        self.tasks = {}
+        # Shared with the metrics server, updated as torrents come and go
+        self.sources = []
+        self.metrics_server = MetricsServer(self.sources, port=metrics_port) \
+            if metrics_port else None
+        self.listener = PeerListener(port=listen_port) \
+            if listen_port is not None else None
+
+    async def start(self):
+        """
+        Start the session, torrents can be added from then on.
+        """
+        self.http_client = create_http_client()
+        if self.listener:
+            await self.listener.start()
+        if self.metrics_server:
+            await self.metrics_server.start()
+
+    async def add(self, torrent, seed: bool = False) -> TorrentClient:
+        """
+        Add the given torrent to the session and start downloading it.
+
+        :param torrent: The `Torrent` to download
+        :param seed: Whether or not to keep seeding it once downloaded
+        :return: The client of the torrent
+        """
+        if self.http_client is None:
+            raise RuntimeError('Session not started')
+        if torrent.info_hash in self.torrents:
+            raise ValueError('Torrent {name} already in session'.format(
+                name=torrent.output_file))
+        client = TorrentClient(torrent, self.connections_per_torrent,
+                               seed=seed, http_client=self.http_client,
+                               verifier=self.verifier,
+                               storage_executor=self.storage_executor,
+                               connection_budget=self.connection_budget,
+                               listen_port=self.listener.port
+                               if self.listener else 0,
+                               dialer=self.dialer,
+                               udp_client=self.udp_client,
+                               mmap_threshold=self.mmap_threshold,
+                               fsync=self.fsync,
+                               fsync_interval=self.fsync_interval)
+        self.torrents[torrent.info_hash] = client
+        if self.listener:
+            self.listener.register(torrent.info_hash, client)
+        self.sources.append(client.metrics)
+        task = asyncio.ensure_future(client.start())
+        task.add_done_callback(
+            lambda t: self._on_done(torrent.output_file, t))
+        self.tasks[torrent.info_hash] = task
+        logging.info('Added torrent {name} ({count} in session)'.format(
+            name=torrent.output_file, count=len(self.torrents)))
+        return client
+
+    def _on_done(self, name: str, task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logging.error('Torrent {name} failed: {error}'.format(
+                name=name, error=task.exception()))
+
+    async def remove(self, info_hash: bytes):
+        """
+        Stop the torrent with the given info hash and remove it from the
+        session. Its files are kept.
+        """
+        client = self.torrents.pop(info_hash, None)
+        if client is None:
+            raise KeyError(info_hash)
+        task = self.tasks.pop(info_hash)
+        self.sources.remove(client.metrics)
+        if self.listener:
+            self.listener.unregister(info_hash)
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        # Done already if the client returned, failed or was cancelled
+        await client.stop()
+        logging.info('Removed torrent {name} ({count} in session)'.format(
+            name=client.tracker.torrent.output_file,
+            count=len(self.torrents)))
+
+    async def wait(self):
+        """
+        Wait until every torrent of the session is done, i.e. downloaded if
+        not seeded, or removed.
+        """
+        while any(not task.done() for task in self.tasks.values()):
+            await asyncio.wait(list(self.tasks.values()))
+
+    async def close(self):
+        """
+        Remove every torrent and release the shared resources.
+        """
+        for info_hash in list(self.torrents):
+            await self.remove(info_hash)
+        if self.listener:
+            self.listener.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        self.verifier.close()
+        self.storage_executor.shutdown(wait=True)
+        if self.http_client:
+            await self.http_client.close()
+            self.http_client = None
+        self.udp_client.close()
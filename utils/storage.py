@@ -0,0 +1,569 @@
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import threading
+import time
+
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# The largest number of buffers accepted by a single vectored write
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16
+
+
+class FileSpans:
+    """
+    Maps the byte space of a torrent (all its files concatenated in order)
+    to ranges within the individual files.
+
+    The start offset of every file is precomputed in a sorted list, so the
+    file holding a given offset is found by bisection, in O(log files).
+    """
+    def __init__(self, lengths: list):
+        self.lengths = list(lengths)
+        self.starts = []
+        start = 0
+        for length in self.lengths:
+            self.starts.append(start)
+            start += length
+        self.total_size = start
+
+    def spans(self, offset: int, length: int) -> list:
+        """
+        Split the given range of the torrent byte space into the ranges of
+        the files it covers.
+
+        :return: A list of (file index, offset within file, length) tuples
+        """
+        if offset < 0 or offset + length > self.total_size:
+            raise ValueError('Range {offset}+{length} outside of torrent of '
+                             '{size} bytes'.format(offset=offset,
+                                                   length=length,
+                                                   size=self.total_size))
+        spans = []
+        # The last file starting at or before the offset; empty files share
+        # their start with the next file and are skipped this way
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0:
+            file_offset = offset - self.starts[index]
+            span = min(length, self.lengths[index] - file_offset)
+            if span > 0:
+                spans.append((index, file_offset, span))
+                offset += span
+                length -= span
+            index += 1
+        return spans
+
+
+class Storage:
+    """
+    The storage engine persists verified pieces to disk without blocking the
+    event loop.
+
+    Offsets are given in the byte space of the torrent, writes and reads are
+    split over the files of the torrent with a `FileSpans` index (a piece
+    might span several files in a multi-file torrent). Since a torrent might
+    contain thousands of files, only a bounded number of them are kept open
+    at once (the least recently used idle file is closed first).
+
+    Pieces are accepted into a write-behind queue and written by a pool of
+    worker threads using positional writes (`os.pwritev`), so no file position
+    is shared between the workers. Pieces queued while a write is in progress
+    are coalesced: adjacent pieces are written with a single large sequential
+    write.
+
+    The queue is bounded (in bytes). Once full, `wait_for_capacity` blocks
+    until the disk catches up, so a slow disk shows up as backpressure on the
+    peer connections rather than as a frozen event loop.
+
+    A write that fails (e.g. the disk is full) is reported to
+    `on_write_error` with the range it covered, the data is dropped.
+
+    Optionally files up to `mmap_threshold` bytes are preallocated and memory
+    mapped: written blocks are copied straight into the mapping and reads of
+    a range within a single mapped file are served as zero-copy `memoryview`
+    slices of the mapping. Larger files (and every file if the threshold is
+    None) use positional reads and writes.
+
+    The fsync policy is one of:
+        - `never`: leave it to the operating system
+        - `periodic`: fsync at most every `fsync_interval` seconds
+        - `close`: fsync once when the storage is closed
+    For memory mapped files the policy applies to `msync` instead.
+    """
+    FSYNC_NEVER = 'never'
+    FSYNC_PERIODIC = 'periodic'
+    FSYNC_CLOSE = 'close'
+
+    def __init__(self, files: list, max_queued_bytes: int = 64 * 2**20,
+                 max_workers: int = 2, max_write_size: int = 16 * 2**20,
+                 fsync: str = FSYNC_CLOSE, fsync_interval: float = 30,
+                 max_open_files: int = 64, mmap_threshold: int = None,
+                 executor: ThreadPoolExecutor = None):
+        """
+        :param files: The files to write to as (path, length) tuples, in
+                      torrent order (e.g. `Torrent.files`)
+        :param max_queued_bytes: The number of bytes queued (or being written)
+                                 before backpressure is applied
+        :param max_workers: The number of writing threads
+        :param max_write_size: The largest number of bytes to coalesce into
+                               a single write
+        :param fsync: The fsync policy
+        :param fsync_interval: Seconds between fsyncs for the periodic policy
+        :param max_open_files: The number of files kept open
+        :param mmap_threshold: The size up to which files are memory mapped,
+                               None to not map any file
+        :param executor: The worker threads to use, which might be shared
+                         with other storages (`max_workers` is then
+                         ignored)
+        """
+        if fsync not in (Storage.FSYNC_NEVER, Storage.FSYNC_PERIODIC,
+                         Storage.FSYNC_CLOSE):
+            raise ValueError('Unknown fsync policy: {}'.format(fsync))
+        self.paths = [path for path, _ in files]
+        self.spans = FileSpans([length for _, length in files])
+        # The memory mapped files, file index -> mmap
+        self._maps = {}
+        for index, (path, length) in enumerate(files):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Existing files are kept, they might hold pieces of a previous
+            # run (see `FastResume`)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                mapped = mmap_threshold is not None and \
+                    0 < length <= mmap_threshold
+                if size > length or (mapped and size != length):
+                    # Preallocate (sparse) the file so it can be mapped
+                    os.ftruncate(fd, length)
+                if mapped:
+                    self._maps[index] = mmap.mmap(fd, length)
+            finally:
+                os.close(fd)
+        self.max_open_files = max_open_files
+        # The open files, file index -> fd, in least recently used order
+        self._fds = OrderedDict()
+        # The number of workers using each open file
+        self._users = {}
+        # The files written since last synced
+        self._dirty = set()
+        self._dirty_maps = set()
+        self._fds_lock = threading.Lock()
+        # An executor given by the caller might be shared with other storages
+        self._own_executor = executor is None
+        self.executor = executor if executor else \
+            ThreadPoolExecutor(max_workers, thread_name_prefix='storage')
+        # The work handed to the executor and not yet completed
+        self._running = set()
+        self.max_queued_bytes = max_queued_bytes
+        self.max_write_size = max_write_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        # The writes not yet handed to a worker, offset -> list of buffers
+        self.queue = {}
+        # The writes handed to a worker but not yet completed
+        self._writing = {}
+        # Bytes queued or being written
+        self.queued_bytes = 0
+        # Called with the (offset, length) of every write that failed
+        self.on_write_error = None
+        # Statistics
+        self.writes = 0
+        self.write_errors = 0
+        self.bytes_written = 0
+        self.write_latency = 0.0  # Smoothed seconds per write
+        self.max_write_latency = 0.0
+
+        self._last_fsync = time.monotonic()
+        self._writer = None
+        self._wakeup = asyncio.Event()
+        self._capacity = asyncio.Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of writes waiting for a worker.
+        """
+        return len(self.queue)
+
+    @property
+    def full(self) -> bool:
+        return self.queued_bytes >= self.max_queued_bytes
+
+    def write(self, offset: int, data):
+        """
+        Queue data to be written at the given offset.
+
+        :param offset: The offset within the file
+        :param data: A bytes-like object or a list of them, which must not
+                     be modified until written
+        """
+        if not isinstance(data, list):
+            data = [data]
+        replaced = self.queue.pop(offset, None)
+        if replaced:
+            self.queued_bytes -= _length(replaced)
+        self.queue[offset] = data
+        self.queued_bytes += _length(data)
+
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_loop())
+        self._wakeup.set()
+
+    async def wait_for_capacity(self):
+        """
+        Wait until the write-behind queue has room for more data.
+        """
+        if not self.full:
+            return
+        async with self._capacity:
+            await self._capacity.wait_for(lambda: not self.full)
+
+    async def flush(self):
+        """
+        Wait until everything queued so far is written.
+        """
+        while self.queue or self.queued_bytes:
+            async with self._capacity:
+                await self._capacity.wait()
+
+    def pending_offsets(self) -> set:
+        """
+        The offsets of the writes queued or being written.
+        """
+        return set(self.queue) | set(self._writing)
+
+    async def sync(self):
+        """
+        Sync the data written so far to disk, unless the fsync policy is
+        `never`.
+        """
+        if self.fsync != Storage.FSYNC_NEVER:
+            await self._submit(self._fsync)
+
+    async def _write_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.queue:
+                runs = self._coalesce()
+                batch = self.queue
+                self.queue = {}
+                # Still served by `read` until written
+                self._writing.update(batch)
+                latencies = await asyncio.gather(*[
+                    self._submit(self._timed_write, offset, buffers)
+                    for offset, buffers in runs])
+                for offset, buffers in batch.items():
+                    if self._writing.get(offset) is buffers:
+                        del self._writing[offset]
+                for (offset, buffers), elapsed in zip(runs, latencies):
+                    self._completed(offset, _length(buffers), elapsed)
+                self.queued_bytes -= sum(_length(b) for _, b in runs)
+                async with self._capacity:
+                    self._capacity.notify_all()
+
+            if self.fsync == Storage.FSYNC_PERIODIC and \
+                    time.monotonic() - self._last_fsync > self.fsync_interval:
+                self._last_fsync = time.monotonic()
+                await self._submit(self._fsync)
+
+    def _submit(self, function, *args) -> asyncio.Future:
+        """
+        Run the given function on a worker thread, keeping track of it until
+        it completes.
+        """
+        future = self.executor.submit(function, *args)
+        self._running.add(future)
+        future.add_done_callback(self._running.discard)
+        return asyncio.wrap_future(future)
+
+    def _coalesce(self) -> list:
+        """
+        Group the queued writes into runs of adjacent writes.
+
+        :return: A list of (offset, buffers) tuples
+        """
+        runs = []
+        end = None
+        size = 0
+        for offset in sorted(self.queue):
+            buffers = self.queue[offset]
+            length = _length(buffers)
+            if offset == end and size + length <= self.max_write_size:
+                runs[-1][1].extend(buffers)
+                size += length
+            else:
+                runs.append((offset, list(buffers)))
+                size = length
+            end = offset + length
+        return runs
+
+    def _timed_write(self, offset: int, buffers: list) -> float:
+        """
+        Write the buffers at the given offset and return the time it took, or
+        None if the write failed. Called from a worker thread.
+        """
+        start = time.monotonic()
+        try:
+            self._pwrite(offset, buffers)
+        except OSError:
+            logging.exception('Unable to write {length} bytes at '
+                              '{offset}'.format(length=_length(buffers),
+                                                offset=offset))
+            return None
+        return time.monotonic() - start
+
+    def _completed(self, offset: int, length: int, elapsed: float):
+        """
+        Account a write that completed, or report it if it failed (elapsed
+        is None).
+        """
+        if elapsed is None:
+            self.write_errors += 1
+            if self.on_write_error:
+                self.on_write_error(offset, length)
+            return
+        self.writes += 1
+        self.bytes_written += length
+        self.write_latency += (elapsed - self.write_latency) / 8
+        self.max_write_latency = max(self.max_write_latency, elapsed)
+
+    def _pwrite(self, offset: int, buffers: list):
+        """
+        Write all the given buffers at the given offset of the torrent,
+        splitting them over the files covered.
+        """
+        buffers = deque(memoryview(b).cast('B') for b in buffers)
+        for index, file_offset, length in self.spans.spans(offset,
+                                                            _length(buffers)):
+            # Take the buffers (or parts of) making up this span
+            chunk = []
+            while length:
+                buffer = buffers[0]
+                if len(buffer) <= length:
+                    chunk.append(buffers.popleft())
+                    length -= len(buffer)
+                else:
+                    chunk.append(buffer[:length])
+                    buffers[0] = buffer[length:]
+                    length = 0
+            if index in self._maps:
+                self._write_map(index, file_offset, chunk)
+                continue
+            fd = self._acquire(index, write=True)
+            try:
+                self._pwrite_file(fd, file_offset, chunk)
+            finally:
+                self._release(index)
+
+    def _write_map(self, index: int, offset: int, buffers: list):
+        """
+        Copy the given buffers into the mapping of a file at the given
+        offset.
+        """
+        mapping = self._maps[index]
+        for buffer in buffers:
+            mapping[offset:offset + len(buffer)] = buffer
+            offset += len(buffer)
+        self._dirty_maps.add(index)
+
+    def _pwrite_file(self, fd: int, offset: int, buffers: list):
+        """
+        Write all the given buffers at the given offset of a file, retrying
+        on partial writes.
+        """
+        if not hasattr(os, 'pwritev'):
+            for buffer in buffers:
+                written = 0
+                while written < len(buffer):
+                    written += os.pwrite(fd, buffer[written:],
+                                         offset + written)
+                offset += written
+            return
+        first = 0
+        while first < len(buffers):
+            # The number of buffers per call is limited by the system
+            written = os.pwritev(fd, buffers[first:first + IOV_MAX],
+                                 offset)
+            offset += written
+            while first < len(buffers) and written >= len(buffers[first]):
+                written -= len(buffers[first])
+                first += 1
+            if written:
+                buffers[first] = buffers[first][written:]
+
+    async def read(self, offset: int, length: int):
+        """
+        Read the given range of the torrent from disk.
+
+        Data queued but not yet written is returned as well, if the range is
+        exactly the one of a queued write (e.g. a piece read back to be
+        uploaded just after it was verified).
+
+        :return: A bytes-like object, a `memoryview` of the mapping if the
+                 range is within a single memory mapped file
+        """
+        buffers = self.queue.get(offset) or self._writing.get(offset)
+        if buffers is not None and _length(buffers) == length:
+            return b''.join(buffers)
+        view = self._map_view(offset, length)
+        if view is not None:
+            return view
+        return await self._submit(self.pread, offset, length)
+
+    def _map_view(self, offset: int, length: int) -> memoryview:
+        """
+        Get a view of the given range of the torrent if it lies within a
+        single memory mapped file, else None.
+        """
+        if not self._maps:
+            return None
+        spans = self.spans.spans(offset, length)
+        if len(spans) != 1 or spans[0][0] not in self._maps:
+            return None
+        index, file_offset, span = spans[0]
+        return memoryview(self._maps[index])[file_offset:file_offset + span]
+
+    def pread(self, offset: int, length: int) -> bytearray:
+        """
+        Read the given range of the torrent, possibly from several files.
+
+        This is a blocking call, to be made from a worker thread.
+        """
+        data = bytearray(length)
+        view = memoryview(data)
+        position = 0
+        for index, file_offset, span in self.spans.spans(offset, length):
+            if index in self._maps:
+                view[position:position + span] = \
+                    self._maps[index][file_offset:file_offset + span]
+                position += span
+                continue
+            fd = self._acquire(index)
+            try:
+                self._pread_file(fd, file_offset, view[position:position + span])
+            finally:
+                self._release(index)
+            position += span
+        view.release()
+        return data
+
+    def _pread_file(self, fd: int, offset: int, view: memoryview):
+        """
+        Fill the given view with the data of a file at the given offset.
+        """
+        position = 0
+        span = len(view)
+        while span:
+            chunk = os.pread(fd, span, offset)
+            if not chunk:
+                # Beyond the end of the file (not yet written), the
+                # buffer is already zero-filled
+                return
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+            offset += len(chunk)
+            span -= len(chunk)
+
+    def _acquire(self, index: int, write: bool = False) -> int:
+        """
+        Get an open fd for the file with the given index, opening it if
+        needed. Must be paired with a call to `_release`.
+        """
+        with self._fds_lock:
+            fd = self._fds.get(index)
+            if fd is None:
+                fd = os.open(self.paths[index], os.O_RDWR)
+                self._fds[index] = fd
+                self._users[index] = 0
+                self._close_idle(self.max_open_files)
+            self._fds.move_to_end(index)
+            self._users[index] += 1
+            if write:
+                self._dirty.add(index)
+            return fd
+
+    def _release(self, index: int):
+        with self._fds_lock:
+            self._users[index] -= 1
+
+    def _close_idle(self, keep: int):
+        """
+        Close the least recently used files not in use until at most `keep`
+        files are open. Must be called with the lock held.
+        """
+        for index in list(self._fds):
+            if len(self._fds) <= keep:
+                break
+            if self._users[index]:
+                continue
+            fd = self._fds.pop(index)
+            del self._users[index]
+            if index in self._dirty and self.fsync != Storage.FSYNC_NEVER:
+                os.fsync(fd)
+            self._dirty.discard(index)
+            os.close(fd)
+
+    def _fsync(self):
+        for index in list(self._dirty_maps):
+            self._dirty_maps.discard(index)
+            self._maps[index].flush()
+        with self._fds_lock:
+            for index in list(self._dirty):
+                os.fsync(self._fds[index])
+            # Files written since will be marked dirty again
+            self._dirty.clear()
+
+    async def aclose(self):
+        """
+        Write whatever is still queued and close the files, without blocking
+        the event loop.
+        """
+        await self.flush()
+        if self._writer and not self._writer.done():
+            self._writer.cancel()
+        self._writer = None
+        # Syncing and closing the files might still take a while
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        """
+        Write whatever is still queued and close the files. This blocks until
+        the data is written, see `aclose` to close from the event loop.
+        """
+        if self._writer and not self._writer.done():
+            self._writer.cancel()
+        # Wait for the writes handed to the workers to complete
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+        else:
+            wait(list(self._running))
+        for offset, buffers in self._coalesce():
+            self._completed(offset, _length(buffers),
+                            self._timed_write(offset, buffers))
+        self.queue.clear()
+        self._writing.clear()
+        self.queued_bytes = 0
+        with self._fds_lock:
+            self._close_idle(0)
+        for mapping in self._maps.values():
+            if self.fsync != Storage.FSYNC_NEVER:
+                mapping.flush()
+            try:
+                mapping.close()
+            except BufferError:
+                # Views of the mapping are still used (e.g. being uploaded),
+                # it will be unmapped once they are released
+                pass
+        self._maps = {}
+
+
+def _length(buffers) -> int:
+    return sum(len(b) for b in buffers)
@@ -15,78 +15,168 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
 from hashlib import sha1
 from collections import namedtuple
 
-from .bencoding import Decoder, Encoder
+from .bencoding import Decoder
 
-# Represents the files within the torrent (i.e. the files to write to disk)
+# Represents the files within the torrent (i.e. the files to write to disk),
+# the name being the path relative to the download directory
 TorrentFile = namedtuple('TorrentFile', ['name', 'length'])
 
 
+class PieceHashes:
+    """
+    The table of the SHA1 hashes of the pieces of a torrent.
+
+    The hashes are kept as the single buffer found in the meta-info (20
+    bytes per piece), a hash is returned as a `memoryview` of it, i.e. no
+    per-piece object is created until asked for and nothing is copied.
+    """
+    HASH_LENGTH = 20
+
+    def __init__(self, data: bytes):
+        if len(data) % PieceHashes.HASH_LENGTH:
+            raise ValueError('Invalid pieces length: {}'.format(len(data)))
+        self._view = memoryview(data)
+        self._count = len(data) // PieceHashes.HASH_LENGTH
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index: int) -> memoryview:
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('Piece index out of range: {}'.format(index))
+        start = index * PieceHashes.HASH_LENGTH
+        return self._view[start:start + PieceHashes.HASH_LENGTH]
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+
+class TorrentMetadata(namedtuple('TorrentMetadata', [
+        'info_hash', 'name', 'announce', 'announce_list', 'multi_file',
+        'piece_length', 'total_size', 'pieces', 'files'])):
+    """
+    The immutable meta-data of a torrent, extracted once from the meta-info
+    dict.
+    """
+    __slots__ = ()
+
+    def piece_size(self, index: int) -> int:
+        """
+        Get the length of the piece with the given index. Every piece has the
+        same length except the final one, which might be shorter.
+        """
+        if index < len(self.pieces) - 1:
+            return self.piece_length
+        return self.total_size - index * self.piece_length
+
+
 class Torrent:
     """
     Represent the torrent meta-data that is kept within a .torrent file. It is
     basically just a wrapper around the bencoded data with utility functions.
 
+    The meta-data is extracted once, when the file is loaded, into an
+    immutable `TorrentMetadata` (see `metadata`) which the properties are
+    read from.
+
     This class does not contain any session state as part of the download.
     """
     def __init__(self, filename):
         self.filename = filename
-        self.files = []
 
         with open(self.filename, 'rb') as f:
-            meta_info = f.read()
-            self.meta_info = Decoder(meta_info).decode()
-            info = Encoder(self.meta_info[b'info']).encode()
-            self.info_hash = sha1(info).digest()
-            self._identify_files()
-        # print()
-
-    def _identify_files(self):
+            decoder = Decoder(f.read())
+            self.meta_info = decoder.decode()
+            # The hash of the info dict exactly as found in the file
+            self.info_hash = sha1(decoder.raw(self.meta_info[b'info'])).digest()
+        self.metadata = self._extract()
+
+    def _extract(self) -> TorrentMetadata:
+        info = self.meta_info[b'info']
+        name = _safe_path([info[b'name']])
+        multi_file = b'files' in info
+        files = tuple(self._identify_files())
+
+        announce_list = tuple(
+            tuple(url.decode('utf-8') for url in tier)
+            for tier in self.meta_info.get(b'announce-list', []))
+        if b'announce' in self.meta_info:
+            announce = self.meta_info[b'announce'].decode('utf-8')
+        elif announce_list and announce_list[0]:
+            announce = announce_list[0][0]
+        else:
+            announce = None
+
+        return TorrentMetadata(
+            info_hash=self.info_hash,
+            name=name,
+            announce=announce,
+            announce_list=announce_list,
+            multi_file=multi_file,
+            piece_length=info[b'piece length'],
+            total_size=sum(f.length for f in files),
+            pieces=PieceHashes(info[b'pieces']),
+            files=files)
+
+    def _identify_files(self) -> list:
         """
         Identifies the files included in this torrent
         """
-        if self.multi_file:
-            # TODO Add support for multi-file torrents
-            # raise RuntimeError('Multi-file torrents is not supported!')
-            root = self.meta_info[b'info'][b'name'].decode('utf-8')
-            for f in self.meta_info[b'info'][b'files']:
-                self.files.append(
-                    TorrentFile(
-                        name=root+f[b'path'][0].decode('utf-8'),
-                        length=f[b'length']))
-        else:
-            self.files.append(
-                TorrentFile(
-                    name=self.meta_info[b'info'][b'name'].decode('utf-8'),
-                    length=self.meta_info[b'info'][b'length']))
+        info = self.meta_info[b'info']
+        if b'files' in info:
+            # The files of a multi-file torrent are placed in a directory
+            # named after the torrent, each file path is a list of the
+            # directories leading to it ending with the file name
+            root = _safe_path([info[b'name']])
+            return [TorrentFile(name=os.path.join(root, _safe_path(f[b'path'])),
+                                length=f[b'length'])
+                    for f in info[b'files']]
+        return [TorrentFile(name=_safe_path([info[b'name']]),
+                            length=info[b'length'])]
+
+    @property
+    def files(self) -> tuple:
+        """
+        The files of this torrent, as `TorrentFile` tuples in torrent order.
+        """
+        return self.metadata.files
 
     @property
     def announce(self) -> str:
         """
         The announce URL to the tracker.
         """
-        if b'announce' in self.meta_info:
-            return self.meta_info[b'announce'].decode('utf-8')
-        if b'announce-list' in self.meta_info:
-            return self.meta_info[b'announce-list'][0][0].decode('utf-8')
-        
+        return self.metadata.announce
+
+    @property
+    def announce_list(self) -> tuple:
+        """
+        The tiers of announce URLs (BEP 12), as tuples of URLs. Empty if the
+        torrent has a single tracker.
+        """
+        return self.metadata.announce_list
 
     @property
     def multi_file(self) -> bool:
         """
         Does this torrent contain multiple files?
         """
-        # If the info dict contains a files element then it is a multi-file
-        return b'files' in self.meta_info[b'info']
+        return self.metadata.multi_file
 
     @property
     def piece_length(self) -> int:
         """
         Get the length in bytes for each piece
         """
-        return self.meta_info[b'info'][b'piece length']
+        return self.metadata.piece_length
 
     @property
     def total_size(self) -> int:
@@ -97,37 +187,44 @@ class Torrent:
 
         :return: The total size (in bytes) for this torrent's data.
         """
-        size = 0
-        for f in self.files:
-            size += f.length
-        # if self.multi_file:
-        #     raise RuntimeError('Multi-file torrents is not supported!')
-        return self.files[0].length
+        return self.metadata.total_size
 
     @property
-    def pieces(self):
-        # The info pieces is a string representing all pieces SHA1 hashes
-        # (each 20 bytes long). Read that data and slice it up into the
-        # actual pieces
-        data = self.meta_info[b'info'][b'pieces']
-        pieces = []
-        offset = 0
-        length = len(data)
-
-        while offset < length:
-            pieces.append(data[offset:offset + 20])
-            offset += 20
-        return pieces
+    def pieces(self) -> PieceHashes:
+        """
+        The SHA1 hashes of the pieces, indexed by piece index.
+        """
+        return self.metadata.pieces
+
+    def piece_size(self, index: int) -> int:
+        """
+        Get the length of the piece with the given index.
+        """
+        return self.metadata.piece_size(index)
 
     @property
     def output_file(self):
-        return self.meta_info[b'info'][b'name'].decode('utf-8')
+        return self.metadata.name
 
     def __str__(self):
         return 'Filename: {0}\n' \
                'File length: {1}\n' \
                'Announce URL: {2}\n' \
-               'Hash: {3}'.format(self.meta_info[b'info'][b'name'],
-                                  self.meta_info[b'info'][b'length'],
-                                  self.meta_info[b'announce'],
+               'Hash: {3}'.format(self.metadata.name,
+                                  self.total_size,
+                                  self.announce,
                                   self.info_hash)
+
+
+def _safe_path(components) -> str:
+    """
+    Join the given path components (as found in the meta-info) into a
+    relative path, dropping any component that would escape the download
+    directory (such as `..`).
+    """
+    parts = [c.decode('utf-8') for c in components]
+    parts = [p for p in parts
+             if p not in ('', '.', '..') and '/' not in p and '\\' not in p]
+    if not parts:
+        raise ValueError('Invalid path in torrent: {}'.format(components))
+    return os.path.join(*parts)
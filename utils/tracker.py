@@ -8,6 +8,10 @@ from .misc import calculate_peer_id, decode_port
 from .bencoding import Decoder
 
 
+# The time (in seconds) an announce may take
+ANNOUNCE_TIMEOUT = 30
+
+
 class TrackerResponse:
     """
     The response from the tracker after a successful connection to the
@@ -41,6 +45,14 @@ class TrackerResponse:
         """
         return self.response.get(b'interval', 0)
 
+    @property
+    def min_interval(self) -> int:
+        """
+        The shortest interval in seconds the client may wait between
+        announces, 0 if not given.
+        """
+        return self.response.get(b'min interval', 0)
+
     @property
     def complete(self) -> int:
         """
@@ -68,12 +80,11 @@ class TrackerResponse:
         elif b'peers6' in self.response.keys():
             peers = self.response[b'peers6']
         else:
-            raise
+            return []
 
         if type(peers) == list:
-            # TODO Implement support for dictionary peer list
             logging.debug('Dictionary model peers are returned by tracker')
-            raise NotImplementedError()
+            return [(p[b'ip'].decode('utf-8'), p[b'port']) for p in peers]
         else:
             logging.debug('Binary model peers are returned by tracker')
 
@@ -96,16 +107,49 @@ class TrackerResponse:
                 )
 
 
+def create_http_client(limit: int = 100) -> aiohttp.ClientSession:
+    """
+    Create an HTTP session for announcing to trackers. Connections are kept
+    alive and pooled, so the announces to a tracker reuse one connection,
+    and resolved host names are cached.
+
+    :param limit: The number of connections open at once
+    """
+    connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=120,
+                                     ttl_dns_cache=600)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=ANNOUNCE_TIMEOUT))
+
+
 class Tracker:
-    def __init__(self, torrent):
+    """
+    A single tracker of a torrent, announced to over HTTP.
+    """
+    def __init__(self, torrent, http_client: aiohttp.ClientSession = None,
+                 port: int = 6889, url: str = None, peer_id: str = None):
+        """
+        :param torrent: The torrent to announce
+        :param http_client: The HTTP session to use, which might be shared
+                            with the trackers of other torrents
+        :param port: The port we accept peer connections on
+        :param url: The announce URL, the one of the torrent if not given
+        :param peer_id: Our peer ID, a new one if not given
+        """
         self.torrent = torrent
-        self.peer_id = calculate_peer_id()
-        self.http_client = aiohttp.ClientSession()
+        self.url = url if url else torrent.announce
+        self.peer_id = peer_id if peer_id else calculate_peer_id()
+        self.port = port
+        # A session given by the caller is closed by the caller
+        self._own_http_client = http_client is None
+        self.http_client = http_client
 
     async def connect(self,
                       first: bool = None,
                       uploaded: int = 0,
-                      downloaded: int = 0):
+                      downloaded: int = 0,
+                      left: int = 0,
+                      event: str = None):
         """
         Makes the announce call to the tracker to update with our statistics
         as well as get a list of available peers to connect to.
@@ -116,32 +160,32 @@ class Tracker:
         :param first: Whether or not this is the first announce call
         :param uploaded: The total number of bytes uploaded
         :param downloaded: The total number of bytes downloaded
+        :param left: The number of bytes we still have to download
+        :param event: The event to report ('started', 'completed' or
+                      'stopped'), 'started' on the first call by default
         """
+        if not self.url.startswith(('http://', 'https://')):
+            raise ValueError('Unsupported tracker: ' + self.url)
         params = {
-            # 'info_hash': b'\x12\x34\x56\x78\x9a\xbc\xde\xf1\x23\x45\x67\x89\xab\xcd\xef\x12\x34\x56\x78\x9a',
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': 0,
+            'port': self.port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
             'compact': 1
         }
-        if not first:
+        if event:
+            params['event'] = event
+        elif first:
             params['event'] = 'started'
 
-        url = self.torrent.announce + '?' + urlencode(params)
-        # url = 'http://tracker.opentrackr.org:1337/announce' + '?' + urlencode(params)
-        # url = 'udp://tracker.opentrackr.org:1337/announce' + '?' + urlencode(params)
-        # url = 'http://tracker1.itzmx.com:8080/announce' + '?' + urlencode(params)
-        # url = 'http://vps02.net.orel.ru:80/announce' + '?' + urlencode(params)
-        # url = 'http://tracker.zerobytes.xyz:1337/announce' + '?' + urlencode(params)
-        # url = 'https://w.wwwww.wtf:443/announce' + '?' + urlencode(params)
-        # url = 'https://trakx.herokuapp.com:443/announce' + '?' + urlencode(params)
-        # url = 'https://tracker.lelux.fi:443/announce' + '?' + urlencode(params)
+        url = self.url + ('&' if '?' in self.url else '?') + urlencode(params)
 
         logging.info('Connecting to tracker at: ' + url)
 
+        if self.http_client is None:
+            self.http_client = create_http_client()
         async with self.http_client.get(url) as response:
             if not response.status == 200:
                 raise ConnectionError('Unable to connect to tracker: status code {}'.format(response.status))
@@ -149,8 +193,10 @@ class Tracker:
             self.raise_for_error(data)
             return TrackerResponse(Decoder(data).decode())
 
-    def close(self):
-        self.http_client.close()
+    async def close(self):
+        if self._own_http_client and self.http_client:
+            await self.http_client.close()
+            self.http_client = None
 
     def raise_for_error(self, tracker_response):
         """
@@ -165,4 +211,4 @@ class Tracker:
 
         # a successful tracker response will have non-uncicode data, so it's a safe to bet ignore this exception.
         except UnicodeDecodeError:
-            pass
\ No newline at end of file
+            pass
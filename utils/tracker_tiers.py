@@ -0,0 +1,183 @@
+import aiohttp
+import asyncio
+import logging
+import random
+import time
+
+from .misc import calculate_peer_id
+from .tracker import Tracker, TrackerResponse, create_http_client
+from .udp_tracker import UDPTracker, UDPTrackerClient
+
+
+# The interval (in seconds) between announces if the tracker gives none
+DEFAULT_INTERVAL = 30 * 60
+# The shortest interval (in seconds) between announces if the tracker gives
+# none
+DEFAULT_MIN_INTERVAL = 60
+# The delay (in seconds) before announcing again to a tier that failed, it
+# doubles with every consecutive failure
+RETRY_DELAY = 15
+
+
+class TrackerTier:
+    """
+    A tier of trackers (BEP 12) and when to announce to it next.
+
+    The trackers of a tier are tried in order until one answers, and the
+    one answering is moved to the front of the tier.
+    """
+    def __init__(self, trackers: list):
+        self.trackers = trackers
+        # Whether or not the 'started' event was reported to this tier
+        self.started = False
+        self.failures = 0
+        # The moment of the next regular announce
+        self.next_announce = 0.0
+        # The earliest moment of an announce made to get more peers
+        self.earliest_announce = 0.0
+        # The announce in progress, if any
+        self.task = None
+
+    def due(self, now: float, want_peers: bool = False) -> bool:
+        if self.task:
+            return False
+        return now >= self.next_announce or \
+            (want_peers and now >= self.earliest_announce)
+
+    def succeeded(self, tracker, response: TrackerResponse,
+                  now: float):
+        self.trackers.remove(tracker)
+        self.trackers.insert(0, tracker)
+        self.started = True
+        self.failures = 0
+        interval = response.interval or DEFAULT_INTERVAL
+        min_interval = min(interval,
+                           response.min_interval or DEFAULT_MIN_INTERVAL)
+        self.next_announce = now + interval
+        self.earliest_announce = now + min_interval
+
+    def failed(self, now: float):
+        self.failures += 1
+        delay = min(DEFAULT_INTERVAL, RETRY_DELAY * 2 ** (self.failures - 1))
+        self.next_announce = self.earliest_announce = now + delay
+
+
+class TrackerTiers:
+    """
+    The trackers of a torrent, grouped in tiers as listed in its
+    `announce-list` (BEP 12), or the single `announce` URL otherwise.
+
+    The trackers of every tier are shuffled once. Every tier is announced
+    to concurrently, failing over to the next tracker of the tier when one
+    does not answer, so peers arrive from every tier at once. The announces
+    run in the background, a tier that is slow to answer does not hold back
+    the others.
+
+    Each tier is announced to again after the interval its tracker asked
+    for. When more peers are wanted, it is announced to before that, but
+    never before the minimum interval of the tracker. A tier where every
+    tracker failed is retried with a doubling delay.
+
+    All HTTP trackers use one HTTP session, pooling the keep-alive
+    connections, and all UDP trackers (BEP 15) use one UDP socket.
+    """
+    def __init__(self, torrent, http_client: aiohttp.ClientSession = None,
+                 port: int = 6889, udp_client: UDPTrackerClient = None):
+        """
+        :param torrent: The torrent to announce
+        :param http_client: The HTTP session to use, which might be shared
+                            with the trackers of other torrents
+        :param port: The port we accept peer connections on
+        :param udp_client: The UDP tracker client to use, which might be
+                           shared with the trackers of other torrents
+        """
+        self.torrent = torrent
+        self.peer_id = calculate_peer_id()
+        # A session given by the caller is closed by the caller
+        self._own_http_client = http_client is None
+        self.http_client = http_client if http_client else \
+            create_http_client()
+        self._own_udp_client = udp_client is None
+        self.udp_client = udp_client if udp_client else UDPTrackerClient()
+        self.tiers = []
+        for urls in torrent.announce_list or ((torrent.announce,),):
+            urls = list(urls)
+            random.shuffle(urls)
+            self.tiers.append(TrackerTier(
+                [self._tracker(url, port) for url in urls]))
+        # The announces in progress
+        self.tasks = set()
+
+    def _tracker(self, url: str, port: int):
+        if url.startswith('udp://'):
+            return UDPTracker(self.torrent, self.udp_client, port, url,
+                              self.peer_id)
+        return Tracker(self.torrent, self.http_client, port, url,
+                       self.peer_id)
+
+    def announce(self, callback, uploaded: int = 0, downloaded: int = 0,
+                 left: int = 0, event: str = None,
+                 want_peers: bool = False) -> list:
+        """
+        Start announcing to the tiers that are due, without waiting for the
+        trackers to answer.
+
+        An event ('completed' or 'stopped') is reported to every tier we
+        announced to already, whether due or not.
+
+        :param callback: Called with the tracker URL and the
+                         `TrackerResponse` of every tier that answers
+        :param uploaded: The total number of bytes uploaded
+        :param downloaded: The total number of bytes downloaded
+        :param left: The number of bytes we still have to download
+        :param event: The event to report, if any
+        :param want_peers: Whether or not more peers are wanted
+        :return: The tasks of the announces started
+        """
+        now = time.monotonic()
+        if event:
+            tiers = [t for t in self.tiers if t.started]
+        else:
+            tiers = [t for t in self.tiers if t.due(now, want_peers)]
+        tasks = []
+        for tier in tiers:
+            task = asyncio.ensure_future(self._announce_tier(
+                tier, callback, uploaded, downloaded, left, event))
+            tier.task = task
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            tasks.append(task)
+        return tasks
+
+    async def _announce_tier(self, tier: TrackerTier, callback,
+                             uploaded: int, downloaded: int, left: int,
+                             event: str):
+        try:
+            for tracker in list(tier.trackers):
+                try:
+                    response = await tracker.connect(
+                        uploaded=uploaded, downloaded=downloaded, left=left,
+                        event=event if event else
+                        (None if tier.started else 'started'))
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError,
+                        ValueError, EOFError, RuntimeError) as e:
+                    logging.warning('Announce to {url} failed: {error}'.format(
+                        url=tracker.url, error=e or type(e).__name__))
+                    continue
+                tier.succeeded(tracker, response, time.monotonic())
+                callback(tracker.url, response)
+                return
+            tier.failed(time.monotonic())
+        finally:
+            if tier.task is asyncio.current_task():
+                tier.task = None
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self._own_http_client and self.http_client:
+            await self.http_client.close()
+            self.http_client = None
+        if self._own_udp_client:
+            self.udp_client.close()
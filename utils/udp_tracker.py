@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+
+from urllib.parse import urlparse
+
+from .misc import calculate_peer_id
+from .tracker import TrackerResponse
+
+
+# The magic constant opening the connect request
+PROTOCOL_ID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# The number of info hashes a scrape request may hold
+MAX_SCRAPE = 74
+# The time (in seconds) a connection ID may be used once received
+CONNECTION_ID_LIFETIME = 60
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    Delivers the responses of UDP trackers to the requests waiting for
+    them, matched by transaction ID.
+    """
+    def __init__(self):
+        self.transport = None
+        # The futures of the requests waiting for a response, keyed by
+        # transaction ID
+        self.waiting = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if len(data) < 8:
+            return
+        action, transaction_id = struct.unpack_from('>II', data)
+        future = self.waiting.get(transaction_id)
+        # Responses to requests given up, or from anyone else, are dropped
+        if future is None or future.done():
+            return
+        if action == ACTION_ERROR:
+            future.set_exception(ConnectionError(
+                'Tracker error: ' + data[8:].decode('utf-8', 'replace')))
+        else:
+            future.set_result((action, data))
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable) are left to the timeouts
+        logging.debug('UDP tracker error: {error}'.format(error=exc))
+
+
+class UDPTrackerClient:
+    """
+    Speaks the UDP tracker protocol (BEP 15) over a single socket, shared by
+    the UDP trackers of every torrent.
+
+    A connection ID is obtained from a tracker before announcing, and reused
+    for `CONNECTION_ID_LIFETIME` seconds. A request not answered is sent
+    again after 15 * 2 ^ n seconds, n going from 0 up to `max_retransmits`,
+    after which the request fails with a `TimeoutError`. The spec goes up to
+    n = 8 (over an hour in total), the default gives up after a few minutes
+    so a tier can fail over to its next tracker.
+
+    Scrapes of many torrents are batched, up to `MAX_SCRAPE` info hashes in
+    a request.
+    """
+    def __init__(self, timeout: float = 15, max_retransmits: int = 2):
+        """
+        :param timeout: The time (in seconds) to wait for the first response
+        :param max_retransmits: The number of times a request is sent again
+        """
+        self.timeout = timeout
+        self.max_retransmits = max_retransmits
+        self.protocol = None
+        # The connection IDs of the trackers, as (ID, expiry moment) keyed by
+        # address
+        self.connection_ids = {}
+        # The resolved addresses of the trackers, keyed by (host, port)
+        self.addresses = {}
+        self._starting = None
+
+    async def _start(self):
+        if self.protocol is None:
+            if self._starting is None:
+                loop = asyncio.get_running_loop()
+                self._starting = asyncio.ensure_future(
+                    loop.create_datagram_endpoint(UDPTrackerProtocol,
+                                                  local_addr=('0.0.0.0', 0)))
+            _, self.protocol = await asyncio.shield(self._starting)
+
+    async def resolve(self, url: str) -> tuple:
+        """
+        Get the (ip, port) address of the tracker with the given URL.
+        """
+        parsed = urlparse(url)
+        key = (parsed.hostname, parsed.port)
+        if key not in self.addresses:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(parsed.hostname, parsed.port,
+                                           family=socket.AF_INET,
+                                           type=socket.SOCK_DGRAM)
+            self.addresses[key] = infos[0][4]
+        return self.addresses[key]
+
+    async def _request(self, address: tuple, build) -> bytes:
+        """
+        Send a request until it is answered.
+
+        :param build: A function building the request from a transaction ID
+        :return: The response
+        """
+        await self._start()
+        loop = asyncio.get_running_loop()
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self.protocol.waiting:
+            transaction_id = random.getrandbits(32)
+        request = build(transaction_id)
+        future = loop.create_future()
+        self.protocol.waiting[transaction_id] = future
+        try:
+            for n in range(self.max_retransmits + 1):
+                self.protocol.transport.sendto(request, address)
+                try:
+                    _, data = await asyncio.wait_for(
+                        asyncio.shield(future), self.timeout * 2 ** n)
+                    return data
+                except asyncio.TimeoutError:
+                    logging.debug('No response from {address}, try {n}'.format(
+                        address=address, n=n + 1))
+            raise TimeoutError('No response from tracker {ip}:{port}'.format(
+                ip=address[0], port=address[1]))
+        finally:
+            del self.protocol.waiting[transaction_id]
+            if not future.done():
+                future.cancel()
+
+    async def _connection_id(self, address: tuple) -> int:
+        connection_id, expiry = self.connection_ids.get(address, (None, 0))
+        if time.monotonic() < expiry:
+            return connection_id
+        data = await self._request(address, lambda transaction_id: struct.pack(
+            '>QII', PROTOCOL_ID, ACTION_CONNECT, transaction_id))
+        if len(data) < 16:
+            raise ConnectionError('Invalid connect response')
+        connection_id, = struct.unpack_from('>Q', data, 8)
+        self.connection_ids[address] = \
+            (connection_id, time.monotonic() + CONNECTION_ID_LIFETIME)
+        return connection_id
+
+    async def _call(self, address: tuple, build) -> bytes:
+        """
+        Send a request needing a connection ID until it is answered.
+
+        :param build: A function building the request from a connection ID
+                      and a transaction ID
+        :return: The response
+        """
+        connection_id = await self._connection_id(address)
+        try:
+            return await self._request(
+                address, lambda transaction_id: build(connection_id,
+                                                      transaction_id))
+        except ConnectionError:
+            # The tracker might have forgotten the connection ID, get a new
+            # one next time
+            self.connection_ids.pop(address, None)
+            raise
+
+    async def announce(self, address: tuple, info_hash: bytes,
+                       peer_id: bytes, downloaded: int, left: int,
+                       uploaded: int, event: str, key: int,
+                       port: int) -> TrackerResponse:
+        """
+        Announce a torrent to the tracker at the given address.
+
+        :return: The response, in the form of an HTTP tracker response with
+                 compact peers
+        """
+        def build(connection_id, transaction_id):
+            # No IP (the sender's is used) and as many peers as the tracker
+            # likes (-1)
+            return struct.pack('>QII20s20sQQQIIIiH', connection_id,
+                               ACTION_ANNOUNCE, transaction_id, info_hash,
+                               peer_id, downloaded, left, uploaded,
+                               EVENTS[event], 0, key, -1, port)
+
+        data = await self._call(address, build)
+        if len(data) < 20:
+            raise ConnectionError('Invalid announce response')
+        interval, leechers, seeders = struct.unpack_from('>III', data, 8)
+        # The peers are in the compact form of HTTP trackers
+        peers = data[20:]
+        return TrackerResponse({b'interval': interval,
+                                b'incomplete': leechers,
+                                b'complete': seeders,
+                                b'peers': peers[:len(peers) - len(peers) % 6]})
+
+    async def scrape(self, address: tuple, info_hashes: list) -> dict:
+        """
+        Get the statistics of the given torrents from the tracker at the
+        given address, in batches of `MAX_SCRAPE` torrents.
+
+        :return: The (seeders, completed, leechers) of every torrent, keyed
+                 by info hash
+        """
+        batches = [info_hashes[i:i + MAX_SCRAPE]
+                   for i in range(0, len(info_hashes), MAX_SCRAPE)]
+        results = await asyncio.gather(*[self._scrape(address, batch)
+                                         for batch in batches])
+        return {info_hash: stats for result in results
+                for info_hash, stats in result.items()}
+
+    async def _scrape(self, address: tuple, info_hashes: list) -> dict:
+        def build(connection_id, transaction_id):
+            return struct.pack('>QII', connection_id, ACTION_SCRAPE,
+                               transaction_id) + b''.join(info_hashes)
+
+        data = await self._call(address, build)
+        if len(data) < 8 + 12 * len(info_hashes):
+            raise ConnectionError('Invalid scrape response')
+        return {info_hash: struct.unpack_from('>III', data, 8 + 12 * i)
+                for i, info_hash in enumerate(info_hashes)}
+
+    def close(self):
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+        self.protocol = None
+        self._starting = None
+
+
+class UDPTracker:
+    """
+    A single tracker of a torrent, announced to over UDP (BEP 15). It has
+    the same interface as the HTTP `Tracker`.
+    """
+    def __init__(self, torrent, udp_client: UDPTrackerClient = None,
+                 port: int = 6889, url: str = None, peer_id: str = None):
+        """
+        :param torrent: The torrent to announce
+        :param udp_client: The UDP client to use, which might be shared
+                           with the trackers of other torrents
+        :param port: The port we accept peer connections on
+        :param url: The announce URL, the one of the torrent if not given
+        :param peer_id: Our peer ID, a new one if not given
+        """
+        self.torrent = torrent
+        self.url = url if url else torrent.announce
+        self.peer_id = peer_id if peer_id else calculate_peer_id()
+        self.port = port
+        # Lets the tracker recognize us if our address changes
+        self.key = random.getrandbits(32)
+        # A client given by the caller is closed by the caller
+        self._own_udp_client = udp_client is None
+        self.udp_client = udp_client if udp_client else UDPTrackerClient()
+
+    async def connect(self,
+                      first: bool = None,
+                      uploaded: int = 0,
+                      downloaded: int = 0,
+                      left: int = 0,
+                      event: str = None):
+        """
+        Makes the announce call to the tracker, see `Tracker.connect`.
+        """
+        if not event and first:
+            event = 'started'
+        logging.info('Connecting to tracker at: ' + self.url)
+        address = await self.udp_client.resolve(self.url)
+        peer_id = self.peer_id.encode('utf-8') \
+            if isinstance(self.peer_id, str) else self.peer_id
+        return await self.udp_client.announce(
+            address, self.torrent.info_hash, peer_id, downloaded, left,
+            uploaded, event, self.key, self.port)
+
+    async def close(self):
+        if self._own_udp_client:
+            self.udp_client.close()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+
+
+def _hash_blocks(blocks) -> bytes:
+    """
+    Calculate the SHA1 hash of the given blocks as if they were one buffer.
+    """
+    piece_hash = sha1()
+    for block in blocks:
+        piece_hash.update(block)
+    return piece_hash.digest()
+
+
+class PieceVerifier:
+    """
+    The verifier checks the SHA1 hash of completed pieces on a pool of worker
+    threads rather than on the event loop, so peer connections are not stalled
+    while a large piece is hashed (hashlib releases the GIL while hashing).
+
+    The result is delivered back on the event loop through a callback. The
+    number of pieces queued for verification is bounded; once the bound is
+    reached `wait_for_capacity` blocks until a verification completes, which
+    is used to stop requesting more blocks from peers until the verifier
+    catches up.
+    """
+    def __init__(self, max_workers: int = 2, max_queued: int = 16):
+        """
+        :param max_workers: The number of hashing threads
+        :param max_queued: The number of pieces that can be queued for
+                           verification before backpressure is applied
+        """
+        self.executor = ThreadPoolExecutor(max_workers,
+                                           thread_name_prefix='verifier')
+        self.max_queued = max_queued
+        self.queued = 0
+        self._capacity = asyncio.Condition()
+
+    @property
+    def full(self) -> bool:
+        return self.queued >= self.max_queued
+
+    def submit(self, piece, callback):
+        """
+        Queue the given (complete) piece for verification.
+
+        :param piece: The piece to verify
+        :param callback: Called on the event loop with the piece and whether
+                         or not its hash matched
+        """
+        loop = asyncio.get_running_loop()
+        self.queued += 1
+        # Hash a snapshot of the blocks, the list might be updated if a
+        # duplicate block is received while the piece is hashed.
+        future = loop.run_in_executor(self.executor, _hash_blocks,
+                                      list(piece.blocks))
+        future.add_done_callback(
+            lambda f: self._on_hashed(f, piece, callback))
+
+    def _on_hashed(self, future, piece, callback):
+        self.queued -= 1
+        asyncio.ensure_future(self._notify())
+        if future.cancelled():
+            return
+        if future.exception():
+            logging.error('Unable to verify piece {index}: {error}'.format(
+                index=piece.index, error=future.exception()))
+            callback(piece, False)
+        else:
+            callback(piece, future.result() == piece.hash)
+
+    async def _notify(self):
+        async with self._capacity:
+            self._capacity.notify_all()
+
+    async def wait_for_capacity(self):
+        """
+        Wait until there is room for another piece in the verification queue.
+        """
+        if not self.full:
+            return
+        async with self._capacity:
+            await self._capacity.wait_for(lambda: not self.full)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)